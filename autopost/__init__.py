@@ -0,0 +1 @@
+"""Building blocks of the Dropbox to Instagram/Facebook publisher in eclipsed_by_you_post.py."""
@@ -0,0 +1,215 @@
+"""Per-endpoint circuit breakers and the requests session that feeds them."""
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+import requests
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Sliding-window breaker: opens on a run of failures or a high failure rate, then lets one probe through."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    WINDOW_SIZE = 20
+    WINDOW_SECONDS = 600
+    MIN_CALLS = 4
+    FAILURE_RATE = 0.5
+    CONSECUTIVE_FAILURES = 3
+    SLOW_CALL_SECONDS = 20.0
+    COOLDOWN_SECONDS = 900
+    # A trial call that never reports back (e.g. an exception outside requests) frees the slot after this
+    PROBE_TIMEOUT = 300
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probe_started = None
+        self.consecutive_failures = 0
+        self.events = deque(maxlen=self.WINDOW_SIZE)  # (timestamp, ok, latency)
+
+    def allow(self, now=None):
+        now = now or time.time()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.COOLDOWN_SECONDS:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self.probe_started is not None and now - self.probe_started < self.PROBE_TIMEOUT:
+                return False
+            self.probe_started = now
+        return True
+
+    def record(self, ok, latency, now=None, slow_after=SLOW_CALL_SECONDS):
+        now = now or time.time()
+        failed = not ok or (slow_after is not None and latency > slow_after)
+        if self.events and now - self.events[-1][0] > self.WINDOW_SECONDS:
+            self.consecutive_failures = 0
+        self.events.append((now, not failed, latency))
+        if self.state == self.HALF_OPEN:
+            # The trial call decides whether the endpoint has recovered
+            self.probe_started = None
+            if failed:
+                self._open(now)
+            else:
+                self.state = self.CLOSED
+                self.consecutive_failures = 0
+            return
+        self.consecutive_failures = self.consecutive_failures + 1 if failed else 0
+        recent = [e for e in self.events if now - e[0] <= self.WINDOW_SECONDS]
+        failures = sum(1 for e in recent if not e[1])
+        if self.consecutive_failures >= self.CONSECUTIVE_FAILURES or (
+                len(recent) >= self.MIN_CALLS and failures / len(recent) >= self.FAILURE_RATE):
+            self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+
+    def is_open(self, now=None):
+        now = now or time.time()
+        return self.state == self.OPEN and now - self.opened_at < self.COOLDOWN_SECONDS
+
+    def stats(self):
+        if not self.events:
+            return {"calls": 0, "error_rate": 0.0, "mean_latency": None}
+        return {
+            "calls": len(self.events),
+            "error_rate": sum(1 for e in self.events if not e[1]) / len(self.events),
+            "mean_latency": sum(e[2] for e in self.events) / len(self.events),
+        }
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "opened_at": self.opened_at,
+            "events": list(self.events),
+        }
+
+    @classmethod
+    def from_dict(cls, name, data):
+        breaker = cls(name)
+        breaker.state = data.get("state", cls.CLOSED)
+        breaker.opened_at = data.get("opened_at")
+        breaker.events.extend(tuple(e) for e in data.get("events", []))
+        return breaker
+
+
+class CircuitBreakerRegistry:
+    """Breakers for Meta, Dropbox and Telegram, persisted between runs so a degraded service is skipped quickly."""
+
+    ENDPOINTS = (
+        ("facebook.com", "meta"),
+        ("dropboxusercontent.com", "dropbox"),
+        ("dropboxapi.com", "dropbox"),
+        ("dropbox.com", "dropbox"),
+        ("telegram.org", "telegram"),
+    )
+    # Slow-call threshold per endpoint. Transfers (rupload chunks, Dropbox content, Meta pulling
+    # a file_url) take as long as the file needs, so for them only errors count.
+    SLOW_CALL_SECONDS = {"meta": 30.0, "dropbox": 30.0, "telegram": 15.0}
+    TRANSFER_HOSTS = ("rupload.facebook.com", "content.dropboxapi.com", "dropboxusercontent.com")
+    TRANSFER_PATHS = re.compile(r"/(videos|video_reels|video-upload)(/|$)")
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.breakers = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    for name, data in json.load(f).items():
+                        self.breakers[name] = CircuitBreaker.from_dict(name, data)
+            except (OSError, ValueError):
+                self.breakers = {}
+
+    def endpoint_for(self, url):
+        host = urlparse(url).hostname or ""
+        for suffix, name in self.ENDPOINTS:
+            if host == suffix or host.endswith("." + suffix):
+                return name
+        return None
+
+    def get(self, name):
+        with self._lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name)
+            return self.breakers[name]
+
+    def check(self, name):
+        breaker = self.get(name)
+        with self._lock:
+            allowed = breaker.allow()
+        if not allowed:
+            raise CircuitOpenError(f"{name} circuit is open (cooling down after repeated failures)")
+
+    def slow_after(self, name, url=None):
+        """Seconds after which a call to url counts as failed, or None for transfers."""
+        if url:
+            parsed = urlparse(url)
+            host = parsed.hostname or ""
+            if any(host == h or host.endswith("." + h) for h in self.TRANSFER_HOSTS) or self.TRANSFER_PATHS.search(parsed.path):
+                return None
+        return self.SLOW_CALL_SECONDS.get(name, CircuitBreaker.SLOW_CALL_SECONDS)
+
+    def record(self, name, ok, latency, url=None):
+        breaker = self.get(name)
+        with self._lock:
+            breaker.record(ok, latency, slow_after=self.slow_after(name, url))
+
+    def is_open(self, name):
+        return self.get(name).is_open()
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            data = {name: breaker.to_dict() for name, breaker in self.breakers.items()}
+        with open(self.path, "w") as f:
+            json.dump(data, f)
+
+
+class CircuitBreakerSession(requests.Session):
+    """requests session that consults and feeds the circuit breakers on every call."""
+
+    def __init__(self, breakers, trace=None):
+        super().__init__()
+        self.breakers = breakers
+        self.trace = trace
+
+    def request(self, method, url, *args, **kwargs):
+        name = self.breakers.endpoint_for(url)
+        if name is None:
+            return super().request(method, url, *args, **kwargs)
+        self.breakers.check(name)
+        start = time.time()
+        try:
+            res = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            self.breakers.record(name, False, time.time() - start, url)
+            raise
+        self.breakers.record(name, res.status_code < 500 and res.status_code != 429, time.time() - start, url)
+        return res
+
+    def send(self, request, **kwargs):
+        if self.trace is None:
+            return super().send(request, **kwargs)
+        if self.trace.mode == "replay":
+            return self.trace.replay_http(request)
+        res = super().send(request, **kwargs)
+        self.trace.record_http(request, res, stream=kwargs.get("stream", False))
+        return res
@@ -0,0 +1,153 @@
+"""Awaitable HTTP, Graph API, Dropbox and Telegram clients."""
+import asyncio
+import time
+from collections import namedtuple
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class AsyncHttpClient:
+    """Awaitable HTTP client: httpx.AsyncClient when installed, otherwise the requests session in a worker thread."""
+
+    def __init__(self, session, timeout=60, breakers=None, use_httpx=True):
+        self.session = session
+        self.timeout = timeout
+        self.breakers = breakers
+        self.use_httpx = use_httpx and httpx is not None
+        self._client = None
+        # Called with every httpx response; the requests path uses session.hooks["response"]
+        self.response_hooks = []
+
+    async def request(self, method, url, **kwargs):
+        if not self.use_httpx:
+            # The session records its own circuit breaker outcomes
+            return await asyncio.to_thread(self.session.request, method, url, **kwargs)
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                follow_redirects=True,
+                event_hooks={"response": [self._run_response_hooks]}
+            )
+        name = self.breakers.endpoint_for(url) if self.breakers else None
+        if name is None:
+            return await self._client.request(method, url, **kwargs)
+        self.breakers.check(name)
+        start = time.time()
+        try:
+            res = await self._client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.breakers.record(name, False, time.time() - start, url)
+            raise
+        self.breakers.record(name, res.status_code < 500 and res.status_code != 429, time.time() - start, url)
+        return res
+
+    async def _run_response_hooks(self, response):
+        for hook in self.response_hooks:
+            hook(response)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def head(self, url, **kwargs):
+        if not self.use_httpx:
+            # requests does not follow redirects for HEAD unless asked; httpx is configured to
+            kwargs.setdefault("allow_redirects", True)
+        return await self.request("HEAD", url, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Light typed views of Graph API payloads; only the requested fields are kept
+GraphError = namedtuple("GraphError", ("message", "code", "subcode", "type"))
+IgMedia = namedtuple("IgMedia", ("id", "permalink", "media_type", "timestamp"))
+FbVideo = namedtuple("FbVideo", ("id", "permalink_url", "created_time", "length"))
+
+
+class GraphResult:
+    """A Graph API response parsed exactly once: status, data dict, GraphError and optional typed item."""
+
+    def __init__(self, response, item_type=None):
+        self.status = response.status_code
+        self.text = response.text
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        self.data = data if isinstance(data, dict) else {"data": data}
+        error = self.data.get("error")
+        self.error = GraphError(
+            error.get("message", "Unknown error"), error.get("code", "N/A"),
+            error.get("error_subcode", "N/A"), error.get("type", "N/A")
+        ) if isinstance(error, dict) else None
+        self.ok = self.status == 200 and self.error is None
+        self.item = item_type(*(self.data.get(f) for f in item_type._fields)) if item_type and self.ok else None
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    @property
+    def error_message(self):
+        return self.error.message if self.error else self.text
+
+
+class GraphClient:
+    """Graph API calls that request only the fields each operation declares."""
+
+    OPERATIONS = {
+        "ig_media": ("id,permalink,media_type,timestamp", IgMedia),
+        "fb_video": ("id,permalink_url,created_time,length", FbVideo),
+        "reels_list": ("id,created_time", None),
+        "publishing_limit": ("quota_usage,config", None),
+        "container_status": ("status_code", None),
+        "resumable_container": ("video_status", None),
+        "ig_recent_media": ("id,caption,timestamp", None),
+        "fb_recent_videos": ("id,description,created_time", None),
+        "fb_recent_photos": ("id,name,created_time", None),
+        "fb_recent_posts": ("id,message,created_time", None),
+    }
+
+    def __init__(self, http):
+        self.http = http
+
+    async def get(self, url, operation, access_token, **params):
+        fields, item_type = self.OPERATIONS[operation]
+        params.update(fields=fields, access_token=access_token)
+        return GraphResult(await self.http.get(url, params=params), item_type)
+
+    async def post(self, url, **kwargs):
+        return GraphResult(await self.http.post(url, **kwargs))
+
+
+class AsyncDropboxAdapter:
+    """Awaitable view of a Dropbox client; the blocking SDK calls run in worker threads."""
+
+    def __init__(self, dbx):
+        self.dbx = dbx
+
+    def __getattr__(self, name):
+        attr = getattr(self.dbx, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(attr, *args, **kwargs)
+        return call
+
+
+class AsyncTelegramAdapter:
+    """Awaitable view of the Telegram bot; sends run in worker threads."""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def send_message(self, chat_id, text):
+        return await asyncio.to_thread(self.bot.send_message, chat_id=chat_id, text=text)
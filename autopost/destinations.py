@@ -0,0 +1,431 @@
+"""Publish destinations: Instagram and Facebook Pages."""
+import abc
+import asyncio
+import json
+import logging
+import time
+from collections import namedtuple
+
+from .clients import GraphError
+from .guard import AmbiguousPublishError, PublishGuard
+from .history import _current_record
+from .media import CarouselGroup
+from .selection import FileSelector
+
+
+DestinationResult = namedtuple("DestinationResult", ("destination", "platform", "success", "media_id", "error"))
+
+
+class PostOutcome(namedtuple("PostOutcome", ("name", "media_type", "results"))):
+    """Result of publishing one file or carousel; the first (primary) destination decides success."""
+
+    __slots__ = ()
+
+    @property
+    def success(self):
+        return bool(self.results) and self.results[0].success
+
+    def result(self, destination):
+        return next((r for r in self.results if r.destination == destination), None)
+
+
+# Everything the destinations of one post share, fetched once: links, Page token and captions
+PublishJob = namedtuple("PublishJob", ("unit", "dbx", "media_type", "files", "links", "caption", "description", "page_token", "remaining", "phases"))
+
+
+def media_type_of(unit):
+    if isinstance(unit, CarouselGroup):
+        return "CAROUSEL"
+    return FileSelector.media_type(unit)
+
+
+class Destination(abc.ABC):
+    """A place a post is published to; run() drives prepare, upload, wait, publish and verify."""
+
+    kind = None
+    platform = None
+    label = None
+
+    def __init__(self, uploader, target=None):
+        self.app = uploader
+        self.target = target
+        self.name = f"{self.kind}:{target}" if target else self.kind
+
+    async def prepare(self, job, record):
+        return {}
+
+    async def upload(self, job, state, record):
+        return True
+
+    async def wait(self, job, state, record):
+        return True
+
+    @abc.abstractmethod
+    async def publish(self, job, state, record):
+        """Publish the post and return its media ID (None on failure)."""
+
+    async def verify(self, job, state, media_id, record):
+        return True
+
+    async def guarded(self, job, operation, send, lookup):
+        """Publish through the app's PublishGuard under this post's operation key."""
+        return await self.app.guard.call(self.app.guard.key(job.unit, self.name), self.name, operation, send, lookup)
+
+    async def run(self, job):
+        app = self.app
+        record = app.history.begin(app.run_id, app.account_key, self.platform, job.unit, job.media_type)
+        for phase, seconds in job.phases:
+            record.add_phase(phase, seconds)
+        token = _current_record.set(record)
+        media_id = None
+        try:
+            media_id = app.guard.completed(app.guard.key(job.unit, self.name))
+            if media_id:
+                record.update(upload_mode="already_published")
+                await app.send_message_async(f"⏭️ {job.unit.name} is already on {self.label} (media ID {media_id}); not posting it again", level=logging.WARNING)
+            else:
+                state = await self.prepare(job, record)
+                if state is not None and await self.upload(job, state, record) and await self.wait(job, state, record):
+                    media_id = await self.publish(job, state, record)
+                if media_id:
+                    await self.verify(job, state, media_id, record)
+            if media_id:
+                record.update(media_id=media_id)
+        except Exception as e:
+            await app.send_message_async(f"❌ {self.label} exception for {job.unit.name}: {e}", level=logging.ERROR)
+        finally:
+            _current_record.reset(token)
+            record.finish("success" if media_id else "failed")
+        error = None if media_id or not record.errors else record.errors[-1]
+        return DestinationResult(self.name, self.platform, bool(media_id), media_id, error)
+
+
+class InstagramDestination(Destination):
+    """Instagram Reels, images and carousels through the container/media_publish flow."""
+
+    kind = "instagram"
+    platform = "instagram"
+    label = "Instagram"
+
+    async def prepare(self, job, record):
+        if not job.page_token:
+            return None
+        if job.media_type == "CAROUSEL":
+            record.update(upload_mode="carousel")
+            return {}
+        await self.app.record_media_metadata(record, job.dbx, job.files[0])
+        upload_mode = "hosted"
+        if job.media_type == "REELS":
+            upload_mode = await asyncio.to_thread(self.app.choose_instagram_upload_mode, job.files[0], job.links[0])
+        return {"upload_mode": upload_mode}
+
+    async def upload(self, job, state, record):
+        app = self.app
+        if job.media_type == "CAROUSEL":
+            app.log_console_only(f"🔄 Creating {len(job.files)} carousel item containers...", level=logging.INFO)
+            with record.phase("container"):
+                child_ids = await asyncio.gather(*(
+                    app.create_carousel_item_container(file, link, job.page_token) for file, link in zip(job.files, job.links)
+                ))
+            if not all(child_ids):
+                await app.send_message_async(f"❌ Could not create all carousel items for: {job.unit.name}", level=logging.ERROR)
+                return False
+            state["children"] = child_ids
+            return True
+
+        app.log_console_only("🔄 Step 2: Sending media creation request to Instagram API...", level=logging.INFO)
+        creation_id = None
+        with record.phase("container"):
+            if state["upload_mode"] == "resumable":
+                creation_id = await app.create_instagram_resumable_container(job.files[0], job.links[0], job.caption, job.page_token)
+                if not creation_id:
+                    await app.send_message_async(f"⚠️ Resumable upload failed for {job.unit.name}, falling back to hosted URL", level=logging.WARNING)
+                    state["upload_mode"] = "hosted"
+            if not creation_id:
+                creation_id = await app.create_instagram_hosted_container(job.unit.name, job.media_type, job.links[0], job.caption, job.page_token)
+        record.update(upload_mode=state["upload_mode"], container_id=creation_id)
+        if not creation_id:
+            return False
+        app.log_console_only(f"✅ Media creation successful! Creation ID: {creation_id}", level=logging.INFO)
+        state["creation_id"] = creation_id
+        return True
+
+    async def wait(self, job, state, record):
+        """Wait for processing. Carousels assemble their parent container once the children are done."""
+        app = self.app
+        if job.media_type == "REELS":
+            with record.phase("processing"):
+                return await app.wait_for_instagram_container(state["creation_id"], job.page_token, job.unit.name)
+        if job.media_type != "CAROUSEL":
+            return True
+
+        with record.phase("processing"):
+            if not await app.wait_for_instagram_containers(state["children"], job.page_token, job.unit.name):
+                return False
+        with record.phase("container"):
+            res = await app.graph.post(f"{app.INSTAGRAM_API_BASE}/{app.ig_id}/media", data={
+                "media_type": "CAROUSEL",
+                "children": ",".join(state["children"]),
+                "caption": job.caption,
+                "access_token": job.page_token
+            })
+        creation_id = res.get("id") if res.ok else None
+        record.update(container_id=creation_id)
+        if not creation_id:
+            await app.send_message_async(f"❌ Instagram carousel container failed: {job.unit.name}\n📸 Status: {res.status}\n📸 Response: {res.text}", level=logging.ERROR)
+            return False
+        state["creation_id"] = creation_id
+        return await app.wait_for_instagram_containers([creation_id], job.page_token, job.unit.name)
+
+    async def publish(self, job, state, record):
+        app = self.app
+        publish_url = f"{app.INSTAGRAM_API_BASE}/{app.ig_id}/media_publish"
+        app.log_console_only(f"📤 Publishing to Instagram: {publish_url}", level=logging.INFO)
+
+        async def send():
+            publish_start = time.time()
+            with record.phase("publish"):
+                res = await app.graph.post(publish_url, data={"creation_id": state["creation_id"], "access_token": job.page_token})
+            app.log_console_only(f"⏱️ Publish request completed in {time.time() - publish_start:.2f} seconds (status {res.status})", level=logging.INFO)
+            if not res.ok:
+                error = res.error or GraphError(res.text, "N/A", "N/A", "N/A")
+                if PublishGuard.is_ambiguous(res.status, error.code):
+                    raise AmbiguousPublishError(f"media_publish returned {res.status}: {error.message}")
+                await app.send_message_async(f"❌ Instagram publish failed: {job.unit.name}\n📸 Error: {error.message}\n📸 Code: {error.code}\n📸 Status: {res.status}", level=logging.ERROR)
+                return None
+            if not res.get("id"):
+                await app.send_message_async("⚠️ Instagram publish succeeded but no media ID returned", level=logging.WARNING)
+            return res.get("id")
+
+        media_id = await self.guarded(job, "media_publish", send, lambda since: self.find_published(job, since))
+        if not media_id:
+            return None
+        if job.media_type == "CAROUSEL":
+            await app.send_message_async(f"✅ Instagram carousel published successfully!\n📸 Media ID: {media_id}\n📸 Items: {len(job.files)}")
+        else:
+            await app.send_message_async(f"✅ Instagram post published successfully!\n📸 Media ID: {media_id}\n📸 Account ID: {app.ig_id}\n📦 Files left: {job.remaining - 1}")
+        return media_id
+
+    async def find_published(self, job, since):
+        app = self.app
+        res = await app.graph.get(f"{app.INSTAGRAM_API_BASE}/{app.ig_id}/media", "ig_recent_media", job.page_token, limit=app.guard.LOOKUP_LIMIT)
+        if not res.ok:
+            raise RuntimeError(res.error_message)
+        return app.guard.match(res.get("data", []), job.caption, since, "caption", "timestamp")
+
+    async def verify(self, job, state, media_id, record):
+        # Verify with the published media_id; the creation_id is invalid after publish
+        return await self.app.verify_instagram_post_by_media_id_async(media_id, job.page_token, record=record)
+
+
+class FacebookPageDestination(Destination):
+    """A Facebook Page (FB_PAGE_ID, or 'facebook:<page id>'): Reels, videos, photos and multi-photo posts."""
+
+    kind = "facebook"
+    platform = "facebook"
+    IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp')
+
+    @property
+    def label(self):
+        return f"Facebook Page {self.target}" if self.target else "Facebook Page"
+
+    async def prepare(self, job, record):
+        app = self.app
+        page_id = self.target or app.fb_page_id
+        if not page_id:
+            await app.send_message_async("⚠️ Facebook Page ID not configured, skipping Facebook post", level=logging.WARNING)
+            return None
+        page_token = job.page_token if page_id == app.fb_page_id else await asyncio.to_thread(app.get_page_access_token, page_id)
+        if not page_token:
+            await app.send_message_async(f"❌ Could not retrieve the Page access token for {page_id}. Aborting Facebook upload.", level=logging.ERROR)
+            return None
+        state = {"page_id": page_id, "page_token": page_token}
+
+        if job.media_type == "CAROUSEL":
+            photos = [(f, link) for f, link in zip(job.files, job.links) if f.name.lower().endswith(self.IMAGE_EXTS)]
+            if len(photos) < len(job.files):
+                app.log_console_only(f"⚠️ Facebook multi-photo posts only take photos; skipping {len(job.files) - len(photos)} video(s)", level=logging.WARNING)
+            if not photos:
+                return None
+            state.update(mode="photo_set", photos=photos)
+        elif job.files[0].name.lower().endswith(self.IMAGE_EXTS):
+            app.log_console_only("🖼️ Detected image file. Uploading as Facebook photo.", level=logging.INFO)
+            await app.send_message_async(f"\n📦 File: {job.unit.name}\n🖼️ Will upload as: Facebook Photo", level=logging.INFO)
+            # Check the Dropbox link is accessible (headers only, the image itself is not fetched)
+            try:
+                status = await app.probe_url_async(job.links[0])
+                if status in (200, 206):
+                    app.log_console_only(f"✅ Dropbox link is accessible (status {status})", level=logging.INFO)
+                else:
+                    app.log_console_only(f"❌ Dropbox link returned status {status}", level=logging.ERROR)
+            except Exception as e:
+                app.log_console_only(f"❌ Exception checking Dropbox link: {e}", level=logging.ERROR)
+            state["mode"] = "photo"
+        else:
+            state["mode"] = "reel" if await self.is_reel(job, record) else "video"
+        record.update(upload_mode=state["mode"])
+        return state
+
+    async def is_reel(self, job, record):
+        """Only strict 9:16 portrait video (e.g. 1080x1920, 720x1280) goes out as a Facebook Reel."""
+        app = self.app
+        width, height, duration = await asyncio.to_thread(app.get_dropbox_video_metadata, job.dbx, job.files[0])
+        aspect_ratio = width / height if width and height else None
+        record.update(width=width, height=height, duration=duration, aspect_ratio=aspect_ratio)
+        decision_msg = f"\n📦 File: {job.unit.name}\n📏 Width: {width}\n📏 Height: {height}\n⏱️ Duration: {duration}s\n📐 Aspect Ratio: {f'{aspect_ratio:.4f}' if aspect_ratio else 'N/A'}"
+        if width is None or height is None or duration is None or aspect_ratio is None:
+            app.log_console_only("Could not get Dropbox video metadata, defaulting to regular video.", level=logging.WARNING)
+            as_reel = False
+            decision_msg += "\n🚀 Will upload as: Regular Facebook Video (metadata unavailable)"
+        elif height >= 960 and width >= 540 and abs(aspect_ratio - 0.5625) < 0.01:
+            as_reel = True
+            decision_msg += "\n🚀 Will upload as: Facebook Reel (strict 9:16 portrait)"
+        else:
+            as_reel = False
+            decision_msg += f"\n🚀 Will upload as: Regular Facebook Video (aspect ratio: {aspect_ratio:.4f})"
+        await app.send_message_async(decision_msg, level=logging.INFO)
+        return as_reel
+
+    def reels_url(self, state):
+        return f"https://graph.facebook.com/v23.0/{state['page_id']}/video_reels"
+
+    async def upload(self, job, state, record):
+        """Reels go through an upload session and photo sets are uploaded unpublished; the rest upload at publish."""
+        app = self.app
+        if state["mode"] == "reel":
+            with record.phase("upload_start"):
+                start_res = await app.graph.post(self.reels_url(state), data={"upload_phase": "start", "access_token": state["page_token"]})
+            if not start_res.ok:
+                await app.send_message_async(f"❌ Failed to start Facebook Reels upload session: {start_res.text}", level=logging.ERROR)
+                return False
+            video_id = start_res.get("video_id")
+            upload_url = start_res.get("upload_url")
+            if not video_id or not upload_url:
+                await app.send_message_async(f"❌ No video_id or upload_url returned: {start_res.text}", level=logging.ERROR)
+                return False
+            # Meta pulls the file from the Dropbox link itself
+            with record.phase("upload"):
+                upload_res = await app.http.post(upload_url, headers={"Authorization": f"OAuth {state['page_token']}", "file_url": job.links[0]})
+            if upload_res.status_code != 200:
+                await app.send_message_async(f"❌ Facebook Reels video upload (hosted file) failed: {upload_res.text}", level=logging.ERROR)
+                return False
+            state["video_id"] = video_id
+            record.update(container_id=video_id)
+        elif state["mode"] == "photo_set":
+            async def upload_unpublished(file, link):
+                res = await app.graph.post(f"https://graph.facebook.com/{state['page_id']}/photos", data={
+                    "url": link,
+                    "published": "false",
+                    "access_token": state["page_token"]
+                })
+                if not res.ok:
+                    app.log_console_only(f"❌ Facebook photo upload failed for {file.name}: {res.error_message}", level=logging.ERROR)
+                    return None
+                return res.get("id")
+
+            with record.phase("upload"):
+                photo_ids = await asyncio.gather(*(upload_unpublished(f, link) for f, link in state["photos"]))
+            if not all(photo_ids):
+                await app.send_message_async(f"❌ Facebook multi-photo upload failed for: {job.unit.name}", level=logging.ERROR)
+                return False
+            state["photo_ids"] = photo_ids
+        return True
+
+    async def publish(self, job, state, record):
+        app = self.app
+        mode, page_id, page_token = state["mode"], state["page_id"], state["page_token"]
+        if mode == "reel":
+            post_url = self.reels_url(state)
+            data = {
+                "upload_phase": "finish",
+                "access_token": page_token,
+                "video_id": state["video_id"],
+                "description": job.caption,
+                "video_state": "PUBLISHED",
+                "share_to_feed": "true"
+            }
+        elif mode == "photo_set":
+            post_url = f"https://graph.facebook.com/{page_id}/feed"
+            data = {"message": job.caption, "access_token": page_token}
+            for i, photo_id in enumerate(state["photo_ids"]):
+                data[f"attached_media[{i}]"] = json.dumps({"media_fbid": photo_id})
+        elif mode == "photo":
+            post_url = f"https://graph.facebook.com/{page_id}/photos"
+            data = {"access_token": page_token, "url": job.links[0], "caption": job.caption}
+        else:
+            post_url = f"https://graph.facebook.com/{page_id}/videos"
+            data = {"access_token": page_token, "file_url": job.links[0], "description": job.caption}
+
+        async def send():
+            app.log_console_only(f"🔄 Sending {mode} publish request to Facebook API: {post_url}", level=logging.INFO)
+            start_time = time.time()
+            with record.phase("publish"):
+                res = await app.graph.post(post_url, data=data)
+            app.log_console_only(f"⏱️ Facebook API request completed in {time.time() - start_time:.2f} seconds", level=logging.INFO)
+            app.log_console_only(f"📊 Facebook response status: {res.status}", level=logging.INFO)
+            app.log_console_only(f"📄 Facebook response: {res.text}", level=logging.INFO)
+            if res.ok:
+                return res.get("id", state["video_id"] if mode == "reel" else "Unknown")
+            error = res.error or GraphError(res.text, "N/A", "N/A", "N/A")
+            if PublishGuard.is_ambiguous(res.status, error.code):
+                raise AmbiguousPublishError(f"Facebook {mode} publish returned {res.status}: {error.message}")
+            if mode == "reel":
+                await app.send_message_async(f"❌ Facebook Reels publish failed: {res.text}", level=logging.ERROR)
+            elif mode == "photo_set":
+                await app.send_message_async(f"❌ Facebook multi-photo post failed: {res.text}", level=logging.ERROR)
+            else:
+                await app.send_message_async(
+                    f"❌ Facebook Page {mode} upload failed:\n📘 Error: {error.message}\n📘 Code: {error.code}\n"
+                    f"📘 Subcode: {error.subcode}\n📘 Type: {error.type}\n📘 Status: {res.status}",
+                    level=logging.ERROR
+                )
+            return None
+
+        media_id = await self.guarded(job, f"{mode}_publish", send, lambda since: self.find_published(job, state, since))
+        if not media_id:
+            return None
+        if mode == "reel":
+            await app.send_message_async(f"✅ Facebook Reel published successfully!\n📘 Video ID: {media_id}\n📘 Page ID: {page_id}")
+        elif mode == "photo_set":
+            await app.send_message_async(f"✅ Facebook multi-photo post published successfully!\n🖼️ Post ID: {media_id}\n🖼️ Photos: {len(state['photo_ids'])}")
+        elif mode == "photo":
+            await app.send_message_async(f"✅ Facebook Page photo published successfully!\n🖼️ Photo ID: {media_id}\n📘 Page ID: {page_id}")
+        else:
+            await app.send_message_async(f"✅ Facebook Page post published successfully!\n📘 Video ID: {media_id}\n📘 Page ID: {page_id}")
+        return media_id
+
+    async def find_published(self, job, state, since):
+        """Recent posts of the kind this mode publishes: Reels, videos, uploaded photos or feed posts."""
+        app = self.app
+        page_url = f"https://graph.facebook.com/{state['page_id']}"
+        url, operation, text_field, params = {
+            "reel": (self.reels_url(state), "fb_recent_videos", "description", {}),
+            "video": (f"{page_url}/videos", "fb_recent_videos", "description", {}),
+            "photo": (f"{page_url}/photos", "fb_recent_photos", "name", {"type": "uploaded"}),
+            "photo_set": (f"{page_url}/feed", "fb_recent_posts", "message", {}),
+        }[state["mode"]]
+        res = await app.graph.get(url, operation, state["page_token"], limit=app.guard.LOOKUP_LIMIT, **params)
+        if not res.ok:
+            raise RuntimeError(res.error_message)
+        return app.guard.match(res.get("data", []), job.caption, since, text_field)
+
+    async def verify(self, job, state, media_id, record):
+        app = self.app
+        if state["mode"] not in ("reel", "video"):
+            return True
+        verified = await app.verify_facebook_post_by_video_id_async(media_id, state["page_token"], record=record)
+        # Diagnostic listing of the Page's latest Reels (debug only)
+        if state["mode"] == "reel" and app.graph_debug:
+            try:
+                reels_res = await app.graph.get(self.reels_url(state), "reels_list", state["page_token"], limit=5)
+                app.log_console_only(f"📄 Latest Reels: {reels_res.get('data', reels_res.text)}", level=logging.INFO)
+            except Exception as e:
+                app.log_console_only(f"⚠️ Could not fetch Reels list: {e}", level=logging.WARNING)
+        return verified
+
+
+# PUBLISH_DESTINATIONS entries are '<kind>' or '<kind>:<target>'
+DESTINATIONS = {
+    InstagramDestination.kind: InstagramDestination,
+    FacebookPageDestination.kind: FacebookPageDestination,
+}
@@ -0,0 +1,134 @@
+"""At-most-once publish calls."""
+import asyncio
+import hashlib
+import logging
+import weakref
+from datetime import datetime, timedelta
+
+import requests
+from pytz import utc
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .media import CarouselGroup
+from .tracing import TraceMissError
+
+
+class AmbiguousPublishError(Exception):
+    """A publish call answered in a way that leaves open whether the post went out."""
+
+
+class PublishGuard:
+    """Runs each non-idempotent publish call at most once per post and destination."""
+
+    RETRIES = 2
+    KEY_TTL = 7 * 86400
+    # Graph timestamps have second resolution and Meta's clock is not ours
+    CLOCK_SKEW = 120
+    LOOKUP_LIMIT = 25
+    TRANSIENT_CODES = (1, 2)
+    AMBIGUOUS_ERRORS = (AmbiguousPublishError, requests.Timeout, requests.ConnectionError) + (
+        (httpx.TimeoutException, httpx.NetworkError) if httpx is not None else ()
+    )
+
+    def __init__(self, history, account, notify, retries=RETRIES):
+        self.history = history
+        self.account = account
+        self.notify = notify
+        self.retries = retries
+        self.adopted = 0
+        # asyncio locks belong to one event loop, and each _run_sync call starts a new one
+        self._locks = weakref.WeakKeyDictionary()
+
+    def lock(self, destination):
+        # Same-day posts share a caption, so a listed post is only attributable while one
+        # publish call or lookup per destination is in flight
+        locks = self._locks.setdefault(asyncio.get_running_loop(), {})
+        return locks.setdefault(destination, asyncio.Lock())
+
+    def key(self, unit, destination):
+        if isinstance(unit, CarouselGroup):
+            members = sorted(f.content_hash or f.path_lower for f in unit.files)
+            content = hashlib.sha256("\n".join(members).encode("utf-8")).hexdigest()
+        else:
+            content = unit.content_hash or unit.path_lower
+        return f"{self.account}:{destination}:{content}"
+
+    @classmethod
+    def is_ambiguous(cls, status, error_code=None):
+        return status >= 500 or error_code in cls.TRANSIENT_CODES
+
+    def completed(self, key):
+        """Media ID of a post already published under key within KEY_TTL, else None."""
+        op = self.history.operation(key)
+        if not op or op["state"] != "done" or not op["media_id"]:
+            return None
+        if datetime.fromisoformat(op["updated_at"]) < datetime.now(utc) - timedelta(seconds=self.KEY_TTL):
+            return None
+        return op["media_id"]
+
+    def match(self, items, caption, since, text_field, time_field="created_time"):
+        """ID of the one unclaimed listed post with this caption made since; AmbiguousPublishError if several qualify."""
+        candidates = []
+        for item in items:
+            try:
+                posted = datetime.strptime(item.get(time_field) or "", "%Y-%m-%dT%H:%M:%S%z")
+            except ValueError:
+                continue
+            if posted < since or (item.get(text_field) or "").strip() != (caption or "").strip():
+                continue
+            if item.get("id") and not self.history.media_claimed(item["id"]):
+                candidates.append(item["id"])
+        if len(candidates) > 1:
+            raise AmbiguousPublishError(f"{len(candidates)} unclaimed posts match ({', '.join(candidates)})")
+        return candidates[0] if candidates else None
+
+    async def find(self, key, lookup, started_at):
+        """Look for the post of a pending key. Returns (media_id, looked): looked is False if the lookup failed."""
+        since = datetime.fromisoformat(started_at) - timedelta(seconds=self.CLOCK_SKEW)
+        try:
+            media_id = await lookup(since)
+        except TraceMissError:
+            raise
+        except Exception as e:
+            await self.notify(f"⚠️ Could not check recent posts for {key}: {e}", level=logging.WARNING)
+            return None, False
+        if media_id:
+            self.history.finish_operation(key, "done", media_id)
+            self.adopted += 1
+            await self.notify(f"🔁 Found the post for {key} (media ID {media_id}) after an unanswered publish; not sending it again", level=logging.WARNING)
+        return media_id, True
+
+    async def call(self, key, destination, operation, send, lookup):
+        """Run send() under key and return the media ID, or None when the post failed."""
+        async with self.lock(destination):
+            return await self._call(key, destination, operation, send, lookup)
+
+    async def _call(self, key, destination, operation, send, lookup):
+        op = self.history.operation(key)
+        if op and op["state"] == "pending":
+            # An earlier attempt, in this run or a previous one, never got an answer
+            media_id, looked = await self.find(key, lookup, op["started_at"])
+            if media_id:
+                return media_id
+            if not looked:
+                raise AmbiguousPublishError(f"{operation} for {key} may already have been published")
+        for attempt in range(self.retries + 1):
+            op = self.history.begin_operation(key, self.account, destination, operation)
+            try:
+                media_id = await send()
+            except self.AMBIGUOUS_ERRORS as e:
+                error = e
+            else:
+                self.history.finish_operation(key, "done" if media_id else "failed", media_id)
+                return media_id
+            logging.getLogger().warning(f"⚠️ {operation} for {key}: no clear answer (attempt {attempt + 1}): {error}")
+            media_id, looked = await self.find(key, lookup, op["started_at"])
+            if media_id:
+                return media_id
+            if not looked:
+                break
+        raise error
@@ -0,0 +1,270 @@
+"""SQLite store of publishes, phase timings and publish operations."""
+import contextlib
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pytz import utc
+
+from .profiling import profile_phase
+
+
+# Publish record currently collecting errors for this task/thread (see send_message)
+_current_record = contextvars.ContextVar("current_publish_record", default=None)
+
+
+class PublishRecord:
+    """One row in the publish history: collects phase timings and the outcome of a single platform publish."""
+
+    def __init__(self, store, row_id):
+        self.store = store
+        self.row_id = row_id
+        self.started = time.time()
+        self.errors = []
+
+    @contextlib.contextmanager
+    def phase(self, name, attempts=None):
+        phase_start = time.time()
+        try:
+            with profile_phase(f"publish.{name}"):
+                yield
+        finally:
+            self.add_phase(name, time.time() - phase_start, attempts)
+
+    def add_phase(self, name, seconds, attempts=None):
+        self.store.add_phase(self.row_id, name, seconds, attempts)
+
+    def update(self, **fields):
+        self.store.update(self.row_id, **fields)
+
+    def finish(self, outcome, **fields):
+        error = "\n".join(self.errors) if self.errors and outcome != "success" else None
+        self.store.update(
+            self.row_id,
+            outcome=outcome,
+            error=error,
+            total_seconds=time.time() - self.started,
+            **fields
+        )
+
+
+class PublishHistoryStore:
+    """Local SQLite history of publish attempts with per-phase latencies."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS publishes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT,
+            started_at TEXT NOT NULL,
+            day TEXT NOT NULL,
+            account TEXT,
+            platform TEXT NOT NULL,
+            file_name TEXT,
+            file_path TEXT,
+            content_hash TEXT,
+            file_size INTEGER,
+            media_type TEXT,
+            width INTEGER,
+            height INTEGER,
+            duration REAL,
+            aspect_ratio REAL,
+            upload_mode TEXT,
+            container_id TEXT,
+            media_id TEXT,
+            permalink TEXT,
+            outcome TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            total_seconds REAL
+        );
+        CREATE TABLE IF NOT EXISTS phases (
+            publish_id INTEGER NOT NULL REFERENCES publishes(id),
+            phase TEXT NOT NULL,
+            seconds REAL NOT NULL,
+            attempts INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS operations (
+            key TEXT PRIMARY KEY,
+            account TEXT,
+            destination TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            media_id TEXT,
+            started_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_publishes_day ON publishes(day);
+        CREATE INDEX IF NOT EXISTS idx_publishes_account_day ON publishes(account, day);
+        CREATE INDEX IF NOT EXISTS idx_publishes_media_type_day ON publishes(media_type, day);
+        CREATE INDEX IF NOT EXISTS idx_phases_publish ON phases(publish_id);
+        CREATE INDEX IF NOT EXISTS idx_operations_media ON operations(media_id);
+    """
+    COLUMNS = (
+        "run_id", "account", "platform", "file_name", "file_path", "content_hash", "file_size",
+        "media_type", "width", "height", "duration", "aspect_ratio", "upload_mode", "container_id",
+        "media_id", "permalink", "outcome", "error", "total_seconds",
+    )
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self._lock, self.conn:
+            self.conn.executescript(self.SCHEMA)
+
+    def begin(self, run_id, account, platform, file, media_type, **fields):
+        now = datetime.now(utc)
+        row = {
+            "run_id": run_id,
+            "account": account,
+            "platform": platform,
+            "file_name": file.name,
+            "file_path": file.path_lower,
+            "content_hash": getattr(file, "content_hash", None),
+            "file_size": file.size,
+            "media_type": media_type,
+        }
+        row.update(fields)
+        columns = ", ".join(["started_at", "day"] + list(row))
+        placeholders = ", ".join("?" * (len(row) + 2))
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                f"INSERT INTO publishes ({columns}) VALUES ({placeholders})",
+                [now.isoformat(), now.strftime("%Y-%m-%d")] + list(row.values())
+            )
+        return PublishRecord(self, cursor.lastrowid)
+
+    def update(self, row_id, **fields):
+        fields = {k: v for k, v in fields.items() if k in self.COLUMNS}
+        if not fields:
+            return
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        with self._lock, self.conn:
+            self.conn.execute(f"UPDATE publishes SET {assignments} WHERE id = ?", list(fields.values()) + [row_id])
+
+    def add_phase(self, row_id, phase, seconds, attempts=None):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO phases (publish_id, phase, seconds, attempts) VALUES (?, ?, ?, ?)",
+                (row_id, phase, seconds, attempts)
+            )
+
+    def query(self, since=None, until=None, account=None, media_type=None, platform=None, limit=100):
+        """Return publish rows (newest first). since/until are YYYY-MM-DD day strings."""
+        clauses, params = [], []
+        for column, op, value in (("day", ">=", since), ("day", "<=", until), ("account", "=", account),
+                                  ("media_type", "=", media_type), ("platform", "=", platform)):
+            if value is not None:
+                clauses.append(f"{column} {op} ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT * FROM publishes {where} ORDER BY id DESC LIMIT ?", params + [limit]
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def phase_stats(self, phase, media_type=None, account=None, platform=None, since_days=30):
+        """Count, mean and p50/p95/p99 of a phase's latency over successful publishes in the last since_days."""
+        since = (datetime.now(utc) - timedelta(days=since_days)).strftime("%Y-%m-%d")
+        sql = ("SELECT ph.seconds FROM phases ph JOIN publishes p ON p.id = ph.publish_id "
+               "WHERE ph.phase = ? AND p.day >= ? AND p.outcome = 'success'")
+        params = [phase, since]
+        for column, value in (("media_type", media_type), ("account", account), ("platform", platform)):
+            if value is not None:
+                sql += f" AND p.{column} = ?"
+                params.append(value)
+        with self._lock:
+            values = sorted(r[0] for r in self.conn.execute(sql, params))
+        if not values:
+            return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None}
+        return {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": values[min(len(values) - 1, int(len(values) * 0.50))],
+            "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+            "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+        }
+
+    def media_type_stats(self, media_type, account=None, platform="instagram", since_days=60):
+        """Mean total publish time and mean file size for successful publishes of one media type."""
+        since = (datetime.now(utc) - timedelta(days=since_days)).strftime("%Y-%m-%d")
+        sql = ("SELECT COUNT(*), AVG(total_seconds), AVG(file_size) FROM publishes "
+               "WHERE media_type = ? AND platform = ? AND day >= ? AND outcome = 'success'")
+        params = [media_type, platform, since]
+        if account is not None:
+            sql += " AND account = ?"
+            params.append(account)
+        with self._lock:
+            count, mean_seconds, mean_size = self.conn.execute(sql, params).fetchone()
+        return {"count": count, "mean_seconds": mean_seconds, "mean_size": mean_size}
+
+    def count_since(self, since, account=None, platform=None, outcome=None, exclude_upload_mode=None):
+        """Number of publishes started at or after the datetime since."""
+        clauses, params = ["started_at >= ?"], [since.astimezone(utc).isoformat()]
+        for column, value in (("account", account), ("platform", platform), ("outcome", outcome)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if exclude_upload_mode is not None:
+            clauses.append("(upload_mode IS NULL OR upload_mode != ?)")
+            params.append(exclude_upload_mode)
+        with self._lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM publishes WHERE {' AND '.join(clauses)}", params).fetchone()[0]
+
+    def operation(self, key):
+        """The idempotency record for an operation key, or None."""
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM operations WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row else None
+
+    def begin_operation(self, key, account, destination, operation):
+        """Mark key pending before its call is sent. A retry keeps the first attempt's start time."""
+        now = datetime.now(utc).isoformat()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO operations (key, account, destination, operation, state, attempts, started_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'pending', 1, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "started_at = CASE WHEN state = 'pending' THEN started_at ELSE excluded.started_at END, "
+                "attempts = CASE WHEN state = 'pending' THEN attempts + 1 ELSE 1 END, "
+                "state = 'pending', operation = excluded.operation, media_id = NULL, updated_at = excluded.updated_at",
+                (key, account, destination, operation, now, now)
+            )
+        return self.operation(key)
+
+    def finish_operation(self, key, state, media_id=None):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE operations SET state = ?, media_id = ?, updated_at = ? WHERE key = ?",
+                (state, media_id, datetime.now(utc).isoformat(), key)
+            )
+
+    def media_claimed(self, media_id):
+        """Whether a finished operation already accounts for media_id."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT 1 FROM operations WHERE media_id = ? AND state = 'done' LIMIT 1", (media_id,)
+            ).fetchone() is not None
+
+    def summary(self, since_days=7):
+        """Outcome counts per day, account, platform and media type."""
+        since = (datetime.now(utc) - timedelta(days=since_days)).strftime("%Y-%m-%d")
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT day, account, platform, media_type, outcome, COUNT(*) AS n, AVG(total_seconds) AS avg_seconds "
+                "FROM publishes WHERE day >= ? GROUP BY day, account, platform, media_type, outcome ORDER BY day",
+                (since,)
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
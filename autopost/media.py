@@ -0,0 +1,294 @@
+"""Media probing, Reel normalisation, the media index and the compact file entries the queue holds."""
+import os
+import re
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+from datetime import datetime
+
+import dropbox
+from pytz import utc
+
+
+# Target spec for Reels; files outside it are normalised before upload when TRANSCODE_MODE=auto
+REEL_SPEC = {
+    "width": 1080,
+    "height": 1920,
+    "max_bitrate_kbps": 8000,
+    "codec": "h264",
+    "fps_range": (23.0, 60.0),
+}
+STANDARD_FPS = (23.976, 24, 25, 29.97, 30, 50, 59.94, 60)
+
+
+def mp4_moov_before_mdat(path):
+    """True if the moov atom precedes mdat (faststart), False if it trails it, None if undetermined."""
+    try:
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return None
+                size, box = struct.unpack(">I4s", header)
+                header_len = 8
+                if size == 1:
+                    size = struct.unpack(">Q", f.read(8))[0]
+                    header_len = 16
+                elif size == 0:
+                    return None
+                if box == b"moov":
+                    return True
+                if box == b"mdat":
+                    return False
+                f.seek(size - header_len, 1)
+    except (OSError, struct.error):
+        return None
+
+
+def probe_media(path):
+    """Size, fps, duration, codec, bitrate and moov position of a local video file."""
+    from moviepy.config import get_setting
+    from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+    infos = ffmpeg_parse_infos(path)
+    # ffmpeg -i without an output always exits non-zero; we only want the stream banner
+    banner = subprocess.run(
+        [get_setting("FFMPEG_BINARY"), "-hide_banner", "-i", path],
+        capture_output=True, text=True
+    ).stderr
+    codec = re.search(r"Video: (\w+)", banner)
+    bitrate = re.search(r"bitrate: (\d+) kb/s", banner)
+    width, height = infos.get("video_size") or (None, None)
+    if infos.get("video_rotation") in (90, 270) and width and height:
+        width, height = height, width
+    return {
+        "width": width,
+        "height": height,
+        "fps": infos.get("video_fps"),
+        "duration": infos.get("duration"),
+        "codec": codec.group(1) if codec else None,
+        "bitrate_kbps": int(bitrate.group(1)) if bitrate else None,
+        "faststart": mp4_moov_before_mdat(path),
+    }
+
+
+def plan_normalisation(info, spec=REEL_SPEC):
+    """Return (action, reasons): action is None (in spec), 'remux' (faststart only) or 'transcode'."""
+    reasons = []
+    if (info["width"], info["height"]) != (spec["width"], spec["height"]):
+        reasons.append(f"size {info['width']}x{info['height']}")
+    if info["codec"] != spec["codec"]:
+        reasons.append(f"codec {info['codec']}")
+    if info["bitrate_kbps"] and info["bitrate_kbps"] > spec["max_bitrate_kbps"]:
+        reasons.append(f"bitrate {info['bitrate_kbps']} kb/s")
+    fps = info["fps"] or 0
+    low, high = spec["fps_range"]
+    if not (low <= fps <= high) or min(abs(fps - s) for s in STANDARD_FPS) > 0.05:
+        reasons.append(f"fps {fps}")
+    if reasons:
+        if info["faststart"] is False:
+            reasons.append("moov at end")
+        return "transcode", reasons
+    if info["faststart"] is False:
+        return "remux", ["moov at end"]
+    return None, []
+
+
+def normalise_media(src, dst, spec=REEL_SPEC):
+    """Process-pool worker: probe src and, if it is outside the Reel spec, write a compliant copy to dst."""
+    from moviepy.config import get_setting
+    info = probe_media(src)
+    action, reasons = plan_normalisation(info, spec)
+    if action is None:
+        return {"action": "none", "reasons": [], "info": info, "output": None}
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    if action == "remux":
+        cmd = [ffmpeg, "-y", "-loglevel", "error", "-i", src, "-c", "copy", "-movflags", "+faststart", dst]
+    else:
+        width, height = spec["width"], spec["height"]
+        filters = (f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                   f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1")
+        if any(r.startswith("fps") for r in reasons):
+            filters += ",fps=30"
+        max_rate = spec["max_bitrate_kbps"]
+        cmd = [
+            ffmpeg, "-y", "-loglevel", "error", "-i", src,
+            "-vf", filters,
+            "-c:v", "libx264", "-profile:v", "high", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-b:v", f"{int(max_rate * 0.75)}k", "-maxrate", f"{max_rate}k", "-bufsize", f"{max_rate * 2}k",
+            "-c:a", "aac", "-b:a", "128k", "-ar", "48000",
+            "-movflags", "+faststart", dst
+        ]
+    subprocess.run(cmd, check=True, capture_output=True)
+    return {"action": action, "reasons": reasons, "info": info, "output": dst}
+
+
+def analyse_media_file(path):
+    """Process-pool worker for the bulk 'analyze' command: media metadata of one local file."""
+    if os.path.splitext(path)[1].lower() in (".mp4", ".mov"):
+        info = probe_media(path)
+        info["media_type"] = "REELS"
+        return info
+    from PIL import Image
+    with Image.open(path) as img:
+        width, height = img.size
+        codec = (img.format or "").lower() or None
+    return {
+        "width": width,
+        "height": height,
+        "fps": None,
+        "duration": None,
+        "codec": codec,
+        "bitrate_kbps": None,
+        "faststart": None,
+        "media_type": "IMAGE",
+    }
+
+
+class MediaIndex:
+    """Persistent media metadata per Dropbox content hash, filled by the 'analyze' command."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS media_index (
+            content_hash TEXT PRIMARY KEY,
+            path TEXT,
+            name TEXT,
+            size INTEGER,
+            media_type TEXT,
+            width INTEGER,
+            height INTEGER,
+            duration REAL,
+            fps REAL,
+            codec TEXT,
+            bitrate_kbps INTEGER,
+            faststart INTEGER,
+            aspect_ratio REAL,
+            error TEXT,
+            analysed_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_media_index_media_type ON media_index(media_type);
+    """
+    COLUMNS = (
+        "path", "name", "size", "media_type", "width", "height", "duration", "fps",
+        "codec", "bitrate_kbps", "faststart", "aspect_ratio", "error",
+    )
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self._lock, self.conn:
+            self.conn.executescript(self.SCHEMA)
+
+    def get(self, content_hash):
+        if not content_hash:
+            return None
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM media_index WHERE content_hash = ?", (content_hash,)).fetchone()
+        if not row:
+            return None
+        entry = dict(row)
+        if entry["faststart"] is not None:
+            entry["faststart"] = bool(entry["faststart"])
+        return entry
+
+    def known_hashes(self):
+        with self._lock:
+            return {r[0] for r in self.conn.execute("SELECT content_hash FROM media_index WHERE error IS NULL")}
+
+    def put(self, content_hash, **fields):
+        fields = {k: v for k, v in fields.items() if k in self.COLUMNS}
+        if fields.get("width") and fields.get("height"):
+            fields["aspect_ratio"] = fields["width"] / fields["height"]
+        columns = ["content_hash", "analysed_at"] + list(fields)
+        values = [content_hash, datetime.now(utc).isoformat()] + list(fields.values())
+        with self._lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO media_index ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                values
+            )
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def media_dimensions(metadata):
+    """(width, height, duration in seconds) from a Dropbox metadata's media_info; None where unknown."""
+    media_info = getattr(metadata, "media_info", None)
+    if not media_info:
+        return None, None, None
+    info = media_info.get_metadata()
+    dimensions = getattr(info, "dimensions", None)
+    width, height = (dimensions.width, dimensions.height) if dimensions is not None else (None, None)
+    duration = info.duration / 1000.0 if isinstance(info, dropbox.files.VideoMetadata) and info.duration is not None else None
+    return width, height, duration
+
+
+class FolderEntry:
+    """A postable Dropbox file with only the fields the queue needs, kept compact for long queues."""
+
+    __slots__ = ("name", "path_lower", "size", "content_hash", "modified", "ext", "media_type", "width", "height", "duration")
+
+    # Extensions that can be posted and the media type each one publishes as
+    MEDIA_TYPES = {".mp4": "REELS", ".mov": "REELS", ".jpg": "IMAGE", ".jpeg": "IMAGE", ".png": "IMAGE"}
+
+    def __init__(self, name, path_lower, size, content_hash=None, modified=0.0, width=None, height=None, duration=None):
+        self.name = name
+        self.path_lower = path_lower
+        self.size = size
+        self.content_hash = content_hash
+        self.modified = modified
+        self.ext = sys.intern(os.path.splitext(name)[1].lower())
+        self.media_type = self.MEDIA_TYPES.get(self.ext)
+        self.width = width
+        self.height = height
+        self.duration = duration
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        """Entry for a listed FileMetadata, or None for folders and files that cannot be posted."""
+        if getattr(metadata, "size", None) is None or os.path.splitext(metadata.name)[1].lower() not in cls.MEDIA_TYPES:
+            return None
+        modified = getattr(metadata, "client_modified", None) or getattr(metadata, "server_modified", None)
+        return cls(
+            metadata.name,
+            metadata.path_lower,
+            metadata.size,
+            getattr(metadata, "content_hash", None),
+            modified.timestamp() if modified else 0.0,
+            *media_dimensions(metadata)
+        )
+
+    def __repr__(self):
+        return f"FolderEntry({self.path_lower!r}, {self.size})"
+
+
+class NormalisedFile:
+    """Dropbox copy of a normalised video; keeps the original file name for captions and logs."""
+
+    def __init__(self, source, metadata):
+        self.source = source
+        self.name = source.name
+        self.path_lower = metadata.path_lower
+        self.size = metadata.size
+        self.content_hash = getattr(metadata, "content_hash", None)
+
+
+class CarouselGroup:
+    """Related Dropbox files posted together as one carousel."""
+
+    def __init__(self, name, files, folder_path=None):
+        self.name = name
+        self.files = files
+        self.folder_path = folder_path
+        self.path_lower = folder_path or files[0].path_lower
+        self.size = sum(f.size for f in files)
+        self.content_hash = None
+
+    def __repr__(self):
+        return f"CarouselGroup({self.name!r}, {len(self.files)} files)"
@@ -0,0 +1,272 @@
+"""Temporary link cache and the local directory that stands in for Dropbox."""
+import asyncio
+import hashlib
+import http.server
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote, unquote, urlparse
+
+import dropbox
+
+from .media import analyse_media_file
+
+
+class LinkCache:
+    """Dropbox temporary links per path, reused until shortly before they expire."""
+
+    TTL = 4 * 3600
+    REFRESH_MARGIN = 15 * 60
+    MAX_CONCURRENT = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._links = {}
+        self.created = 0
+        self.hits = 0
+
+    def get(self, client, path):
+        with self._lock:
+            cached = self._links.get(path)
+            if cached and cached[1] > time.time():
+                self.hits += 1
+                return cached[0]
+        link = client.files_get_temporary_link(path).link
+        with self._lock:
+            self._links[path] = (link, time.time() + self.TTL - self.REFRESH_MARGIN)
+            self.created += 1
+        return link
+
+    async def get_many(self, client, paths):
+        """Links for paths in order; missing ones are created concurrently, each path once."""
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT)
+
+        async def fetch(path):
+            async with semaphore:
+                return path, await asyncio.to_thread(self.get, client, path)
+
+        links = dict(await asyncio.gather(*(fetch(path) for path in dict.fromkeys(paths))))
+        return [links[path] for path in paths]
+
+    def discard(self, path):
+        with self._lock:
+            self._links.pop(path, None)
+
+
+def dropbox_content_hash(path, block_size=4 * 1024 * 1024):
+    """Dropbox content_hash of a local file: SHA-256 over the SHA-256 of each 4 MB block."""
+    digests = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digests.update(hashlib.sha256(block).digest())
+    return digests.hexdigest()
+
+
+class LocalMediaSource:
+    """Local directory standing in for the Dropbox client, served over HTTP for offline runs and load tests."""
+
+    COPY_CHUNK = 1024 * 1024
+
+    def __init__(self, root, host="127.0.0.1", port=0, public_url=None):
+        self.root = os.path.abspath(root)
+        self.host = host
+        self.port = port
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.server = None
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._sessions = {}
+
+    @property
+    def base_url(self):
+        return self.public_url or f"http://127.0.0.1:{self.port}"
+
+    def local_path(self, path):
+        """Filesystem path for a Dropbox-style path, or None if it would leave root."""
+        parts = [p for p in path.split("/") if p]
+        if any(p in (".", "..") for p in parts):
+            return None
+        current = self.root
+        for part in parts:
+            candidate = os.path.join(current, part)
+            if not os.path.exists(candidate) and os.path.isdir(current):
+                candidate = next((os.path.join(current, n) for n in os.listdir(current) if n.lower() == part.lower()), candidate)
+            current = candidate
+        return current
+
+    def _require(self, path):
+        local = self.local_path(path)
+        if local is None or not os.path.exists(local):
+            raise FileNotFoundError(f"{path} not found under {self.root}")
+        return local
+
+    def content_hash(self, local, stat):
+        key = (local, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if key in self._hashes:
+                return self._hashes[key]
+        digest = dropbox_content_hash(local)
+        with self._lock:
+            self._hashes[key] = digest
+        return digest
+
+    def metadata(self, local, include_media_info=False):
+        display = "/" + os.path.relpath(local, self.root).replace(os.sep, "/")
+        entry_id = "id:" + hashlib.sha1(display.lower().encode("utf-8")).hexdigest()
+        name = os.path.basename(local)
+        if os.path.isdir(local):
+            return dropbox.files.FolderMetadata(name=name, id=entry_id, path_lower=display.lower(), path_display=display)
+        stat = os.stat(local)
+        modified = datetime.utcfromtimestamp(int(stat.st_mtime))
+        media_info = None
+        if include_media_info and name.lower().endswith((".mp4", ".mov", ".jpg", ".jpeg", ".png")):
+            try:
+                info = analyse_media_file(local)
+                dimensions = dropbox.files.Dimensions(height=info["height"], width=info["width"]) if info["width"] else None
+                if info["media_type"] == "REELS":
+                    media = dropbox.files.VideoMetadata(dimensions=dimensions, duration=int((info["duration"] or 0) * 1000))
+                else:
+                    media = dropbox.files.PhotoMetadata(dimensions=dimensions)
+                media_info = dropbox.files.MediaInfo.metadata(media)
+            except Exception:
+                media_info = None
+        return dropbox.files.FileMetadata(
+            name=name,
+            id=entry_id,
+            client_modified=modified,
+            server_modified=modified,
+            rev=f"{stat.st_mtime_ns:016x}",
+            size=stat.st_size,
+            path_lower=display.lower(),
+            path_display=display,
+            content_hash=self.content_hash(local, stat),
+            media_info=media_info
+        )
+
+    # Dropbox SDK surface
+
+    def files_list_folder(self, path, **kwargs):
+        local = self._require(path)
+        entries = [self.metadata(os.path.join(local, name)) for name in sorted(os.listdir(local))]
+        return dropbox.files.ListFolderResult(entries=entries, cursor="local", has_more=False)
+
+    def files_get_metadata(self, path, include_media_info=False, **kwargs):
+        return self.metadata(self._require(path), include_media_info)
+
+    def files_get_temporary_link(self, path):
+        metadata = self.metadata(self._require(path))
+        return dropbox.files.GetTemporaryLinkResult(metadata=metadata, link=self.base_url + quote(metadata.path_display))
+
+    def files_delete_v2(self, path):
+        local = self._require(path)
+        metadata = self.metadata(local)
+        if os.path.isdir(local):
+            shutil.rmtree(local)
+        else:
+            os.remove(local)
+        return dropbox.files.DeleteResult(metadata=metadata)
+
+    def files_upload(self, data, path, mode=None, **kwargs):
+        local = self.local_path(path)
+        if local is None:
+            raise ValueError(f"Invalid path: {path}")
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(local, "wb") as f:
+            f.write(data)
+        return self.metadata(local)
+
+    def files_upload_session_start(self, data, **kwargs):
+        fd, part = tempfile.mkstemp(prefix="upload-", suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        session_id = os.path.basename(part)
+        with self._lock:
+            self._sessions[session_id] = part
+        return dropbox.files.UploadSessionStartResult(session_id=session_id)
+
+    def files_upload_session_append_v2(self, data, cursor, **kwargs):
+        with open(self._sessions[cursor.session_id], "ab") as f:
+            f.write(data)
+
+    def files_upload_session_finish(self, data, cursor, commit, **kwargs):
+        self.files_upload_session_append_v2(data, cursor)
+        with self._lock:
+            part = self._sessions.pop(cursor.session_id)
+        local = self.local_path(commit.path)
+        if local is None:
+            os.remove(part)
+            raise ValueError(f"Invalid path: {commit.path}")
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        shutil.move(part, local)
+        return self.metadata(local)
+
+    # Link server
+
+    def start(self):
+        source = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self._serve(send_body=False)
+
+            def do_GET(self):
+                self._serve(send_body=True)
+
+            def _serve(self, send_body):
+                local = source.local_path(unquote(urlparse(self.path).path))
+                if local is None or not os.path.isfile(local):
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                size = os.path.getsize(local)
+                start, end = 0, size - 1
+                match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range") or "")
+                if match and match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                elif match and match.group(2):
+                    start = max(0, size - int(match.group(2)))
+                if start > end and size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206 if match else 200)
+                if match:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.send_header("Content-Type", mimetypes.guess_type(local)[0] or "application/octet-stream")
+                self.send_header("Content-Length", str(max(0, end - start + 1)))
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+                if not send_body:
+                    return
+                with open(local, "rb") as f:
+                    f.seek(start)
+                    left = end - start + 1
+                    while left > 0:
+                        chunk = f.read(min(source.COPY_CHUNK, left))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        left -= len(chunk)
+
+            def log_message(self, format, *args):
+                logging.getLogger().debug("local media: " + format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="local-media", daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,53 @@
+"""Index of the Facebook Pages the Meta user manages."""
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+
+# One Page managed by the Meta user token, as indexed by PageDirectory
+PageEntry = namedtuple("PageEntry", ("id", "name", "category", "tasks", "access_token", "instagram_id"))
+
+
+class PageDirectory:
+    """Index of the Pages the Meta user token manages, loaded once per run from /me/accounts."""
+
+    FIELDS = "id,name,category,tasks,access_token,instagram_business_account{id}"
+    PAGE_LIMIT = 100
+
+    def __init__(self, session, graph_url="https://graph.facebook.com/v18.0"):
+        self.session = session
+        self.graph_url = graph_url
+        self._lock = threading.Lock()
+        self.pages = None
+
+    def load(self, user_token, refresh=False):
+        """Mapping of Page ID -> PageEntry. Raises RuntimeError if Meta rejects the request."""
+        with self._lock:
+            if self.pages is not None and not refresh:
+                return self.pages
+            pages = {}
+            url = f"{self.graph_url}/me/accounts"
+            params = {"fields": self.FIELDS, "limit": self.PAGE_LIMIT, "access_token": user_token}
+            while url:
+                res = self.session.get(url, params=params)
+                if res.status_code != 200:
+                    raise RuntimeError(f"Failed to fetch pages: {res.text}")
+                body = res.json()
+                for page in body.get("data", []):
+                    pages[page["id"]] = PageEntry(
+                        page["id"],
+                        page.get("name", "Unknown"),
+                        page.get("category", "Unknown"),
+                        tuple(page.get("tasks", [])),
+                        page.get("access_token"),
+                        (page.get("instagram_business_account") or {}).get("id")
+                    )
+                # The next link already carries the query string
+                url = (body.get("paging") or {}).get("next")
+                params = None
+            self.pages = MappingProxyType(pages)
+            return self.pages
+
+    def cached(self, page_id):
+        """PageEntry from an already loaded index, without any request."""
+        return self.pages.get(page_id) if self.pages is not None else None
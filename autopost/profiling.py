@@ -0,0 +1,194 @@
+"""Run profiling: cProfile or stack sampling, written as folded stacks and hotspot summaries."""
+import cProfile
+import contextlib
+import contextvars
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+class StackSampler:
+    """Background thread that samples every thread's Python stack into folded-stack counts."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def frame_label(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+
+class RunProfiler:
+    """Profiling for one run (PROFILE_MODE=cprofile | sample): folded stacks, hotspots and phase times in PROFILE_DIR."""
+
+    MODES = ("cprofile", "sample")
+    MIN_FOLDED_SECONDS = 1e-5
+
+    def __init__(self, mode, directory, top_n=30, interval=0.01, import_clocks=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown PROFILE_MODE '{mode}', expected off or one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.directory = directory
+        self.top_n = top_n
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.phases = {}
+        self.profile = None
+        self.sampler = None
+        # (wall, cpu) clocks read before and after the script's imports
+        started, self.imports_done = import_clocks or ((time.perf_counter(), time.process_time()),) * 2
+        self.add_phase("imports", self.imports_done[0] - started[0], self.imports_done[1] - started[1])
+
+    def add_phase(self, name, wall, cpu):
+        with self._lock:
+            total = self.phases.setdefault(name, [0.0, 0.0, 0])
+            total[0] += wall
+            total[1] += cpu
+            total[2] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+
+    def start(self):
+        self.add_phase("startup", time.perf_counter() - self.imports_done[0], time.process_time() - self.imports_done[1])
+        self.started = (time.perf_counter(), time.process_time())
+        if self.mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.sampler = StackSampler(self.interval)
+            self.sampler.start()
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.add_phase("run", time.perf_counter() - self.started[0], time.process_time() - self.started[1])
+
+    def folded_from_stats(self, stats, max_depth=64):
+        """Approximate folded stacks from pstats, splitting each function's own time over its callers."""
+        def label(func):
+            filename, line, name = func
+            return f"{name} ({os.path.basename(filename)}:{line})"
+
+        folded = {}
+
+        def walk(func, seconds, path, seen):
+            callers = {c: v[3] for c, v in stats.stats.get(func, (0, 0, 0, 0, {}))[4].items() if c not in seen}
+            total = sum(callers.values())
+            if total <= 0 or len(path) >= max_depth:
+                key = ";".join(reversed(path))
+                folded[key] = folded.get(key, 0.0) + seconds
+                return
+            if seconds < self.MIN_FOLDED_SECONDS:
+                callers = {max(callers, key=callers.get): total}
+            for caller, cumulative in callers.items():
+                walk(caller, seconds * cumulative / total, path + [label(caller)], seen | {caller})
+
+        for func, (_, _, own, _, _) in stats.stats.items():
+            if own > 0:
+                walk(func, own, [label(func)], {func})
+        # flamegraph.pl wants integer counts: microseconds
+        return {key: int(seconds * 1e6) for key, seconds in folded.items() if int(seconds * 1e6) > 0}
+
+    def hotspots(self):
+        """Summary lines for the top_n functions by own and by inclusive time."""
+        lines = []
+        if self.profile is not None:
+            out = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=out)
+            stats.sort_stats("tottime").print_stats(self.top_n)
+            stats.sort_stats("cumulative").print_stats(self.top_n)
+            return out.getvalue().splitlines()
+        own, inclusive = {}, {}
+        for stack, count in self.sampler.counts.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                inclusive[frame] = inclusive.get(frame, 0) + count
+        total = max(1, sum(self.sampler.counts.values()))
+        for title, table in (("Own time (samples, all threads)", own), ("Inclusive time (samples, all threads)", inclusive)):
+            lines.append(title)
+            for frame, count in sorted(table.items(), key=lambda item: -item[1])[:self.top_n]:
+                lines.append(f"  {count * self.interval:8.2f}s {count / total:6.1%}  {frame}")
+        return lines
+
+    def write(self, run_id):
+        """Write the folded stacks and the summary. Returns the paths written."""
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{run_id}-{self.mode}")
+        paths = []
+        if self.profile is not None:
+            self.profile.dump_stats(base + ".prof")
+            paths.append(base + ".prof")
+            folded = self.folded_from_stats(pstats.Stats(self.profile))
+        else:
+            folded = self.sampler.counts
+        with open(base + ".folded", "w") as f:
+            for stack, count in sorted(folded.items()):
+                f.write(f"{stack} {count}\n")
+        paths.append(base + ".folded")
+
+        with open(base + "-summary.txt", "w") as f:
+            f.write(f"Profile {run_id} ({self.mode})\n\nPhase               wall s    cpu s   cpu/wall   count\n")
+            for name, (wall, cpu, count) in sorted(self.phases.items(), key=lambda item: -item[1][0]):
+                f.write(f"{name:<18} {wall:8.2f} {cpu:8.2f} {cpu / wall if wall else 0:9.0%} {count:7d}\n")
+            f.write("\n" + "\n".join(self.hotspots()) + "\n")
+        paths.append(base + "-summary.txt")
+        return paths
+
+
+# Profiler of the current run, if PROFILE_MODE is on (see profile_phase)
+_current_profiler = contextvars.ContextVar("current_run_profiler", default=None)
+
+
+@contextlib.contextmanager
+def profile_phase(name):
+    """Time a block as a profile phase when the current run is being profiled."""
+    profiler = _current_profiler.get()
+    if profiler is None:
+        yield
+        return
+    with profiler.phase(name):
+        yield
@@ -0,0 +1,68 @@
+"""Instagram publishing quota and Graph app usage tracking."""
+import json
+import threading
+from datetime import datetime, timedelta
+
+from pytz import utc
+
+
+class QuotaTracker:
+    """Instagram content-publishing quota and Graph app usage for one account."""
+
+    WINDOW_SECONDS = 24 * 3600
+    DEFAULT_QUOTA = 100  # posts per rolling 24h when the API does not report config.quota_total
+    APP_USAGE_LIMIT = 90  # percent of any app usage metric at which publishing pauses
+
+    def __init__(self, history, account, platform="instagram"):
+        self.history = history
+        self.account = account
+        self.platform = platform
+        self._lock = threading.Lock()
+        self.quota_total = self.DEFAULT_QUOTA
+        self.api_usage = None
+        self.app_usage = 0
+        self.regain_seconds = 0
+
+    def observe_response(self, response, *args, **kwargs):
+        """Response hook (requests and httpx): track Graph usage headers."""
+        headers = response.headers
+        usage = []
+        try:
+            if headers.get("X-App-Usage"):
+                usage.extend(json.loads(headers["X-App-Usage"]).values())
+            regain = 0
+            if headers.get("X-Business-Use-Case-Usage"):
+                for entries in json.loads(headers["X-Business-Use-Case-Usage"]).values():
+                    for entry in entries:
+                        usage.extend(entry.get(k, 0) for k in ("call_count", "total_cputime", "total_time"))
+                        regain = max(regain, entry.get("estimated_time_to_regain_access", 0) * 60)
+        except (ValueError, AttributeError, TypeError):
+            return
+        if usage or regain:
+            with self._lock:
+                self.app_usage = max(usage, default=0)
+                self.regain_seconds = regain
+
+    def update_limit(self, data):
+        """Apply a content_publishing_limit payload ({"quota_usage": n, "config": {...}})."""
+        with self._lock:
+            self.api_usage = data.get("quota_usage")
+            self.quota_total = (data.get("config") or {}).get("quota_total") or self.DEFAULT_QUOTA
+
+    def local_count(self):
+        since = datetime.now(utc) - timedelta(seconds=self.WINDOW_SECONDS)
+        # Rows for posts found already published made no media_publish call of their own
+        return self.history.count_since(since, account=self.account, platform=self.platform, outcome="success",
+                                        exclude_upload_mode="already_published")
+
+    def throttled(self):
+        return self.app_usage >= self.APP_USAGE_LIMIT or self.regain_seconds > 0
+
+    def remaining(self):
+        """Posts that can still be published in the current window (0 while the app is throttled)."""
+        if self.throttled():
+            return 0
+        used = self.local_count()
+        if self.api_usage is not None:
+            used = max(used, self.api_usage)
+        return max(0, self.quota_total - used)
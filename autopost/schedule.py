@@ -0,0 +1,129 @@
+"""Validation and hot reload of scheduler/config.json."""
+import json
+import os
+import re
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+
+class ConfigError(ValueError):
+    """scheduler/config.json failed validation; .problems lists every issue found."""
+
+    def __init__(self, path, problems):
+        self.path = path
+        self.problems = problems
+        super().__init__(f"{path}: " + "; ".join(problems))
+
+
+# One validated day entry; tuples and mapping proxies keep the loaded config read-only
+DaySchedule = namedtuple("DaySchedule", ("caption", "description", "slots", "limits"))
+
+
+# {account: {"limits": {...}?, <Weekday>: {"caption", "description"?, "slots": ["HH:MM"]?, "limits"?}}};
+# limits may set posts_per_run and posts_per_day, and a day's limits override the account's
+class ScheduleConfig:
+    """Validated, immutable view of scheduler/config.json."""
+
+    WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+    DAY_KEYS = ("caption", "description", "slots", "limits")
+    LIMIT_KEYS = ("posts_per_run", "posts_per_day")
+    SLOT_PATTERN = re.compile(r"^([01]\d|2[0-3]):[0-5]\d$")
+
+    def __init__(self, days, mtime):
+        self._days = MappingProxyType(days)
+        self.accounts = frozenset(account for account, _ in days)
+        self.mtime = mtime
+
+    def day(self, account, weekday):
+        """DaySchedule for account on weekday, or None when the config has no entry."""
+        return self._days.get((account, weekday))
+
+    @classmethod
+    def _limits(cls, value, where, problems):
+        if not isinstance(value, dict):
+            problems.append(f"{where}.limits must be an object")
+            return MappingProxyType({})
+        for key, limit in value.items():
+            if key not in cls.LIMIT_KEYS:
+                problems.append(f"{where}.limits: unknown key '{key}'")
+            elif not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+                problems.append(f"{where}.limits.{key} must be a positive integer")
+        return MappingProxyType({k: v for k, v in value.items() if k in cls.LIMIT_KEYS})
+
+    @classmethod
+    def parse(cls, path, raw, mtime=None):
+        """Validate the decoded JSON and build the lookup table, or raise ConfigError with every problem."""
+        problems = []
+        days = {}
+        if not isinstance(raw, dict) or not raw:
+            raise ConfigError(path, ["top level must be a non-empty object of accounts"])
+        for account, schedule in raw.items():
+            if not isinstance(schedule, dict):
+                problems.append(f"{account} must be an object of weekdays")
+                continue
+            account_limits = cls._limits(schedule["limits"], account, problems) if "limits" in schedule else MappingProxyType({})
+            for weekday, entry in schedule.items():
+                if weekday == "limits":
+                    continue
+                where = f"{account}.{weekday}"
+                if weekday not in cls.WEEKDAYS:
+                    problems.append(f"{account}: unknown weekday '{weekday}'")
+                    continue
+                if not isinstance(entry, dict):
+                    problems.append(f"{where} must be an object")
+                    continue
+                for key in entry:
+                    if key not in cls.DAY_KEYS:
+                        problems.append(f"{where}: unknown key '{key}'")
+                caption = entry.get("caption")
+                if not isinstance(caption, str) or not caption.strip():
+                    problems.append(f"{where}.caption must be a non-empty string")
+                description = entry.get("description", caption)
+                if not isinstance(description, str):
+                    problems.append(f"{where}.description must be a string")
+                slots = entry.get("slots", [])
+                if not isinstance(slots, list) or not all(isinstance(s, str) and cls.SLOT_PATTERN.match(s) for s in slots):
+                    problems.append(f"{where}.slots must be a list of \"HH:MM\" times")
+                    slots = []
+                limits = dict(account_limits)
+                if "limits" in entry:
+                    limits.update(cls._limits(entry["limits"], where, problems))
+                days[(account, weekday)] = DaySchedule(caption, description, tuple(sorted(slots)), MappingProxyType(limits))
+        if problems:
+            raise ConfigError(path, problems)
+        return cls(days, mtime)
+
+
+class ScheduleConfigLoader:
+    """Loads scheduler/config.json and reloads it when its mtime changes, keeping the last good config."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._config = None
+        self.error = None
+
+    def get(self):
+        """Current ScheduleConfig. Raises ConfigError/OSError only if no valid config was ever loaded."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            if self._config is None:
+                raise
+            return self._config
+        config = self._config
+        if config is not None and config.mtime == mtime:
+            return config
+        with self._lock:
+            if self._config is None or self._config.mtime != mtime:
+                try:
+                    with open(self.path, "r") as f:
+                        raw = json.load(f)
+                    self._config = ScheduleConfig.parse(self.path, raw, mtime)
+                    self.error = None
+                except ValueError as e:
+                    self.error = e if isinstance(e, ConfigError) else ConfigError(self.path, [f"invalid JSON: {e}"])
+                    if self._config is None:
+                        raise self.error
+            return self._config
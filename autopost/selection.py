@@ -0,0 +1,139 @@
+"""File selection strategies and deadline-aware batching."""
+import heapq
+import random
+import time
+from datetime import datetime, timedelta
+
+from pytz import utc
+
+from .media import FolderEntry
+
+
+class FileSelector:
+    """Orders queued Dropbox files for posting with one of STRATEGIES."""
+
+    # weighted favours old files, small files and less recently posted media types;
+    # fastest orders by the Meta processing time estimated from publish history
+    STRATEGIES = ("random", "fifo", "weighted", "round_robin", "fastest")
+    DEFAULT_SECONDS = {"REELS": 90.0, "IMAGE": 15.0}
+    MIN_HISTORY_SAMPLES = 3
+
+    def __init__(self, strategy="random", history=None, account=None, rng=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown selection strategy '{strategy}', expected one of {', '.join(self.STRATEGIES)}")
+        self.strategy = strategy
+        self.history = history
+        self.account = account
+        self.rng = rng or random.Random()
+        self._type_stats = {}
+
+    @staticmethod
+    def media_type(file):
+        return getattr(file, "media_type", None) or ("REELS" if file.name.lower().endswith((".mp4", ".mov")) else "IMAGE")
+
+    @staticmethod
+    def file_timestamp(file):
+        if isinstance(file, FolderEntry):
+            return file.modified
+        modified = getattr(file, "client_modified", None) or getattr(file, "server_modified", None)
+        return modified.timestamp() if modified else 0.0
+
+    def _stats_for(self, media_type):
+        if media_type not in self._type_stats:
+            stats = None
+            if self.history is not None:
+                stats = self.history.media_type_stats(media_type, account=self.account)
+            self._type_stats[media_type] = stats
+        return self._type_stats[media_type]
+
+    def estimate_seconds(self, file):
+        """Estimated end-to-end Instagram publish time, scaled by size against similar past files."""
+        media_type = self.media_type(file)
+        stats = self._stats_for(media_type)
+        if not stats or stats["count"] < self.MIN_HISTORY_SAMPLES or not stats["mean_seconds"]:
+            return self.DEFAULT_SECONDS[media_type]
+        if not stats["mean_size"]:
+            return stats["mean_seconds"]
+        scale = file.size / stats["mean_size"]
+        return stats["mean_seconds"] * min(3.0, max(0.5, scale))
+
+    def _recent_type_share(self):
+        """Share of each media type among recent Instagram publishes."""
+        if self.history is None:
+            return {}
+        since = (datetime.now(utc) - timedelta(days=7)).strftime("%Y-%m-%d")
+        rows = self.history.query(since=since, account=self.account, platform="instagram", limit=200)
+        if not rows:
+            return {}
+        counts = {}
+        for row in rows:
+            counts[row["media_type"]] = counts.get(row["media_type"], 0) + 1
+        return {media_type: n / len(rows) for media_type, n in counts.items()}
+
+    def _last_media_type(self):
+        if self.history is None:
+            return None
+        rows = self.history.query(account=self.account, platform="instagram", limit=1)
+        return rows[0]["media_type"] if rows else None
+
+    def _priorities(self, files):
+        """Yield (priority, file); lower priority is posted first."""
+        if self.strategy == "random":
+            for file in files:
+                yield self.rng.random(), file
+        elif self.strategy == "fifo":
+            for file in files:
+                yield self.file_timestamp(file), file
+        elif self.strategy == "fastest":
+            for file in files:
+                yield self.estimate_seconds(file), file
+        elif self.strategy == "weighted":
+            now = time.time()
+            shares = self._recent_type_share()
+            for file in files:
+                modified = self.file_timestamp(file)
+                age_days = max(0.0, (now - modified) / 86400) if modified else 0.0
+                weight = 1 + age_days / 7
+                weight *= 2 - shares.get(self.media_type(file), 0.0)
+                weight /= 1 + file.size / 1024 / 1024 / 100
+                # Weighted random ordering (Efraimidis-Spirakis): larger u ** (1 / w) goes first
+                yield -(self.rng.random() ** (1 / weight)), file
+        elif self.strategy == "round_robin":
+            by_type = {}
+            for file in sorted(files, key=self.file_timestamp):
+                by_type.setdefault(self.media_type(file), []).append(file)
+            types = sorted(by_type)
+            last = self._last_media_type()
+            if last in types and len(types) > 1:
+                # Start with the type that was not posted last time
+                types.remove(last)
+                types.append(last)
+            for offset, media_type in enumerate(types):
+                for rank, file in enumerate(by_type[media_type]):
+                    yield rank * len(types) + offset, file
+
+    def queue(self, files):
+        """Return files in posting order."""
+        heap = [(priority, seq, file) for seq, (priority, file) in enumerate(self._priorities(files))]
+        heapq.heapify(heap)
+        return [heapq.heappop(heap)[2] for _ in range(len(heap))]
+
+    def select(self, files):
+        ordered = self.queue(files)
+        return ordered[0] if ordered else None
+
+    def pack_batch(self, files, max_files, deadline_seconds=None, concurrency=1):
+        """Take files in queue order while the estimated batch time fits the deadline."""
+        ordered = self.queue(files)
+        if not ordered:
+            return []
+        batch, total = [], 0.0
+        for file in ordered:
+            if len(batch) >= max_files:
+                break
+            estimate = self.estimate_seconds(file)
+            if deadline_seconds and (total + estimate) / max(1, concurrency) > deadline_seconds:
+                continue
+            batch.append(file)
+            total += estimate
+        return batch or ordered[:1]
@@ -0,0 +1,59 @@
+"""Pooled transfer buffers and chunked reads of streamed responses."""
+import contextlib
+import threading
+
+
+STREAM_BUFFER_SIZE = 8 * 1024 * 1024
+STREAM_MAX_BUFFERS = 8
+
+
+class BufferPool:
+    """Fixed set of reusable transfer buffers; transfers wait while all of them are in use."""
+
+    def __init__(self, buffer_size=STREAM_BUFFER_SIZE, count=STREAM_MAX_BUFFERS):
+        self.buffer_size = buffer_size
+        self._slots = threading.BoundedSemaphore(count)
+        self._lock = threading.Lock()
+        self._free = []
+
+    @contextlib.contextmanager
+    def buffer(self):
+        self._slots.acquire()
+        with self._lock:
+            buf = self._free.pop() if self._free else bytearray(self.buffer_size)
+        try:
+            yield memoryview(buf)
+        finally:
+            with self._lock:
+                self._free.append(buf)
+            self._slots.release()
+
+
+def fill_buffer(stream, view):
+    """readinto() until view is full or the stream ends. Returns the number of bytes read."""
+    filled = 0
+    while filled < len(view):
+        n = stream.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def iter_response_chunks(response, view):
+    """Yield a stream=True response body as slices of view, each overwritten by the next."""
+    if response._content_consumed and isinstance(response._content, bytes):
+        body = memoryview(response._content)
+        for start in range(0, len(body), len(view)):
+            n = min(len(view), len(body) - start)
+            view[:n] = body[start:start + n]
+            yield view[:n]
+        return
+    raw = response.raw
+    raw.decode_content = True
+    while True:
+        n = fill_buffer(raw, view)
+        if n:
+            yield view[:n]
+        if n < len(view):
+            return
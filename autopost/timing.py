@@ -0,0 +1,87 @@
+"""Clocks and the run-level deadline budget."""
+import asyncio
+import time
+
+
+class Clock:
+    """Wall clock used for every wait in a run; scale < 1 compresses sleeps (dry runs)."""
+
+    def __init__(self, scale=1.0):
+        self.scale = scale
+
+    def time(self):
+        return time.time()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(max(0.0, seconds) * self.scale)
+
+
+class ManualClock(Clock):
+    """Virtual clock: sleeping advances time instantly, so waits and deadlines can be exercised without delay."""
+
+    def __init__(self, start=0.0):
+        super().__init__(scale=0.0)
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += max(0.0, seconds)
+
+    async def sleep(self, seconds):
+        self.advance(seconds)
+        await asyncio.sleep(0)
+
+
+class RunBudget:
+    """Run-level deadline that every wait draws from, split into per-phase slices (PHASE_SHARES)."""
+
+    PHASE_SHARES = (("processing", 0.7), ("verify", 0.3))
+
+    def __init__(self, clock, total_seconds):
+        self.clock = clock
+        self.total = total_seconds
+        self.started = clock.time()
+        self.deadline = self.started + total_seconds
+        self.cutoffs = {}
+        cumulative = 0.0
+        for phase, share in self.PHASE_SHARES:
+            cumulative += share
+            self.cutoffs[phase] = self.started + total_seconds * min(cumulative, 1.0)
+        self.waited = {}
+
+    def remaining(self, phase=None):
+        end = self.cutoffs.get(phase, self.deadline) if phase else self.deadline
+        return max(0.0, end - self.clock.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    async def wait(self, seconds, phase):
+        """Sleep up to seconds within the phase's allocation. Returns the seconds actually waited."""
+        allowed = min(seconds, self.remaining(phase))
+        if allowed <= 0:
+            return 0.0
+        await self.clock.sleep(allowed)
+        self.waited[phase] = self.waited.get(phase, 0.0) + allowed
+        return allowed
+
+    async def wait_for(self, future, seconds, phase):
+        """Wait for future up to seconds within the phase's allocation. Returns its result, or None on timeout."""
+        if future.done():
+            return future.result()
+        allowed = min(seconds, self.remaining(phase))
+        if allowed <= 0:
+            return None
+        started = self.clock.time()
+        sleeper = asyncio.ensure_future(self.clock.sleep(allowed))
+        try:
+            await asyncio.wait({sleeper, future}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sleeper.cancel()
+        self.waited[phase] = self.waited.get(phase, 0.0) + min(allowed, self.clock.time() - started)
+        if future.done():
+            return future.result()
+        future.cancel()
+        return None
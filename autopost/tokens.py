@@ -0,0 +1,160 @@
+"""Dropbox and Meta token refresh."""
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class TokenManager:
+    """Dropbox and Meta tokens for a run, refreshed near expiry and written to disk only at TOKEN_CACHE."""
+
+    # Where earlier versions cached tokens; removed so the Actions cache stops carrying them
+    LEGACY_CACHE = "state/tokens.json"
+
+    GRAPH_URL = "https://graph.facebook.com"
+    DROPBOX_TOKEN_URL = "https://api.dropbox.com/oauth2/token"
+    DROPBOX_EXPIRY_MARGIN = 300  # refresh this many seconds before the access token expires
+    META_REFRESH_DAYS = 10
+
+    def __init__(self, session, path=None, meta_token=None, meta_app_id=None, meta_app_secret=None,
+                 dropbox_key=None, dropbox_secret=None, dropbox_refresh=None):
+        self.session = session
+        self.path = path
+        self.meta_app_id = meta_app_id
+        self.meta_app_secret = meta_app_secret
+        self.dropbox_key = dropbox_key
+        self.dropbox_secret = dropbox_secret
+        self.dropbox_refresh = dropbox_refresh
+        self._lock = threading.Lock()
+        self._debug = None
+        self._meta_source = self.fingerprint(meta_token)
+        self.meta_token = meta_token
+        self.meta_expires_at = None
+        self.dropbox_token = None
+        self.dropbox_expires_at = 0.0
+        self._load()
+
+    @staticmethod
+    def fingerprint(secret):
+        return hashlib.sha256(secret.encode("utf-8")).hexdigest()[:16] if secret else None
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        dbx = data.get("dropbox") or {}
+        if dbx.get("source") == self.fingerprint(self.dropbox_refresh):
+            self.dropbox_token = dbx.get("access_token")
+            self.dropbox_expires_at = dbx.get("expires_at") or 0.0
+        meta = data.get("meta") or {}
+        # A changed META_TOKEN secret wins over a token exchanged from the old one
+        if meta.get("source") == self._meta_source and meta.get("access_token"):
+            self.meta_token = meta["access_token"]
+            self.meta_expires_at = meta.get("expires_at")
+
+    def remove_legacy_cache(self):
+        """Delete tokens cached by earlier versions under state/. Returns True if a file was removed."""
+        if os.path.abspath(self.LEGACY_CACHE) == os.path.abspath(self.path or ""):
+            return False
+        try:
+            os.remove(self.LEGACY_CACHE)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            data = {
+                "dropbox": {
+                    "access_token": self.dropbox_token,
+                    "expires_at": self.dropbox_expires_at,
+                    "source": self.fingerprint(self.dropbox_refresh),
+                },
+                "meta": {
+                    "access_token": self.meta_token,
+                    "expires_at": self.meta_expires_at,
+                    "source": self._meta_source,
+                },
+            }
+        with open(self.path, "w") as f:
+            json.dump(data, f)
+        os.chmod(self.path, 0o600)
+
+    def dropbox_access_token(self):
+        """Cached Dropbox access token, refreshed through OAuth only when close to expiry."""
+        with self._lock:
+            if self.dropbox_token and self.dropbox_expires_at - time.time() > self.DROPBOX_EXPIRY_MARGIN:
+                return self.dropbox_token, False
+        r = self.session.post(self.DROPBOX_TOKEN_URL, data={
+            "grant_type": "refresh_token",
+            "refresh_token": self.dropbox_refresh,
+            "client_id": self.dropbox_key,
+            "client_secret": self.dropbox_secret,
+        })
+        if r.status_code != 200:
+            raise RuntimeError(f"Dropbox refresh failed: {r.text}")
+        data = r.json()
+        with self._lock:
+            self.dropbox_token = data.get("access_token")
+            self.dropbox_expires_at = time.time() + float(data.get("expires_in") or 14400)
+        self.save()
+        return self.dropbox_token, True
+
+    def debug_meta_token(self, refresh=False):
+        """debug_token data for the current Meta token, fetched once per run."""
+        if self._debug is None or refresh:
+            res = self.session.get(f"{self.GRAPH_URL}/debug_token", params={
+                "input_token": self.meta_token,
+                "access_token": self.meta_token
+            })
+            body = res.json()
+            if "data" not in body:
+                raise RuntimeError(f"Token debug info not returned properly: {res.text}")
+            self._debug = body["data"]
+            if self._debug.get("expires_at"):
+                self.meta_expires_at = self._debug["expires_at"]
+        return self._debug
+
+    def meta_days_left(self):
+        expires_at = self.debug_meta_token().get("expires_at")
+        if not expires_at:
+            return None
+        return (expires_at - time.time()) / 86400
+
+    def exchange_meta_token(self, token):
+        """fb_exchange_token: trade a user or page token for a long-lived one. Returns (token, expires_in)."""
+        if not (self.meta_app_id and self.meta_app_secret):
+            raise RuntimeError("META_APP_ID and META_APP_SECRET are required to exchange tokens")
+        res = self.session.get(f"{self.GRAPH_URL}/v18.0/oauth/access_token", params={
+            "grant_type": "fb_exchange_token",
+            "client_id": self.meta_app_id,
+            "client_secret": self.meta_app_secret,
+            "fb_exchange_token": token
+        })
+        if res.status_code != 200:
+            raise RuntimeError(f"Token exchange failed: {res.text}")
+        data = res.json()
+        return data.get("access_token"), data.get("expires_in")
+
+    def refresh_meta_token_if_needed(self):
+        """Exchange the Meta user token when it is close to expiry. Returns days left before, or None if not refreshed."""
+        days_left = self.meta_days_left()
+        if days_left is None or days_left > self.META_REFRESH_DAYS:
+            return None
+        token, expires_in = self.exchange_meta_token(self.meta_token)
+        with self._lock:
+            self.meta_token = token
+            self.meta_expires_at = time.time() + float(expires_in) if expires_in else None
+        self._debug = None
+        self.save()
+        return days_left
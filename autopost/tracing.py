@@ -0,0 +1,209 @@
+"""Record/replay of HTTP and Telegram traffic for dry runs."""
+import base64
+import io
+import json
+import os
+import random
+import re
+import threading
+from collections import deque
+from datetime import datetime
+from urllib.parse import urlparse
+
+import requests
+from pytz import utc
+
+
+# Not a requests error: retries and PublishGuard's lookup must not absorb a replay that diverged
+class TraceMissError(RuntimeError):
+    """Replay asked for a request that the trace does not contain (or has already been used up)."""
+
+    def __init__(self, message, request=None):
+        super().__init__(message)
+        self.request = request
+
+
+class TracedStream:
+    """File-like wrapper over a streamed response body that keeps its first limit bytes for a trace."""
+
+    def __init__(self, raw, limit, done):
+        self._raw = raw
+        self._limit = limit
+        self._done = done
+        self._head = bytearray()
+        self._length = 0
+        self._finished = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    @property
+    def decode_content(self):
+        return getattr(self._raw, "decode_content", None)
+
+    @decode_content.setter
+    def decode_content(self, value):
+        self._raw.decode_content = value
+
+    def _seen(self, data):
+        if self._length < self._limit:
+            self._head += data[:self._limit - self._length]
+        self._length += len(data)
+
+    def readinto(self, b):
+        n = self._raw.readinto(b)
+        self._seen(memoryview(b)[:n])
+        if not n:
+            self.finish()
+        return n
+
+    def read(self, amt=None, **kwargs):
+        data = self._raw.read(amt, **kwargs)
+        self._seen(data)
+        if not data or amt is None:
+            self.finish()
+        return data
+
+    def stream(self, amt=65536, decode_content=None):
+        while True:
+            data = self.read(amt, decode_content=decode_content)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self.finish()
+        self._raw.close()
+
+    def finish(self):
+        if not self._finished:
+            self._finished = True
+            self._done(bytes(self._head), self._length)
+            self._head = None
+
+
+class TraceStore:
+    """Record/replay of HTTP and Telegram traffic for dry runs (PUBLISH_TRACE_MODE=record|replay)."""
+
+    SECRET_KEYS = ("access_token", "input_token", "client_secret", "client_id", "fb_exchange_token", "refresh_token")
+    SECRET_PATTERN = re.compile(r'("?(?:%s)"?\s*[:=]\s*"?)[^"&\s,}]+' % "|".join(SECRET_KEYS))
+    MAX_BODY_BYTES = 2 * 1024 * 1024  # media downloads beyond this are stored truncated
+
+    def __init__(self, mode, path, time_scale=None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown trace mode '{mode}', expected record or replay")
+        self.mode = mode
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = []
+        self.seed = random.randrange(2 ** 32)
+        if mode == "replay":
+            with open(path, "r") as f:
+                data = json.load(f)
+            self.seed = data["seed"]
+            self.entries = data["entries"]
+        self._queues = {}
+        for entry in self.entries:
+            if entry["channel"] == "http":
+                self._queues.setdefault(self.key(entry["method"], entry["url"]), deque()).append(entry)
+        self.replayed = 0
+        self._streams = []
+        # Replays skip the polling sleeps by default; recordings keep real time
+        self.time_scale = time_scale if time_scale is not None else (0.0 if mode == "replay" else 1.0)
+
+    @staticmethod
+    def key(method, url):
+        parsed = urlparse(url)
+        return f"{method.upper()} {parsed.netloc}{parsed.path}"
+
+    @classmethod
+    def redact(cls, text):
+        return cls.SECRET_PATTERN.sub(r"\1<redacted>", text)
+
+    def record_http(self, request, response, stream=False):
+        """Record a response. Streamed bodies are captured as the caller reads them, never buffered whole."""
+        entry = {
+            "channel": "http",
+            "method": request.method,
+            "url": self.redact(request.url),
+            "status": response.status_code,
+            "headers": {k: v for k, v in response.headers.items() if k.lower() not in ("set-cookie", "content-encoding")},
+            "text": "",
+        }
+        with self._lock:
+            self.entries.append(entry)
+        if stream and not response._content_consumed:
+            response.raw = TracedStream(response.raw, self.MAX_BODY_BYTES, lambda head, length: self._set_body(entry, head, length))
+            with self._lock:
+                self._streams.append(response.raw)
+            return
+        body = response.content or b""
+        self._set_body(entry, body[:self.MAX_BODY_BYTES], len(body))
+
+    def _set_body(self, entry, head, length):
+        entry.pop("text", None)
+        entry["length"] = length
+        entry["truncated"] = length > len(head)
+        try:
+            entry["text"] = self.redact(head.decode("utf-8"))
+        except UnicodeDecodeError:
+            entry["base64"] = base64.b64encode(head).decode("ascii")
+
+    def replay_http(self, request):
+        with self._lock:
+            queue = self._queues.get(self.key(request.method, request.url))
+            if not queue:
+                raise TraceMissError(f"No recorded response left for {self.key(request.method, request.url)}", request=request)
+            entry = queue.popleft()
+            self.replayed += 1
+        body = entry["text"].encode("utf-8") if "text" in entry else base64.b64decode(entry["base64"])
+        res = requests.Response()
+        res.status_code = entry["status"]
+        res.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        # Truncated media keeps its real length, so a short read is noticed instead of used
+        res.headers["Content-Length"] = str(entry.get("length", len(body)))
+        res._content = body
+        res._content_consumed = True
+        res.raw = io.BytesIO(body)
+        res.encoding = "utf-8"
+        res.url = request.url
+        res.request = request
+        return res
+
+    def record_telegram(self, chat_id, text):
+        with self._lock:
+            self.entries.append({"channel": "telegram", "chat_id": str(chat_id), "text": self.redact(text)})
+
+    def remaining(self):
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    def save(self):
+        if self.mode != "record":
+            return
+        with self._lock:
+            streams, self._streams = self._streams, []
+        # Streams the run never finished reading are recorded with what was read
+        for stream in streams:
+            stream.finish()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            data = {"seed": self.seed, "recorded_at": datetime.now(utc).isoformat(), "entries": self.entries}
+        with open(self.path, "w") as f:
+            json.dump(data, f, indent=1)
+
+
+class TracedTelegramBot:
+    """Telegram bot stand-in that records messages, and only sends them when recording."""
+
+    def __init__(self, bot, trace):
+        self.bot = bot
+        self.trace = trace
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.trace.record_telegram(chat_id, text)
+        if self.trace.mode == "replay" or self.bot is None:
+            return None
+        return self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
@@ -0,0 +1,153 @@
+"""Meta webhook receiver."""
+import asyncio
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qsl, urlparse
+
+import requests
+
+
+class WebhookReceiver:
+    """Local HTTP endpoint for signed Meta webhooks that resolves pending "video:<id>" futures."""
+
+    MAX_BODY_BYTES = 1024 * 1024
+    EVENT_TTL_SECONDS = 900
+    FINAL_VIDEO_STATUSES = ("ready", "published", "error")
+
+    def __init__(self, app_secret, verify_token=None, host="127.0.0.1", port=8080):
+        if not app_secret:
+            raise ValueError("META_APP_SECRET is required to verify webhook signatures")
+        self.app_secret = app_secret.encode("utf-8")
+        self.verify_token = verify_token
+        self.host = host
+        self.port = port
+        self.server = None
+        self._lock = threading.Lock()
+        self.events = {}
+        self._waiters = {}
+
+    @staticmethod
+    def sign(body, app_secret):
+        return "sha256=" + hmac.new(app_secret, body, hashlib.sha256).hexdigest()
+
+    def verify_signature(self, body, header):
+        return bool(header) and hmac.compare_digest(self.sign(body, self.app_secret), header)
+
+    @classmethod
+    def parse(cls, payload):
+        """(key, event) pairs for the completion events in a webhook payload."""
+        events = []
+        if payload.get("object") != "page":
+            return events
+        for entry in payload.get("entry", []):
+            for change in entry.get("changes", []):
+                field, value = change.get("field"), change.get("value") or {}
+                if field == "videos" and value.get("id"):
+                    status = (value.get("status") or {}).get("video_status")
+                    if status in cls.FINAL_VIDEO_STATUSES:
+                        events.append((f"video:{value['id']}", {"status": status}))
+                elif field == "feed" and value.get("verb") == "add" and value.get("video_id"):
+                    events.append((f"video:{value['video_id']}", {"status": "published", "post_id": value.get("post_id")}))
+        return events
+
+    def dispatch(self, payload):
+        now = time.monotonic()
+        for key, event in self.parse(payload):
+            with self._lock:
+                # Drop events nobody claimed in time
+                for stale in [k for k, (at, _) in self.events.items() if now - at > self.EVENT_TTL_SECONDS]:
+                    del self.events[stale]
+                waiters = self._waiters.pop(key, [])
+                if not waiters:
+                    self.events[key] = (now, event)
+            for loop, future in waiters:
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(self._resolve, future, event)
+
+    @staticmethod
+    def _resolve(future, event):
+        if not future.done():
+            future.set_result(event)
+
+    def future(self, key):
+        """Future on the running loop that resolves with the event for key."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if key in self.events:
+                future.set_result(self.events.pop(key)[1])
+            else:
+                self._waiters.setdefault(key, []).append((loop, future))
+                future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            waiters = [w for w in self._waiters.get(key, []) if w[1] is not future]
+            if waiters:
+                self._waiters[key] = waiters
+            else:
+                self._waiters.pop(key, None)
+
+    def start(self):
+        receiver = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                # Subscription handshake
+                query = dict(parse_qsl(urlparse(self.path).query))
+                if query.get("hub.mode") == "subscribe" and receiver.verify_token \
+                        and hmac.compare_digest(query.get("hub.verify_token", ""), receiver.verify_token):
+                    self._reply(200, query.get("hub.challenge", "").encode("utf-8"))
+                else:
+                    self._reply(403)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length > receiver.MAX_BODY_BYTES:
+                    self._reply(413)
+                    return
+                body = self.rfile.read(length)
+                if not receiver.verify_signature(body, self.headers.get("X-Hub-Signature-256")):
+                    self._reply(403)
+                    return
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    self._reply(400)
+                    return
+                receiver.dispatch(payload)
+                self._reply(200)
+
+            def _reply(self, code, body=b""):
+                self.send_response(code)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.getLogger().debug("webhook: " + format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="webhook-receiver", daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def post_simulated_webhook(url, payload, app_secret):
+    """Offline stand-in for Meta: sign payload with app_secret and POST it to a receiver."""
+    body = json.dumps(payload).encode("utf-8")
+    return requests.post(url, data=body, timeout=10, headers={
+        "Content-Type": "application/json",
+        "X-Hub-Signature-256": WebhookReceiver.sign(body, app_secret.encode("utf-8")),
+    })
@@ -1,27 +1,64 @@
 # File: eclipsed_by_you_post.py
 import os
 import time
+# Wall and CPU clocks around the imports, for the profile's 'imports' phase
+_IMPORTS_STARTED = (time.perf_counter(), time.process_time())
+import asyncio
 import json
 import logging
-import requests
+import sys
 import dropbox
 from telegram import Bot
-from datetime import datetime, timedelta
+from datetime import datetime
 from pytz import timezone, utc
 from moviepy.editor import VideoFileClip
 import random
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from autopost.media import CarouselGroup, FolderEntry, MediaIndex, NormalisedFile, analyse_media_file, media_dimensions, normalise_media, plan_normalisation
+from autopost.streaming import BufferPool, STREAM_BUFFER_SIZE, iter_response_chunks
+from autopost.breakers import CircuitBreakerRegistry, CircuitBreakerSession, CircuitOpenError
+from autopost.clients import AsyncDropboxAdapter, AsyncHttpClient, AsyncTelegramAdapter, GraphClient, GraphError
+from autopost.media_source import LinkCache, LocalMediaSource
+from autopost.timing import Clock, ManualClock, RunBudget
+from autopost.profiling import RunProfiler, _current_profiler, profile_phase
+from autopost.tokens import TokenManager
+from autopost.webhooks import WebhookReceiver, post_simulated_webhook
+from autopost.schedule import ConfigError, ScheduleConfigLoader
+from autopost.pages import PageDirectory
+from autopost.tracing import TraceStore, TracedTelegramBot
+from autopost.history import PublishHistoryStore, _current_record
+from autopost.quota import QuotaTracker
+from autopost.guard import PublishGuard
+from autopost.selection import FileSelector
+from autopost.destinations import DESTINATIONS, PostOutcome, PublishJob, media_type_of
+
+_IMPORTS_DONE = (time.perf_counter(), time.process_time())
+
 
 class DropboxToInstagramUploader:
     DROPBOX_TOKEN_URL = "https://api.dropbox.com/oauth2/token"
     INSTAGRAM_API_BASE = "https://graph.facebook.com/v18.0"
     INSTAGRAM_REEL_STATUS_RETRIES = 10
     INSTAGRAM_REEL_STATUS_WAIT_TIME = 15
+    WEBHOOK_WAIT_SECONDS = 120
+    INSTAGRAM_RUPLOAD_BASE = "https://rupload.facebook.com/ig-api-upload/v18.0"
+    RESUMABLE_CHUNK_SIZE = STREAM_BUFFER_SIZE
+    RESUMABLE_CHUNK_RETRIES = 3
+    RESUMABLE_MIN_SIZE_MB = 40
+    DROPBOX_MIN_THROUGHPUT_MBPS = 4.0
+    THROUGHPUT_PROBE_BYTES = 2 * 1024 * 1024
+    PUBLISH_CONCURRENCY = 4
+    CAROUSEL_MAX_ITEMS = 10
+    DROPBOX_UPLOAD_CHUNK = STREAM_BUFFER_SIZE  # the SDK needs bytes, so each chunk is one read
 
     def __init__(self):
         self.script_name = "eclipsed_by_you_post.py"
         self.ist = timezone('Asia/Kolkata')
         self.account_key = "eclipsed_by_you"
         self.schedule_file = "scheduler/config.json"
+        self.config = ScheduleConfigLoader(self.schedule_file)
 
         # Logging
         logging.basicConfig(
@@ -31,10 +68,12 @@ class DropboxToInstagramUploader:
         )
         self.logger = logging.getLogger()
 
-        # Secrets from GitHub environment
-        self.meta_token = os.getenv("META_TOKEN")
+        # Secrets from GitHub environment (META_TOKEN is served through self.tokens)
+        meta_token = os.getenv("META_TOKEN")
         self.ig_id = os.getenv("IG_ID")
         self.fb_page_id = os.getenv("FB_PAGE_ID")
+        # auto | hosted | resumable
+        self.ig_upload_mode = (os.getenv("IG_UPLOAD_MODE") or "auto").strip().lower()
         
         # Telegram configuration
         self.telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -51,14 +90,158 @@ class DropboxToInstagramUploader:
             self.telegram_bot = None
 
         self.start_time = time.time()
-        self.session = requests.Session()
+
+        # Dry runs: record | replay traffic to/from PUBLISH_TRACE_FILE
+        trace_mode = (os.getenv("PUBLISH_TRACE_MODE") or "off").strip().lower()
+        trace_scale = os.getenv("PUBLISH_TRACE_TIME_SCALE")
+        self.trace = None
+        if trace_mode != "off":
+            self.trace = TraceStore(
+                trace_mode,
+                os.getenv("PUBLISH_TRACE_FILE") or "state/traces/trace.json",
+                float(trace_scale) if trace_scale else None
+            )
+            self.telegram_bot = TracedTelegramBot(self.telegram_bot, self.trace)
+        if self.trace and self.trace.time_scale == 0:
+            self.clock = ManualClock(time.time())
+        else:
+            self.clock = Clock(self.trace.time_scale if self.trace else 1.0)
+        # Every wait in the run draws from this budget so a run cannot outlive the CI job
+        self.budget = RunBudget(self.clock, float(os.getenv("RUN_DEADLINE_SECONDS") or 900))
+        replaying = self.trace is not None and self.trace.mode == "replay"
+
+        # A replay must not read or overwrite the real breaker state and history
+        self.breakers = CircuitBreakerRegistry(None if replaying else os.getenv("CIRCUIT_BREAKER_STATE") or "state/circuit_breakers.json")
+        self.session = CircuitBreakerSession(self.breakers, trace=self.trace)
+        self.http = AsyncHttpClient(self.session, breakers=self.breakers, use_httpx=self.trace is None)
+        self.graph = GraphClient(self.http)
+        # Diagnostic-only Graph fetches (e.g. the Reels listing) run only with GRAPH_DEBUG=1
+        self.graph_debug = (os.getenv("GRAPH_DEBUG") or "").strip().lower() in ("1", "true", "on")
+        # Optional Meta webhook receiver (WEBHOOK_MODE=on); its events race the polling.
+        # It binds to localhost unless WEBHOOK_HOST opts in to a public interface.
+        self.webhooks = None
+        if (os.getenv("WEBHOOK_MODE") or "off").strip().lower() == "on":
+            self.webhooks = WebhookReceiver(
+                os.getenv("META_APP_SECRET"),
+                os.getenv("WEBHOOK_VERIFY_TOKEN"),
+                host=(os.getenv("WEBHOOK_HOST") or "127.0.0.1").strip(),
+                port=int(os.getenv("WEBHOOK_PORT") or 8080)
+            )
+
+        self.pages = PageDirectory(self.session)
+
+        # Memory ceiling for media transfers: STREAM_MAX_BUFFERS buffers of STREAM_BUFFER_SIZE
+        self.buffers = BufferPool()
+        # One temporary link per file for the whole run
+        self.links = LinkCache()
+        # Media backend: dropbox | local (LOCAL_MEDIA_DIR served over HTTP, for offline runs and load tests)
+        self.local_media = None
+        if (os.getenv("MEDIA_SOURCE") or "dropbox").strip().lower() == "local":
+            public_url = os.getenv("LOCAL_MEDIA_URL")
+            self.local_media = LocalMediaSource(
+                os.getenv("LOCAL_MEDIA_DIR") or "media",
+                host="0.0.0.0" if public_url else "127.0.0.1",
+                port=int(os.getenv("LOCAL_MEDIA_PORT") or 0),
+                public_url=public_url
+            )
+        # Dry runs always go through OAuth so recordings and replays see the same requests
+        self.tokens = TokenManager(
+            self.session,
+            None if self.trace else os.getenv("TOKEN_CACHE"),
+            meta_token=meta_token,
+            meta_app_id=os.getenv("META_APP_ID"),
+            meta_app_secret=os.getenv("META_APP_SECRET"),
+            dropbox_key=self.dropbox_key,
+            dropbox_secret=self.dropbox_secret,
+            dropbox_refresh=self.dropbox_refresh
+        )
+        self.telegram = AsyncTelegramAdapter(self.telegram_bot) if self.telegram_bot else None
+
+        # Publish history (SQLite)
+        self.run_id = datetime.now(utc).strftime("%Y%m%dT%H%M%S")
+        self.history = PublishHistoryStore(":memory:" if replaying else os.getenv("PUBLISH_HISTORY_DB") or "state/publish_history.db")
+        # Operation keys in the history make publish retries safe (PUBLISH_RETRIES per ambiguous failure)
+        self.guard = PublishGuard(self.history, self.account_key, self.send_message_async, retries=int(os.getenv("PUBLISH_RETRIES") or PublishGuard.RETRIES))
+        self.media_index = MediaIndex(os.getenv("MEDIA_INDEX_DB") or "state/media_index.db")
+
+        # Publishing quota: checked before any container is created
+        self.quota = QuotaTracker(self.history, self.account_key)
+        self.session.hooks["response"].append(self.quota.observe_response)
+        self.http.response_hooks.append(self.quota.observe_response)
+
+        # File selection: strategy, files per run and the time budget a batch must fit in
+        self.selector = FileSelector(
+            (os.getenv("FILE_SELECTION_STRATEGY") or "random").strip().lower(),
+            history=self.history,
+            account=self.account_key,
+            rng=random.Random(self.trace.seed) if self.trace else None
+        )
+        self.post_batch_size = int(os.getenv("POST_BATCH_SIZE") or 1)
+        self.post_batch_deadline = float(os.getenv("POST_BATCH_DEADLINE") or 600)
+
+        # Carousel sets: off | prefix | subfolder
+        self.carousel_grouping = (os.getenv("CAROUSEL_GROUPING") or "off").strip().lower()
+        self.carousel_separator = os.getenv("CAROUSEL_PREFIX_SEPARATOR") or "__"
+
+        # Profiling for slow runs: off | cprofile | sample, written to PROFILE_DIR (job artifact)
+        profile_mode = (os.getenv("PROFILE_MODE") or "off").strip().lower()
+        self.profiler = None
+        if profile_mode != "off":
+            self.profiler = RunProfiler(
+                profile_mode,
+                os.getenv("PROFILE_DIR") or "profiles",
+                top_n=int(os.getenv("PROFILE_TOP") or 30),
+                interval=float(os.getenv("PROFILE_SAMPLE_INTERVAL") or 0.01),
+                import_clocks=(_IMPORTS_STARTED, _IMPORTS_DONE)
+            )
+
+        # Where each post goes, all published concurrently; the first destination is the primary one
+        self.destinations = self.build_destinations(os.getenv("PUBLISH_DESTINATIONS") or "instagram,facebook")
+
+        # Pre-publish normalisation: off | auto (re-encode files outside the Reel spec)
+        self.transcode_mode = (os.getenv("TRANSCODE_MODE") or "off").strip().lower()
+        self.transcode_cache_dir = os.getenv("TRANSCODE_CACHE_DIR") or "state/transcode_cache"
+        self.transcode_cache_file = os.path.join(self.transcode_cache_dir, "index.json")
+        self.transcode_cache = self._load_transcode_cache()
+        self.normalised_folder = f"{self.dropbox_folder}/.normalized"
+        self.normalised_media = {}
+
+    def build_destinations(self, spec):
+        """Destinations from a PUBLISH_DESTINATIONS list such as 'instagram,facebook,facebook:<page id>'."""
+        destinations = []
+        for entry in (e.strip() for e in spec.split(",")):
+            if not entry:
+                continue
+            kind, _, target = entry.partition(":")
+            if kind not in DESTINATIONS:
+                self.logger.warning(f"Unknown publish destination '{entry}' ignored (known: {', '.join(DESTINATIONS)})")
+                continue
+            destinations.append(DESTINATIONS[kind](self, target or None))
+        return destinations
+
+    @property
+    def meta_token(self):
+        """Current Meta user token; may have been exchanged for a fresh long-lived one this run."""
+        return self.tokens.meta_token
+
+    @meta_token.setter
+    def meta_token(self, value):
+        self.tokens.meta_token = value
 
     def send_message(self, msg, level=logging.INFO):
         prefix = f"[{self.script_name}]\n"
         full_msg = prefix + msg
+        self._record_error(msg, level)
         try:
-            if self.telegram_bot and self.telegram_chat_id:
-                self.telegram_bot.send_message(chat_id=self.telegram_chat_id, text=full_msg)
+            if self.telegram_bot and self.telegram_chat_id and self._telegram_allowed():
+                start = time.time()
+                sent = False
+                try:
+                    with profile_phase("telegram"):
+                        self.telegram_bot.send_message(chat_id=self.telegram_chat_id, text=full_msg)
+                    sent = True
+                finally:
+                    self.breakers.record("telegram", sent, time.time() - start)
             # Also log the message to console with the specified level
             if level == logging.ERROR:
                 self.logger.error(full_msg)
@@ -67,10 +250,58 @@ class DropboxToInstagramUploader:
         except Exception as e:
             self.logger.error(f"Telegram send error for message '{full_msg}': {e}")
 
+    async def send_message_async(self, msg, level=logging.INFO):
+        prefix = f"[{self.script_name}]\n"
+        full_msg = prefix + msg
+        self._record_error(msg, level)
+        try:
+            if self.telegram and self.telegram_chat_id and self._telegram_allowed():
+                start = time.time()
+                sent = False
+                try:
+                    with profile_phase("telegram"):
+                        await self.telegram.send_message(chat_id=self.telegram_chat_id, text=full_msg)
+                    sent = True
+                finally:
+                    self.breakers.record("telegram", sent, time.time() - start)
+            if level == logging.ERROR:
+                self.logger.error(full_msg)
+            else:
+                self.logger.info(full_msg)
+        except Exception as e:
+            self.logger.error(f"Telegram send error for message '{full_msg}': {e}")
+
+    def _telegram_allowed(self):
+        """False while the Telegram breaker is open; messages then go to the console only."""
+        try:
+            self.breakers.check("telegram")
+            return True
+        except CircuitOpenError:
+            return False
+
+    def _record_error(self, msg, level):
+        """Attach error messages to the publish record of the current task, if any."""
+        record = _current_record.get()
+        if record is not None and level == logging.ERROR:
+            record.errors.append(msg)
+
+    def _async_dropbox(self, dbx):
+        return AsyncDropboxAdapter(dbx)
+
+    def _run_sync(self, coro):
+        """Run a pipeline coroutine to completion from synchronous code."""
+        async def runner():
+            try:
+                return await coro
+            finally:
+                await self.http.aclose()
+        return asyncio.run(runner())
+
     def log_console_only(self, msg, level=logging.INFO):
         """Log message to console only, not to Telegram."""
         prefix = f"[{self.script_name}]\n"
         full_msg = prefix + msg
+        self._record_error(msg, level)
         if level == logging.ERROR:
             self.logger.error(full_msg)
         else:
@@ -79,18 +310,12 @@ class DropboxToInstagramUploader:
     def send_token_expiry_info(self):
         """Get comprehensive token expiry info using debug_token endpoint."""
         try:
-            url = "https://graph.facebook.com/debug_token"
-            params = {
-                "input_token": self.meta_token,
-                "access_token": self.meta_token
-            }
-            res = self.session.get(url, params=params)
-            
-            if res.status_code != 200:
-                self.send_message(f"❌ Failed to check token: {res.text}", level=logging.ERROR)
+            try:
+                data = self.tokens.debug_meta_token()
+            except RuntimeError as e:
+                self.send_message(f"❌ Failed to check token: {e}", level=logging.ERROR)
                 return
 
-            data = res.json().get("data", {})
             is_valid = data.get("is_valid", False)
             expires_at = data.get("expires_at")  # epoch timestamp
             data_access_expires_at = data.get("data_access_expires_at")  # epoch timestamp
@@ -117,156 +342,214 @@ class DropboxToInstagramUploader:
         except Exception as e:
             self.send_message(f"⚠️ Could not retrieve token expiry info: {str(e)}", level=logging.WARNING)
 
-    def get_page_access_token(self):
-        """Fetch short-lived Page Access Token from long-lived user token."""
+    def get_page_access_token(self, page_id=None):
+        """Page Access Token for page_id (default FB_PAGE_ID), served from the page directory."""
+        page_id = page_id or self.fb_page_id
         try:
-            self.log_console_only("🔐 Fetching Page Access Token from Meta API...", level=logging.INFO)
-            url = f"https://graph.facebook.com/v18.0/me/accounts"
-            params = {"access_token": self.meta_token}
-            
-            self.log_console_only(f"📡 API URL: {url}", level=logging.INFO)
-            
             start_time = time.time()
-            res = self.session.get(url, params=params)
-            request_time = time.time() - start_time
-            
-            self.log_console_only(f"⏱️ Page token request completed in {request_time:.2f} seconds", level=logging.INFO)
-            self.log_console_only(f"📊 Response status: {res.status_code}", level=logging.INFO)
-
-            if res.status_code != 200:
-                self.send_message(f"❌ Failed to fetch Page token: {res.text}", level=logging.ERROR)
+            pages = self.pages.load(self.meta_token)
+            page = pages.get(page_id)
+            if page is None:
+                self.send_message(f"⚠️ Page ID {page_id} not found in user's account list ({len(pages)} pages).", level=logging.WARNING)
+                self.log_console_only("💡 To fix this, update your FB_PAGE_ID environment variable with one of the page IDs listed at the start of the run.", level=logging.INFO)
                 return None
-
-            pages = res.json().get("data", [])
-            self.log_console_only(f"🔍 Found {len(pages)} pages in user account", level=logging.INFO)
-            
-            # Show all available pages with details (console only)
-            self.log_console_only("📋 Available Pages:", level=logging.INFO)
-            for i, page in enumerate(pages):
-                page_id = page.get("id", "Unknown")
-                page_name = page.get("name", "Unknown")
-                category = page.get("category", "Unknown")
-                tasks = page.get("tasks", [])
-                page_access_token = page.get("access_token", "Not available")
-                
-                self.log_console_only(f"📄 Page {i+1}:", level=logging.INFO)
-                self.log_console_only(f"   📝 Name: {page_name}", level=logging.INFO)
-                self.log_console_only(f"   🆔 ID: {page_id}", level=logging.INFO)
-                self.log_console_only(f"   📂 Category: {category}", level=logging.INFO)
-                self.log_console_only(f"   🔧 Tasks: {', '.join(tasks)}", level=logging.INFO)
-                self.log_console_only(f"   🔐 Access Token: {page_access_token[:20]}..." if page_access_token != "Not available" else "   🔐 Access Token: Not available", level=logging.INFO)
-                
-                # Check if this is the target page
-                if page_id == self.fb_page_id:
-                    self.log_console_only(f"   ✅ MATCH FOUND! This is your target page", level=logging.INFO)
-                    
-                    # Use the page access token directly from the response
-                    if page_access_token and page_access_token != "Not available":
-                        self.send_message(f"✅ Page Access Token fetched successfully for: {page_name} (ID: {self.fb_page_id})")
-                        self.log_console_only(f"🔐 Using page access token: {page_access_token[:20]}...", level=logging.INFO)
-                        return page_access_token
-                    else:
-                        self.send_message(f"❌ No access token found for page: {page_name}", level=logging.ERROR)
-                        return None
-                else:
-                    self.log_console_only(f"   ❌ Not matching target page ID: {self.fb_page_id}", level=logging.INFO)
-
-            # If no match found, show configuration help
-            self.send_message(f"⚠️ Page ID {self.fb_page_id} not found in user's account list.", level=logging.WARNING)
-            self.log_console_only("💡 To fix this, update your FB_PAGE_ID environment variable with one of the page IDs shown above.", level=logging.INFO)
-            return None
+            if not page.access_token:
+                self.send_message(f"❌ No access token found for page: {page.name}", level=logging.ERROR)
+                return None
+            self.log_console_only(f"🔐 Page Access Token ready for {page.name} (ID: {page.id}) in {time.time() - start_time:.2f}s", level=logging.INFO)
+            return page.access_token
         except Exception as e:
             self.send_message(f"❌ Exception during Page token fetch: {e}", level=logging.ERROR)
             return None
 
     def refresh_dropbox_token(self):
-        self.logger.info("Refreshing Dropbox token...")
-        data = {
-            "grant_type": "refresh_token",
-            "refresh_token": self.dropbox_refresh,
-            "client_id": self.dropbox_key,
-            "client_secret": self.dropbox_secret,
-        }
-        r = self.session.post(self.DROPBOX_TOKEN_URL, data=data)
-        if r.status_code == 200:
-            new_token = r.json().get("access_token")
-            self.logger.info("Dropbox token refreshed.")
-            return new_token
-        else:
-            self.send_message("❌ Dropbox refresh failed: " + r.text)
+        """Dropbox access token from the token cache, refreshed only when close to expiry."""
+        try:
+            token, refreshed = self.tokens.dropbox_access_token()
+        except Exception as e:
+            self.send_message(f"❌ {e}")
             raise Exception("Dropbox refresh failed.")
+        self.logger.info("Dropbox token refreshed." if refreshed else "Using cached Dropbox token.")
+        return token
+
+    def refresh_meta_token(self):
+        """Exchange META_TOKEN for a fresh long-lived token when it is close to expiry."""
+        try:
+            days_left = self.tokens.refresh_meta_token_if_needed()
+        except Exception as e:
+            self.send_message(f"⚠️ Meta token refresh failed: {e}", level=logging.WARNING)
+            return
+        if days_left is None:
+            return
+        if self.tokens.path:
+            self.send_message(f"🔁 Meta token had {days_left:.1f} days left; exchanged for a fresh long-lived token, cached in TOKEN_CACHE for later runs", level=logging.INFO)
+        else:
+            self.send_message(
+                f"🔁 Meta token has {days_left:.1f} days left; exchanged for a fresh long-lived token for this run only. "
+                f"Rotate the META_TOKEN secret by hand before it expires (or set TOKEN_CACHE to a private path)",
+                level=logging.WARNING
+            )
+
+    @staticmethod
+    def list_folder_entries(dbx, path):
+        """Every entry of a Dropbox folder, following the listing cursor page by page."""
+        result = dbx.files_list_folder(path)
+        while True:
+            yield from result.entries
+            if not result.has_more:
+                return
+            result = dbx.files_list_folder_continue(result.cursor)
 
     def list_dropbox_files(self, dbx):
+        """Postable files in the Dropbox folder as FolderEntry objects."""
         try:
-            files = dbx.files_list_folder(self.dropbox_folder).entries
-            valid_exts = ('.mp4', '.mov', '.jpg', '.jpeg', '.png')
-            return [f for f in files if f.name.lower().endswith(valid_exts)]
+            # Converted as the pages arrive, so the SDK metadata objects are dropped as we go
+            return [entry for entry in map(FolderEntry.from_metadata, self.list_folder_entries(dbx, self.dropbox_folder)) if entry]
         except Exception as e:
             self.send_message(f"❌ Dropbox folder read failed: {e}", level=logging.ERROR)
             return []
 
     def get_caption_from_config(self):
         try:
-            with open(self.schedule_file, 'r') as f:
-                config = json.load(f)
-            
-            # Get today's caption from config
-            today = datetime.now(self.ist).strftime("%A")
-            day_config = config.get(self.account_key, {}).get(today, {})
-            
-            caption = day_config.get("caption", "✨ #inkwisps ✨")
-            description = day_config.get("description", caption)  # Fallback to caption if missing
-            
-            if not caption:
+            # Get today's caption from the validated config (reloaded if the file changed)
+            day_config = self.today_schedule()
+
+            if day_config is None:
                 self.send_message("⚠️ No caption found in config for today", level=logging.WARNING)
-            
-            return caption, description
+                return "✨ #inkwisps ✨", "✨ #inkwisps ✨"
+
+            return day_config.caption, day_config.description
         except Exception as e:
             self.send_message(f"❌ Failed to read caption/description from config: {e}", level=logging.ERROR)
             return "✨ #inkwisps ✨", "✨ #inkwisps ✨"
 
+    def today_schedule(self):
+        """Today's DaySchedule for this account (None if the config has no entry)."""
+        return self.config.get().day(self.account_key, datetime.now(self.ist).strftime("%A"))
+
+    def apply_config_limits(self):
+        """Apply today's posts_per_run / posts_per_day limits. Returns False when today's quota is used up."""
+        try:
+            day_config = self.today_schedule()
+        except Exception:
+            return True
+        limits = day_config.limits if day_config else {}
+        if "posts_per_run" in limits:
+            self.post_batch_size = limits["posts_per_run"]
+        if "posts_per_day" in limits:
+            # The schedule's days are IST days, so count from IST midnight rather than the UTC date
+            midnight = datetime.now(self.ist).replace(hour=0, minute=0, second=0, microsecond=0)
+            posted = self.history.count_since(midnight, account=self.account_key, platform="instagram", outcome="success")
+            left = limits["posts_per_day"] - posted
+            if left <= 0:
+                return False
+            self.post_batch_size = min(self.post_batch_size, left)
+        return True
+
     def build_caption_with_filename(self, file, original_caption):
         base_name = os.path.splitext(file.name)[0]
         base_name = base_name.replace('_', ' ')
         first_line = base_name[:0]
         return f"{first_line}\n\n{original_caption}"
 
-    def post_to_instagram(self, dbx, file, caption, description):
-        name = file.name
-        ext = name.lower()
-        media_type = "REELS" if ext.endswith((".mp4", ".mov")) else "IMAGE"
+    def publish_unit(self, dbx, unit, caption, description):
+        """Sync wrapper around publish_unit_async."""
+        return self._run_sync(self.publish_unit_async(dbx, unit, caption, description))
 
-        self.send_message(f"🚀 Starting upload process for: {name}", level=logging.INFO)
-        
-        temp_link = dbx.files_get_temporary_link(file.path_lower).link
-        file_size = f"{file.size / 1024 / 1024:.2f}MB"
-        total_files = len(self.list_dropbox_files(dbx))
+    async def publish_unit_async(self, dbx, unit, caption, description):
+        """Publish one file or carousel set to every destination concurrently. Returns a PostOutcome."""
+        job = await self.fetch_publish_job_async(dbx, unit, caption, description)
+        results = await asyncio.gather(*(destination.run(job) for destination in self.destinations))
+        return PostOutcome(unit.name, job.media_type, tuple(results))
 
-        self.log_console_only(f"📸 Instagram upload details:\n📂 Type: {media_type}\n📐 Size: {file_size}\n📦 Remaining: {total_files}")
+    async def fetch_publish_job_async(self, dbx, unit, caption, description):
+        """Fetch what the destinations share exactly once: temporary links, the verified Page token and captions."""
+        media_type = media_type_of(unit)
+        members = unit.files if isinstance(unit, CarouselGroup) else [unit]
+        # Upload the normalised copies when the transcoding stage produced them
+        files = [self.normalised_media.get(f.path_lower, f) for f in members]
+
+        if media_type == "CAROUSEL":
+            await self.send_message_async(f"🚀 Starting carousel upload for: {unit.name} ({len(files)} items)", level=logging.INFO)
+        else:
+            await self.send_message_async(f"🚀 Starting upload process for: {unit.name}", level=logging.INFO)
+
+        links = await self.links.get_many(dbx, [f.path_lower for f in files])
+        remaining = len(await asyncio.to_thread(self.list_dropbox_files, dbx))
+        self.log_console_only(f"📤 Upload details:\n📂 Type: {media_type}\n📐 Size: {sum(f.size for f in files) / 1024 / 1024:.2f}MB\n📦 Remaining: {remaining}")
 
-        # Get Facebook page access token for both Instagram and Facebook
         self.log_console_only("🔐 Step 1: Retrieving Facebook Page Access Token...", level=logging.INFO)
-        page_token = self.get_page_access_token()
+        token_start = time.time()
+        page_token = await self.get_verified_page_token_async()
+
+        return PublishJob(
+            unit, dbx, media_type, files, links,
+            self.build_caption_with_filename(unit, caption),
+            self.build_caption_with_filename(unit, description),
+            page_token, remaining,
+            (("page_token", time.time() - token_start),)
+        )
+
+    async def get_verified_page_token_async(self):
+        """Fetch the Page token and check it belongs to the page and its connected Instagram account."""
+        page_token = await asyncio.to_thread(self.get_page_access_token)
         if not page_token:
-            self.send_message("❌ Could not retrieve Facebook Page access token. Aborting upload.", level=logging.ERROR)
-            return False
+            await self.send_message_async("❌ Could not retrieve Facebook Page access token. Aborting upload.", level=logging.ERROR)
+            return None
 
         self.log_console_only("✅ Facebook Page Access Token retrieved successfully", level=logging.INFO)
 
         # Test the page token to ensure it works
-        if not self.test_page_token(page_token):
-            self.send_message("❌ Page token test failed. Aborting upload.", level=logging.ERROR)
-            return False
+        if not await asyncio.to_thread(self.test_page_token, page_token):
+            await self.send_message_async("❌ Page token test failed. Aborting upload.", level=logging.ERROR)
+            return None
 
         # Check if Instagram is properly connected to the Facebook page
-        if not self.check_instagram_page_connection(page_token):
-            self.send_message("❌ Instagram account not properly connected to Facebook page. Aborting upload.", level=logging.ERROR)
-            return False
+        if not await asyncio.to_thread(self.check_instagram_page_connection, page_token):
+            await self.send_message_async("❌ Instagram account not properly connected to Facebook page. Aborting upload.", level=logging.ERROR)
+            return None
+        return page_token
+
+    async def wait_for_instagram_container(self, creation_id, page_token, name):
+        """Poll the container status_code until FINISHED. Returns False on ERROR or timeout."""
+        self.log_console_only("⏳ Step 3: Processing video for Instagram...", level=logging.INFO)
+        processing_start = time.time()
+        for attempt in range(self.INSTAGRAM_REEL_STATUS_RETRIES):
+            self.log_console_only(f"🔄 Processing attempt {attempt + 1}/{self.INSTAGRAM_REEL_STATUS_RETRIES}", level=logging.INFO)
+            
+            status = await self.graph.get(f"{self.INSTAGRAM_API_BASE}/{creation_id}", "container_status", page_token)
+            
+            if not status.ok:
+                await self.send_message_async(f"❌ Status check failed: {status.status}", level=logging.ERROR)
+                return False
+            
+            current_status = status.get("status_code", "UNKNOWN")
+            
+            self.log_console_only(f"📊 Current status: {current_status}", level=logging.INFO)
+            
+            if current_status == "FINISHED":
+                processing_time = time.time() - processing_start
+                self.log_console_only(f"✅ Instagram video processing completed in {processing_time:.2f} seconds!", level=logging.INFO)
+                
+                # Settle after FINISHED before publishing; shortened when the run budget is tight
+                waited = await self.budget.wait(15, "processing")
+                self.log_console_only(f"⏳ Waited {waited:.0f} seconds before publishing", level=logging.INFO)
+                return True
+            elif current_status == "ERROR":
+                await self.send_message_async(f"❌ Instagram processing failed: {name}\n📸 Status: ERROR", level=logging.ERROR)
+                return False
+            
+            self.log_console_only(f"⏳ Waiting {self.INSTAGRAM_REEL_STATUS_WAIT_TIME} seconds before next check...", level=logging.INFO)
+            if not await self.budget.wait(self.INSTAGRAM_REEL_STATUS_WAIT_TIME, "processing"):
+                self.log_console_only("⌛ Processing budget used up, publishing without further checks", level=logging.WARNING)
+                break
 
-        # Build captions with file name as first line
-        caption = self.build_caption_with_filename(file, caption)
-        description = self.build_caption_with_filename(file, description)
+        # Out of retries: keep the old behaviour and let media_publish report the outcome
+        self.log_console_only(f"⚠️ Container {creation_id} still processing after {attempt + 1} checks", level=logging.WARNING)
+        return True
 
+    async def create_instagram_hosted_container(self, name, media_type, temp_link, caption, page_token):
+        """Create an Instagram media container that Meta fetches from the Dropbox link."""
         upload_url = f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media"
         data = {
             "access_token": page_token,
@@ -278,123 +561,163 @@ class DropboxToInstagramUploader:
         else:
             data["image_url"] = temp_link
 
-        self.log_console_only("🔄 Step 2: Sending media creation request to Instagram API...", level=logging.INFO)
         self.log_console_only(f"📡 API URL: {upload_url}", level=logging.INFO)
-        
+
         start_time = time.time()
-        res = self.session.post(upload_url, data=data)
+        res = await self.graph.post(upload_url, data=data)
         request_time = time.time() - start_time
-        
+
         self.log_console_only(f"⏱️ API request completed in {request_time:.2f} seconds", level=logging.INFO)
-        self.log_console_only(f"📊 Response status: {res.status_code}", level=logging.INFO)
-        
-        if res.status_code != 200:
-            err = res.json().get("error", {}).get("message", "Unknown")
-            code = res.json().get("error", {}).get("code", "N/A")
-            self.send_message(f"❌ Instagram upload failed: {name}\n📸 Error: {err}\n📸 Code: {code}\n📸 Status: {res.status_code}", level=logging.ERROR)
-            return False, media_type
+        self.log_console_only(f"📊 Response status: {res.status}", level=logging.INFO)
+
+        if not res.ok:
+            error = res.error or GraphError(res.text, "N/A", "N/A", "N/A")
+            await self.send_message_async(f"❌ Instagram upload failed: {name}\n📸 Error: {error.message}\n📸 Code: {error.code}\n📸 Status: {res.status}", level=logging.ERROR)
+            return None
 
-        creation_id = res.json().get("id")
+        creation_id = res.get("id")
         if not creation_id:
-            self.send_message(f"❌ No media ID returned for: {name}", level=logging.ERROR)
-            return False, media_type
+            await self.send_message_async(f"❌ No media ID returned for: {name}", level=logging.ERROR)
+            return None
+        return creation_id
 
-        self.log_console_only(f"✅ Media creation successful! Creation ID: {creation_id}", level=logging.INFO)
+    def measure_dropbox_throughput(self, temp_link):
+        """Download the first few MB of the Dropbox link and return the throughput in MB/s."""
+        try:
+            headers = {"Range": f"bytes=0-{self.THROUGHPUT_PROBE_BYTES - 1}"}
+            received = 0
+            start_time = time.time()
+            with self.buffers.buffer() as view, \
+                    self.session.get(temp_link, headers=headers, stream=True, timeout=30) as r:
+                if r.status_code not in (200, 206):
+                    self.log_console_only(f"⚠️ Throughput probe returned status {r.status_code}", level=logging.WARNING)
+                    return None
+                for chunk in iter_response_chunks(r, view[:self.THROUGHPUT_PROBE_BYTES]):
+                    received += len(chunk)
+                    if received >= self.THROUGHPUT_PROBE_BYTES:
+                        break
+            elapsed = max(time.time() - start_time, 1e-3)
+            throughput = received / 1024 / 1024 / elapsed
+            self.log_console_only(f"📶 Dropbox throughput: {throughput:.2f} MB/s ({received} bytes in {elapsed:.2f}s)", level=logging.INFO)
+            return throughput
+        except Exception as e:
+            self.log_console_only(f"⚠️ Could not measure Dropbox throughput: {e}", level=logging.WARNING)
+            return None
 
-        if media_type == "REELS":
-            self.log_console_only("⏳ Step 3: Processing video for Instagram...", level=logging.INFO)
-            processing_start = time.time()
-            for attempt in range(self.INSTAGRAM_REEL_STATUS_RETRIES):
-                self.log_console_only(f"🔄 Processing attempt {attempt + 1}/{self.INSTAGRAM_REEL_STATUS_RETRIES}", level=logging.INFO)
-                
-                status_response = self.session.get(
-                    f"{self.INSTAGRAM_API_BASE}/{creation_id}?fields=status_code&access_token={page_token}"
-                )
-                
-                if status_response.status_code != 200:
-                    self.send_message(f"❌ Status check failed: {status_response.status_code}", level=logging.ERROR)
-                    return False
-                
-                status = status_response.json()
-                current_status = status.get("status_code", "UNKNOWN")
-                
-                self.log_console_only(f"📊 Current status: {current_status}", level=logging.INFO)
-                
-                if current_status == "FINISHED":
-                    processing_time = time.time() - processing_start
-                    self.log_console_only(f"✅ Instagram video processing completed in {processing_time:.2f} seconds!", level=logging.INFO)
-                    
-                    # Wait 8 seconds after FINISHED status before publishing (reduced from 15)
-                    self.log_console_only("⏳ Waiting 15 seconds before publishing...", level=logging.INFO)
-                    time.sleep(15)
-                    break
-                elif current_status == "ERROR":
-                    self.send_message(f"❌ Instagram processing failed: {name}\n📸 Status: ERROR", level=logging.ERROR)
+    def choose_instagram_upload_mode(self, file, temp_link):
+        """Pick 'hosted' (Meta fetches video_url) or 'resumable' (we stream bytes to rupload)."""
+        if self.ig_upload_mode in ("hosted", "resumable"):
+            self.log_console_only(f"📦 Instagram upload mode forced by IG_UPLOAD_MODE: {self.ig_upload_mode}", level=logging.INFO)
+            return self.ig_upload_mode
+
+        size_mb = file.size / 1024 / 1024
+        if size_mb < self.RESUMABLE_MIN_SIZE_MB:
+            self.log_console_only(f"📦 Upload mode: hosted ({size_mb:.2f}MB < {self.RESUMABLE_MIN_SIZE_MB}MB)", level=logging.INFO)
+            return "hosted"
+
+        throughput = self.measure_dropbox_throughput(temp_link)
+        if throughput is None or throughput < self.DROPBOX_MIN_THROUGHPUT_MBPS:
+            self.log_console_only(f"📦 Upload mode: hosted (Dropbox throughput too low to stream {size_mb:.2f}MB)", level=logging.INFO)
+            return "hosted"
+
+        self.log_console_only(f"📦 Upload mode: resumable ({size_mb:.2f}MB at {throughput:.2f} MB/s)", level=logging.INFO)
+        return "resumable"
+
+    async def create_instagram_resumable_container(self, file, temp_link, caption, page_token):
+        """Create a REELS container with upload_type=resumable and stream the file to rupload."""
+        try:
+            upload_url = f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media"
+            data = {
+                "access_token": page_token,
+                "caption": caption,
+                "media_type": "REELS",
+                "upload_type": "resumable",
+                "share_to_feed": "false"
+            }
+            self.log_console_only(f"📡 API URL (resumable): {upload_url}", level=logging.INFO)
+            res = await self.graph.post(upload_url, data=data)
+            self.log_console_only(f"📊 Response status: {res.status}", level=logging.INFO)
+            if not res.ok:
+                self.log_console_only(f"❌ Resumable container creation failed: {res.error_message}", level=logging.ERROR)
+                return None
+
+            creation_id = res.get("id")
+            if not creation_id:
+                self.log_console_only(f"❌ No container ID returned for resumable upload: {res.text}", level=logging.ERROR)
+                return None
+            rupload_url = res.get("uri") or f"{self.INSTAGRAM_RUPLOAD_BASE}/{creation_id}"
+
+            if await self.upload_instagram_resumable(rupload_url, creation_id, temp_link, file.size, page_token):
+                return creation_id
+            return None
+        except Exception as e:
+            self.log_console_only(f"❌ Exception during resumable upload: {e}", level=logging.ERROR)
+            return None
+
+    async def get_resumable_offset(self, creation_id, page_token, fallback):
+        """Bytes Meta has accepted for a resumable container (video_status.uploading_phase.bytes_transferred)."""
+        try:
+            res = await self.graph.get(f"{self.INSTAGRAM_API_BASE}/{creation_id}", "resumable_container", page_token)
+            uploading = (res.get("video_status") or {}).get("uploading_phase") or {}
+            if res.ok and uploading.get("bytes_transferred") is not None:
+                return int(uploading["bytes_transferred"])
+            problem = res.error_message if not res.ok else "no uploading_phase.bytes_transferred in video_status"
+        except Exception as e:
+            problem = e
+        self.log_console_only(f"⚠️ Could not read the uploaded byte count of container {creation_id} ({problem}); resuming from local offset {fallback}", level=logging.WARNING)
+        return fallback
+
+    def send_resumable_chunks(self, rupload_url, temp_link, file_size, page_token, progress):
+        """Stream the Dropbox file to rupload from progress["offset"], advancing it as chunks are accepted."""
+        offset = progress["offset"]
+        headers = {"Range": f"bytes={offset}-"}
+        with self.buffers.buffer() as view, \
+                self.session.get(temp_link, headers=headers, stream=True, timeout=60) as source:
+            if source.status_code not in (200, 206):
+                raise Exception(f"Dropbox returned status {source.status_code}")
+            if source.status_code == 200 and offset:
+                raise Exception("Dropbox ignored Range header, cannot resume")
+            for chunk in iter_response_chunks(source, view[:self.RESUMABLE_CHUNK_SIZE]):
+                upload_headers = {
+                    "Authorization": f"OAuth {page_token}",
+                    "offset": str(offset),
+                    "file_size": str(file_size),
+                }
+                res = self.session.post(rupload_url, headers=upload_headers, data=chunk, timeout=120)
+                if res.status_code != 200:
+                    raise Exception(f"rupload returned {res.status_code}: {res.text}")
+                offset += len(chunk)
+                progress["offset"] = offset
+                self.log_console_only(f"⬆️ Uploaded {offset}/{file_size} bytes", level=logging.INFO)
+        if offset < file_size:
+            raise Exception(f"Dropbox stream ended early at {offset}/{file_size} bytes")
+
+    async def upload_instagram_resumable(self, rupload_url, creation_id, temp_link, file_size, page_token):
+        """Stream the Dropbox file to rupload in chunks, resuming from the offset the container reports."""
+        self.log_console_only(f"⬆️ Streaming {file_size / 1024 / 1024:.2f}MB to {rupload_url}", level=logging.INFO)
+        upload_start = time.time()
+        progress = {"offset": 0}
+        failures = 0
+        while progress["offset"] < file_size:
+            try:
+                await asyncio.to_thread(self.send_resumable_chunks, rupload_url, temp_link, file_size, page_token, progress)
+            except Exception as e:
+                failures += 1
+                self.log_console_only(f"⚠️ Resumable upload interrupted at offset {progress['offset']}: {e}", level=logging.WARNING)
+                if failures > self.RESUMABLE_CHUNK_RETRIES:
+                    self.log_console_only("❌ Resumable upload gave up after too many failures", level=logging.ERROR)
                     return False
-                
-                self.log_console_only(f"⏳ Waiting {self.INSTAGRAM_REEL_STATUS_WAIT_TIME} seconds before next check...", level=logging.INFO)
-                time.sleep(self.INSTAGRAM_REEL_STATUS_WAIT_TIME)
+                progress["offset"] = await self.get_resumable_offset(creation_id, page_token, progress["offset"])
 
-        self.log_console_only("📤 Step 4: Publishing to Instagram...", level=logging.INFO)
-        publish_url = f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media_publish"
-        publish_data = {"creation_id": creation_id, "access_token": page_token}
-        
-        self.log_console_only(f"📡 Publishing to: {publish_url}", level=logging.INFO)
-        
-        publish_start = time.time()
-        pub = self.session.post(publish_url, data=publish_data)
-        publish_time = time.time() - publish_start
-        
-        self.log_console_only(f"⏱️ Publish request completed in {publish_time:.2f} seconds", level=logging.INFO)
-        self.log_console_only(f"📊 Publish response status: {pub.status_code}", level=logging.INFO)
-        
-        # Track Instagram and Facebook results separately
-        instagram_success = False
-        facebook_success = False
-        
-        if pub.status_code == 200:
-            response_data = pub.json()
-            instagram_id = response_data.get("id", "Unknown")
-            
-            if not instagram_id:
-                self.send_message("⚠️ Instagram publish succeeded but no media ID returned", level=logging.WARNING)
-                instagram_success = False
-            else:
-                self.send_message(f"✅ Instagram post published successfully!\n📸 Media ID: {instagram_id}\n📸 Account ID: {self.ig_id}\n📦 Files left: {total_files - 1}")
-                instagram_success = True
-                
-                # Verify the post is live using the published media_id (not creation_id)
-                self.verify_instagram_post_by_media_id(instagram_id, page_token)
-            
-            # Also post to Facebook Page for both REELS and IMAGE
-            if media_type == "REELS":
-                self.log_console_only("📘 Step 5: Starting Facebook Page upload...", level=logging.INFO)
-                facebook_success = self.post_to_facebook_page(dbx, file, caption, page_token)
-            elif media_type == "IMAGE":
-                self.log_console_only("📘 Step 5: Starting Facebook Page upload for image...", level=logging.INFO)
-                facebook_success = self.post_to_facebook_page(dbx, file, caption, page_token)
-                # Telegram log for Facebook image upload
-                if facebook_success:
-                    self.send_message(f"✅ Facebook Page photo published successfully for file: {file.name}", level=logging.INFO)
-                else:
-                    self.send_message(f"❌ Facebook Page photo upload failed for file: {file.name}", level=logging.ERROR)
-            else:
-                facebook_success = True  # No Facebook post needed for other types
-            
-            # Return success status for both platforms
-            return True, media_type, instagram_success, facebook_success
-        else:
-            error_msg = pub.json().get("error", {}).get("message", "Unknown error")
-            error_code = pub.json().get("error", {}).get("code", "N/A")
-            self.send_message(f"❌ Instagram publish failed: {name}\n📸 Error: {error_msg}\n📸 Code: {error_code}\n📸 Status: {pub.status_code}", level=logging.ERROR)
-            # Do not attempt verification with creation_id, as it is invalid after publish
-            return False, media_type, instagram_success, facebook_success
+        upload_time = time.time() - upload_start
+        self.log_console_only(f"✅ Resumable upload finished in {upload_time:.2f} seconds", level=logging.INFO)
+        return True
 
     def is_supported_aspect_ratio(self, video_path):
-        clip = VideoFileClip(video_path)
-        width, height = clip.size
+        with VideoFileClip(video_path) as clip:
+            width, height = clip.size
+            duration = clip.duration
         aspect_ratio = width / height
-        duration = clip.duration
         self.log_console_only(f"🎬 Video duration: {duration:.2f}s", level=logging.INFO)
         if duration < 3 or duration > 90:
             self.send_message(f'❌ Video duration {duration:.2f}s not supported for Reels (must be 3–90s).', level=logging.ERROR)
@@ -403,228 +726,324 @@ class DropboxToInstagramUploader:
 
     def get_video_aspect_and_duration(self, video_url):
         """Download video to temp file, return (aspect_ratio, duration, temp_file_path)."""
-        import tempfile
-        import requests
         temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4')
-        with requests.get(video_url, stream=True) as r:
-            r.raise_for_status()
-            for chunk in r.iter_content(chunk_size=8192):
-                temp_file.write(chunk)
         temp_file.close()
-        from moviepy.editor import VideoFileClip
-        clip = VideoFileClip(temp_file.name)
-        width, height = clip.size
+        self.stream_download(video_url, temp_file.name)
+        with VideoFileClip(temp_file.name) as clip:
+            width, height = clip.size
+            duration = clip.duration
         aspect_ratio = width / height
-        duration = clip.duration
         return aspect_ratio, duration, temp_file.name
 
+    async def record_media_metadata(self, record, dbx, file):
+        """Store width/height/duration of the file on its history record (best effort)."""
+        try:
+            width, height, duration = await asyncio.to_thread(self.get_dropbox_video_metadata, dbx, file)
+            aspect_ratio = width / height if width and height else None
+            record.update(width=width, height=height, duration=duration, aspect_ratio=aspect_ratio)
+        except Exception as e:
+            self.log_console_only(f"⚠️ Could not read media metadata for history: {e}", level=logging.WARNING)
+
     def get_dropbox_video_metadata(self, dbx, file):
-        """Get width, height, duration from Dropbox file metadata (no download)."""
-        from dropbox.files import VideoMetadata, PhotoMetadata
-        metadata = dbx.files_get_metadata(file.path_lower, include_media_info=True)
-        if hasattr(metadata, 'media_info') and metadata.media_info:
-            info = metadata.media_info.get_metadata()
-            width = None
-            height = None
-            if getattr(info, 'dimensions', None) is not None:
-                width = info.dimensions.width
-                height = info.dimensions.height
-            if isinstance(info, VideoMetadata):
-                duration = info.duration / 1000.0  # ms to seconds
-            else:
-                duration = None
-            return width, height, duration
-        return None, None, None
-
-    def post_to_facebook_page(self, dbx, file, caption, page_token=None, as_reel=None):
-        """Publish the video to the Facebook Page as a Reel or regular video. Uses Dropbox metadata for decision."""
-        import requests
-        import os
-        media_url = dbx.files_get_temporary_link(file.path_lower).link
-        if not self.fb_page_id:
-            self.send_message("⚠️ Facebook Page ID not configured, skipping Facebook post", level=logging.WARNING)
-            return False
-        if not page_token:
-            self.log_console_only("🔐 Fetching fresh Facebook Page Access Token...", level=logging.INFO)
-            page_token = self.get_page_access_token()
-            if not page_token:
-                self.send_message("❌ Could not retrieve Facebook Page access token. Aborting Facebook upload.", level=logging.ERROR)
-                return False
-        else:
-            self.log_console_only("🔐 Using shared Facebook Page Access Token for Facebook upload", level=logging.INFO)
-        # Use Dropbox metadata for decision
-        width, height, duration = self.get_dropbox_video_metadata(dbx, file)
-        aspect_ratio = width / height if width and height else None
-        decision_msg = f"\n📦 File: {file.name}\n📏 Width: {width}\n📏 Height: {height}\n⏱️ Duration: {duration}s\n📐 Aspect Ratio: {aspect_ratio:.4f}" if aspect_ratio else f"\n📦 File: {file.name}\n📏 Width: {width}\n📏 Height: {height}\n⏱️ Duration: {duration}s\n📐 Aspect Ratio: N/A"
-        # Strict 9:16 check for Reels
-        if width is not None and height is not None and duration is not None and aspect_ratio is not None:
-            # Only allow strict 9:16 portrait (e.g., 1080x1920, 720x1280) for Facebook Reels
-            if height >= 960 and width >= 540 and abs(aspect_ratio - 0.5625) < 0.01:
-                as_reel = True
-                decision_msg += "\n🚀 Will upload as: Facebook Reel (strict 9:16 portrait)"
-                self.log_console_only("✅ Strict 9:16 portrait detected. Will upload as Facebook Reel.", level=logging.INFO)
-            else:
-                as_reel = False
-                decision_msg += f"\n🚀 Will upload as: Regular Facebook Video (aspect ratio: {aspect_ratio:.4f})"
-                self.log_console_only(f"❌ Not strict 9:16 portrait (aspect ratio: {aspect_ratio:.4f}). Will upload as regular Facebook video.", level=logging.INFO)
+        """Get width, height, duration from the media index, else from Dropbox file metadata (no download)."""
+        indexed = self.media_index.get(getattr(file, "content_hash", None))
+        if indexed and not indexed["error"] and indexed["width"] and indexed["height"]:
+            return indexed["width"], indexed["height"], indexed["duration"]
+        if isinstance(file, FolderEntry) and file.width and file.height:
+            return file.width, file.height, file.duration
+        width, height, duration = media_dimensions(dbx.files_get_metadata(file.path_lower, include_media_info=True))
+        if isinstance(file, FolderEntry):
+            file.width, file.height, file.duration = width, height, duration
+        return width, height, duration
+
+    def list_carousel_groups(self, dbx, files):
+        """Group related files into carousels by CAROUSEL_GROUPING (prefix or subfolder)."""
+        sets = {}
+        folders = {}
+        if self.carousel_grouping == "prefix":
+            for file in files:
+                if self.carousel_separator in file.name:
+                    sets.setdefault(file.name.split(self.carousel_separator, 1)[0], []).append(file)
+        elif self.carousel_grouping == "subfolder":
+            try:
+                entries = list(self.list_folder_entries(dbx, self.dropbox_folder))
+                for folder in (e for e in entries if isinstance(e, dropbox.files.FolderMetadata) and not e.name.startswith(".")):
+                    children = self.list_folder_entries(dbx, folder.path_lower)
+                    sets[folder.name] = [entry for entry in map(FolderEntry.from_metadata, children) if entry]
+                    folders[folder.name] = folder.path_lower
+            except Exception as e:
+                self.send_message(f"❌ Dropbox carousel folder read failed: {e}", level=logging.ERROR)
+                return {}
+        groups = {}
+        for name, members in sets.items():
+            if len(members) < 2:
+                continue
+            members = sorted(members, key=lambda f: f.name)[:self.CAROUSEL_MAX_ITEMS]
+            groups[name] = CarouselGroup(name, members, folders.get(name))
+        return groups
+
+    def group_batch(self, batch, groups):
+        """Replace files that belong to a carousel set by their group, keeping order and dropping duplicates."""
+        by_path = {f.path_lower: group for group in groups.values() for f in group.files}
+        units, seen = [], set()
+        for file in batch:
+            unit = by_path.get(file.path_lower, file)
+            if id(unit) not in seen:
+                seen.add(id(unit))
+                units.append(unit)
+        return units
+
+    async def create_carousel_item_container(self, file, link, page_token):
+        data = {"is_carousel_item": "true", "access_token": page_token}
+        if file.name.lower().endswith((".mp4", ".mov")):
+            data.update({"media_type": "VIDEO", "video_url": link})
         else:
-            self.log_console_only("Could not get Dropbox video metadata, defaulting to regular video.", level=logging.WARNING)
-            as_reel = False
-            decision_msg += "\n🚀 Will upload as: Regular Facebook Video (metadata unavailable)"
-        self.send_message(decision_msg, level=logging.INFO)
-        if as_reel:
-            self.log_console_only("📘 Starting Facebook Page upload (Reels API, hosted file)...", level=logging.INFO)
-            # 1. Start upload session
-            start_url = f"https://graph.facebook.com/v23.0/{self.fb_page_id}/video_reels"
-            start_data = {"upload_phase": "start", "access_token": page_token}
-            start_res = self.session.post(start_url, data=start_data)
-            if start_res.status_code != 200:
-                self.send_message(f"❌ Failed to start Facebook Reels upload session: {start_res.text}", level=logging.ERROR)
-                return False
-            video_id = start_res.json().get("video_id")
-            upload_url = start_res.json().get("upload_url")
-            if not video_id or not upload_url:
-                self.send_message(f"❌ No video_id or upload_url returned: {start_res.text}", level=logging.ERROR)
+            data["image_url"] = link
+        res = await self.graph.post(f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/media", data=data)
+        if not res.ok:
+            self.log_console_only(f"❌ Carousel item failed for {file.name}: {res.error_message}", level=logging.ERROR)
+            return None
+        return res.get("id")
+
+    async def wait_for_instagram_containers(self, container_ids, page_token, name):
+        """Poll several containers with a single ?ids= request per attempt until all are FINISHED."""
+        pending = set(container_ids)
+        for attempt in range(self.INSTAGRAM_REEL_STATUS_RETRIES):
+            res = await self.graph.get(f"{self.INSTAGRAM_API_BASE}/", "container_status", page_token, ids=",".join(sorted(pending)))
+            if not res.ok:
+                await self.send_message_async(f"❌ Status check failed: {res.status}", level=logging.ERROR)
                 return False
-            # 2. Upload video using hosted file (Dropbox temp link)
-            headers = {
-                "Authorization": f"OAuth {page_token}",
-                "file_url": media_url
-            }
-            upload_res = self.session.post(upload_url, headers=headers)
-            if upload_res.status_code != 200:
-                self.send_message(f"❌ Facebook Reels video upload (hosted file) failed: {upload_res.text}", level=logging.ERROR)
+            statuses = {cid: data.get("status_code", "UNKNOWN") for cid, data in res.data.items()}
+            self.log_console_only(f"📊 Container status ({attempt + 1}/{self.INSTAGRAM_REEL_STATUS_RETRIES}): {statuses}", level=logging.INFO)
+            if "ERROR" in statuses.values():
+                await self.send_message_async(f"❌ Instagram processing failed: {name}\n📸 Status: ERROR", level=logging.ERROR)
                 return False
-            # 3. Finish and publish
-            finish_data = {
-                "upload_phase": "finish",
-                "access_token": page_token,
-                "video_id": video_id,
-                "description": caption,
-                "video_state": "PUBLISHED",
-                "share_to_feed": "true"
-            }
-            finish_res = self.session.post(start_url, data=finish_data)
-            if finish_res.status_code == 200:
-                response_data = finish_res.json()
-                fb_video_id = response_data.get("id", video_id)
-                self.send_message(f"✅ Facebook Reel published successfully!\n📘 Video ID: {fb_video_id}\n📘 Page ID: {self.fb_page_id}")
-                self.verify_facebook_post_by_video_id(fb_video_id, page_token)
-                # Fetch and log the list of Reels for the Page
-                try:
-                    reels_url = f'https://graph.facebook.com/v23.0/{self.fb_page_id}/video_reels?access_token={page_token}'
-                    reels_res = self.session.get(reels_url)
-                    self.log_console_only(f'📄 Reels list response: {reels_res.text}', level=logging.INFO)
-                except Exception as e:
-                    self.log_console_only(f'⚠️ Could not fetch Reels list: {e}', level=logging.WARNING)
+            pending -= {cid for cid, status in statuses.items() if status == "FINISHED"}
+            if not pending:
                 return True
-            else:
-                self.send_message(f"❌ Facebook Reels publish failed: {finish_res.text}", level=logging.ERROR)
-                return False
-        else:
-            self.log_console_only("📘 Starting Facebook Page upload (Regular Video)...", level=logging.INFO)
-            # Detect if file is an image
-            image_exts = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp')
-            is_image = file.name.lower().endswith(image_exts)
-            if is_image:
-                self.log_console_only("🖼️ Detected image file. Uploading as Facebook photo.", level=logging.INFO)
-                self.send_message(f"\n📦 File: {file.name}\n🖼️ Will upload as: Facebook Photo", level=logging.INFO)
-                post_url = f"https://graph.facebook.com/{self.fb_page_id}/photos"
-                self.log_console_only(f"🌐 Dropbox image URL: {media_url}", level=logging.INFO)
-                # Check if Dropbox link is accessible
-                try:
-                    check_res = requests.get(media_url, timeout=10)
-                    if check_res.status_code == 200:
-                        self.log_console_only(f"✅ Dropbox link is accessible (status 200)", level=logging.INFO)
-                    else:
-                        self.log_console_only(f"❌ Dropbox link returned status {check_res.status_code}", level=logging.ERROR)
-                except Exception as e:
-                    self.log_console_only(f"❌ Exception checking Dropbox link: {e}", level=logging.ERROR)
-                data = {
-                    "access_token": page_token,
-                    "url": media_url,
-                    "caption": caption
-                }
+            if not await self.budget.wait(self.INSTAGRAM_REEL_STATUS_WAIT_TIME, "processing"):
+                break
+        await self.send_message_async(f"❌ Carousel items still processing after {attempt + 1} checks: {name}", level=logging.ERROR)
+        return False
+
+    def _load_transcode_cache(self):
+        try:
+            with open(self.transcode_cache_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_transcode_cache(self):
+        os.makedirs(os.path.dirname(self.transcode_cache_file) or ".", exist_ok=True)
+        with open(self.transcode_cache_file, "w") as f:
+            json.dump(self.transcode_cache, f, indent=2)
+
+    def download_dropbox_file(self, dbx, file, local_path):
+        link = self.links.get(dbx, file.path_lower)
+        return self.stream_download(link, local_path)
+
+    def stream_download(self, url, local_path, timeout=60):
+        """Stream url to local_path through a pooled buffer. Returns the number of bytes written."""
+        written = 0
+        with self.buffers.buffer() as view, self.session.get(url, stream=True, timeout=timeout) as r:
+            r.raise_for_status()
+            expected = int(r.headers.get("Content-Length") or 0)
+            with open(local_path, "wb") as f:
+                for chunk in iter_response_chunks(r, view):
+                    f.write(chunk)
+                    written += len(chunk)
+        if written < expected:
+            raise IOError(f"Download of {url} ended early at {written}/{expected} bytes")
+        return written
+
+    async def probe_url_async(self, url, timeout=10):
+        """Accessibility check without downloading: HEAD, falling back to a one-byte Range GET."""
+        res = await self.http.head(url, timeout=timeout)
+        if res.status_code in (403, 405, 501):
+            # Some hosts reject HEAD; the first byte is enough to prove the link works
+            res = await self.http.get(url, headers={"Range": "bytes=0-0"}, timeout=timeout)
+        return res.status_code
+
+    def upload_to_dropbox(self, dbx, local_path, dropbox_path):
+        """Upload a local file, switching to an upload session above DROPBOX_UPLOAD_CHUNK bytes."""
+        size = os.path.getsize(local_path)
+        mode = dropbox.files.WriteMode.overwrite
+        with open(local_path, "rb") as f:
+            if size <= self.DROPBOX_UPLOAD_CHUNK:
+                return dbx.files_upload(f.read(), dropbox_path, mode=mode)
+            session = dbx.files_upload_session_start(f.read(self.DROPBOX_UPLOAD_CHUNK))
+            cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=f.tell())
+            commit = dropbox.files.CommitInfo(path=dropbox_path, mode=mode)
+            while size - f.tell() > self.DROPBOX_UPLOAD_CHUNK:
+                dbx.files_upload_session_append_v2(f.read(self.DROPBOX_UPLOAD_CHUNK), cursor)
+                cursor.offset = f.tell()
+            return dbx.files_upload_session_finish(f.read(self.DROPBOX_UPLOAD_CHUNK), cursor, commit)
+
+    async def prepare_media_async(self, dbx, units):
+        """Normalise every Reel in units to the Reel spec in a process pool, caching by content hash."""
+        if self.transcode_mode != "auto":
+            return
+        adbx = self._async_dropbox(dbx)
+        videos = []
+        for unit in units:
+            for file in (unit.files if isinstance(unit, CarouselGroup) else [unit]):
+                if file.name.lower().endswith((".mp4", ".mov")):
+                    videos.append(file)
+
+        jobs = []
+        for file in videos:
+            cached = self.transcode_cache.get(file.content_hash)
+            indexed = self.media_index.get(file.content_hash)
+            if indexed and not indexed["error"] and plan_normalisation(indexed)[0] is None:
+                cached = {"action": "none"}
+            if cached and cached["action"] == "none":
+                self.log_console_only(f"🎞️ {file.name} already in Reel spec (cached)", level=logging.INFO)
+                continue
+            if cached and cached.get("dropbox_path"):
                 try:
-                    self.log_console_only("🔄 Sending image upload request to Facebook API...", level=logging.INFO)
-                    self.log_console_only(f"📡 Facebook API URL: {post_url}", level=logging.INFO)
-                    res = self.session.post(post_url, data=data)
-                    self.log_console_only(f"📊 Facebook response status: {res.status_code}", level=logging.INFO)
-                    try:
-                        response_json = res.json()
-                        self.log_console_only(f"📄 Facebook response: {json.dumps(response_json, indent=2)}", level=logging.INFO)
-                    except:
-                        self.log_console_only(f"📄 Facebook response text: {res.text}", level=logging.INFO)
-                    if res.status_code == 200:
-                        photo_id = res.json().get("id", "Unknown")
-                        self.send_message(f"✅ Facebook Page photo published successfully!\n🖼️ Photo ID: {photo_id}\n📘 Page ID: {self.fb_page_id}")
-                        return True
-                    else:
-                        error_msg = res.json().get("error", {}).get("message", "Unknown error")
-                        self.send_message(f"❌ Facebook Page photo upload failed: {error_msg}", level=logging.ERROR)
-                        return False
-                except Exception as e:
-                    self.send_message(f"❌ Facebook Page photo upload exception:\n🖼️ Error: {str(e)}", level=logging.ERROR)
-                    return False
-            else:
-                self.log_console_only("📘 Starting Facebook Page upload (Regular Video)...", level=logging.INFO)
-                post_url = f"https://graph.facebook.com/{self.fb_page_id}/videos"
-                data = {
-                    "access_token": page_token,
-                    "file_url": media_url,
-                    "description": caption
-                }
-                self.log_console_only(f"🔐 Using page token for Facebook upload: {page_token[:20]}...", level=logging.INFO)
-                self.log_console_only(f"📄 Page ID for upload: {self.fb_page_id}", level=logging.INFO)
-                self.log_console_only(f"📹 Video URL: {media_url[:50]}...", level=logging.INFO)
-                self.log_console_only(f"📝 Caption: {caption[:50]}...", level=logging.INFO)
-                self.log_console_only("🔄 Skipping token verification for Facebook upload...", level=logging.INFO)
+                    metadata = await adbx.files_get_metadata(cached["dropbox_path"])
+                    self.normalised_media[file.path_lower] = NormalisedFile(file, metadata)
+                    self.log_console_only(f"🎞️ Using cached normalised copy for {file.name}", level=logging.INFO)
+                    continue
+                except Exception:
+                    self.transcode_cache.pop(file.content_hash, None)
+            jobs.append(file)
+        if not jobs:
+            return
+
+        os.makedirs(self.transcode_cache_dir, exist_ok=True)
+        workdir = tempfile.mkdtemp(dir=self.transcode_cache_dir)
+        loop = asyncio.get_running_loop()
+        started = time.time()
+        try:
+            sources = {}
+            for file in jobs:
+                src = os.path.join(workdir, f"src_{file.content_hash}{os.path.splitext(file.name)[1].lower()}")
+                sources[file.path_lower] = src
+            await asyncio.gather(*(asyncio.to_thread(self.download_dropbox_file, dbx, f, sources[f.path_lower]) for f in jobs))
+
+            with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as pool:
+                results = await asyncio.gather(*(
+                    loop.run_in_executor(pool, normalise_media, sources[f.path_lower],
+                                         os.path.join(workdir, f"{f.content_hash}.mp4"))
+                    for f in jobs
+                ), return_exceptions=True)
+
+            for file, result in zip(jobs, results):
+                if isinstance(result, Exception):
+                    self.log_console_only(f"⚠️ Normalisation failed for {file.name}, uploading original: {result}", level=logging.WARNING)
+                    continue
+                if result["action"] == "none":
+                    self.transcode_cache[file.content_hash] = {"action": "none"}
+                    self.log_console_only(f"🎞️ {file.name} already in Reel spec", level=logging.INFO)
+                    continue
+                dropbox_path = f"{self.normalised_folder}/{file.content_hash}.mp4"
+                metadata = await asyncio.to_thread(self.upload_to_dropbox, dbx, result["output"], dropbox_path)
+                self.normalised_media[file.path_lower] = NormalisedFile(file, metadata)
+                self.transcode_cache[file.content_hash] = {"action": result["action"], "dropbox_path": metadata.path_lower}
+                self.send_message(f"🎞️ Normalised {file.name} ({result['action']}: {', '.join(result['reasons'])})", level=logging.INFO)
+            self._save_transcode_cache()
+        except Exception as e:
+            self.log_console_only(f"⚠️ Media normalisation stage failed, uploading originals: {e}", level=logging.WARNING)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            self.log_console_only(f"⏱️ Normalisation stage took {time.time() - started:.2f} seconds for {len(jobs)} file(s)", level=logging.INFO)
+
+    def analyze_folder(self):
+        """Bulk 'analyze' command: index media metadata for every file not analysed yet."""
+        dbx = self.authenticate_dropbox()
+        files = self.list_dropbox_files(dbx)
+        if self.carousel_grouping == "subfolder":
+            files += [f for group in self.list_carousel_groups(dbx, files).values() for f in group.files]
+        known = self.media_index.known_hashes()
+        pending = [f for f in files if f.content_hash not in known]
+        self.log_console_only(f"🔬 {len(files)} media files, {len(pending)} not analysed yet", level=logging.INFO)
+        if pending:
+            self._run_sync(self.analyze_files_async(dbx, pending))
+        self.log_console_only(f"🏁 Analysis complete in {time.time() - self.start_time:.1f} seconds", level=logging.INFO)
+
+    async def analyze_files_async(self, dbx, files):
+        """Download files in bounded chunks and probe them in a process pool across all cores."""
+        workers = os.cpu_count() or 1
+        chunk_size = workers * 2  # bounds temp disk usage to a couple of files per core
+        loop = asyncio.get_running_loop()
+        os.makedirs(self.transcode_cache_dir, exist_ok=True)
+        analysed = failed = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(files), chunk_size):
+                chunk = files[start:start + chunk_size]
+                workdir = tempfile.mkdtemp(dir=self.transcode_cache_dir)
                 try:
-                    self.log_console_only("🔄 Sending request to Facebook API...", level=logging.INFO)
-                    self.log_console_only(f"📡 Facebook API URL: {post_url}", level=logging.INFO)
-                    start_time = time.time()
-                    res = self.session.post(post_url, data=data)
-                    request_time = time.time() - start_time
-                    self.log_console_only(f"⏱️ Facebook API request completed in {request_time:.2f} seconds", level=logging.INFO)
-                    self.log_console_only(f"📊 Facebook response status: {res.status_code}", level=logging.INFO)
-                    try:
-                        response_json = res.json()
-                        self.log_console_only(f"📄 Facebook response: {json.dumps(response_json, indent=2)}", level=logging.INFO)
-                    except:
-                        self.log_console_only(f"📄 Facebook response text: {res.text}", level=logging.INFO)
-                    if res.status_code == 200:
-                        response_data = res.json()
-                        video_id = response_data.get("id", "Unknown")
-                        self.send_message(f"✅ Facebook Page post published successfully!\n📘 Video ID: {video_id}\n📘 Page ID: {self.fb_page_id}")
-                        self.verify_facebook_post_by_video_id(video_id, page_token)
-                        return True
-                    else:
-                        error_msg = res.json().get("error", {}).get("message", "Unknown error")
-                        error_code = res.json().get("error", {}).get("code", "N/A")
-                        error_subcode = res.json().get("error", {}).get("error_subcode", "N/A")
-                        error_type = res.json().get("error", {}).get("type", "N/A")
-                        self.send_message(f"❌ Facebook Page upload failed:", level=logging.ERROR)
-                        self.send_message(f"📘 Error: {error_msg}", level=logging.ERROR)
-                        self.send_message(f"📘 Code: {error_code}", level=logging.ERROR)
-                        self.send_message(f"📘 Subcode: {error_subcode}", level=logging.ERROR)
-                        self.send_message(f"📘 Type: {error_type}", level=logging.ERROR)
-                        self.send_message(f"📘 Status: {res.status_code}", level=logging.ERROR)
-                        self.send_message("⚠️ Facebook upload failed, but Instagram upload was successful", level=logging.WARNING)
-                        return False
-                except Exception as e:
-                    self.send_message(f"❌ Facebook Page upload exception:\n📘 Error: {str(e)}", level=logging.ERROR)
-                    self.send_message("⚠️ Facebook upload exception, but Instagram upload was successful", level=logging.WARNING)
-                    return False
+                    paths = [os.path.join(workdir, f"{i}{os.path.splitext(f.name)[1].lower()}") for i, f in enumerate(chunk)]
+                    downloads = await asyncio.gather(*(
+                        asyncio.to_thread(self.download_dropbox_file, dbx, f, p) for f, p in zip(chunk, paths)
+                    ), return_exceptions=True)
+                    probes = await asyncio.gather(*(
+                        loop.run_in_executor(pool, analyse_media_file, p)
+                        for p, d in zip(paths, downloads) if not isinstance(d, Exception)
+                    ), return_exceptions=True)
+                    probes = iter(probes)
+                    for file, download in zip(chunk, downloads):
+                        result = download if isinstance(download, Exception) else next(probes)
+                        base = {"path": file.path_lower, "name": file.name, "size": file.size}
+                        if isinstance(result, Exception):
+                            failed += 1
+                            self.media_index.put(file.content_hash, error=str(result), **base)
+                            self.log_console_only(f"⚠️ Could not analyse {file.name}: {result}", level=logging.WARNING)
+                        else:
+                            analysed += 1
+                            self.media_index.put(file.content_hash, **base, **result)
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                self.log_console_only(f"🔬 Analysed {min(start + chunk_size, len(files))}/{len(files)} files", level=logging.INFO)
+        self.send_message(f"🔬 Media analysis finished: {analysed} indexed, {failed} failed", level=logging.INFO)
+
+    def validate_for_posting(self, file):
+        """Check a file against Reels limits using only the media index. Unindexed files pass."""
+        info = self.media_index.get(getattr(file, "content_hash", None))
+        if not info or info["error"] or info["media_type"] != "REELS":
+            return True, None
+        duration = info["duration"]
+        if duration is not None and (duration < 3 or duration > 90):
+            return False, f"duration {duration:.2f}s outside 3–90s"
+        aspect_ratio = info["aspect_ratio"]
+        if self.transcode_mode != "auto" and aspect_ratio and not 0.5625 <= aspect_ratio <= 1.7778:
+            return False, f"aspect ratio {aspect_ratio:.4f} outside 0.5625–1.7778"
+        return True, None
 
     def authenticate_dropbox(self):
-        """Authenticate with Dropbox and return the client."""
+        """Authenticate with Dropbox and return the client (the local media source when MEDIA_SOURCE=local)."""
+        if self.local_media:
+            if self.local_media.server is None:
+                self.local_media.start()
+                self.log_console_only(f"📁 Serving {self.local_media.root} at {self.local_media.base_url}", level=logging.INFO)
+            return self.local_media
         try:
             access_token = self.refresh_dropbox_token()
-            return dropbox.Dropbox(oauth2_access_token=access_token)
+            # With the refresh credentials the SDK renews the token itself if a run outlives it
+            return dropbox.Dropbox(
+                oauth2_access_token=access_token,
+                oauth2_access_token_expiration=datetime.utcfromtimestamp(self.tokens.dropbox_expires_at),
+                oauth2_refresh_token=self.dropbox_refresh,
+                app_key=self.dropbox_key,
+                app_secret=self.dropbox_secret,
+                session=self.session
+            )
         except Exception as e:
             self.send_message(f"❌ Dropbox authentication failed: {str(e)}", level=logging.ERROR)
             raise
 
+    def check_config(self):
+        """Validate scheduler/config.json up front so a malformed file is reported before posting."""
+        try:
+            self.config.get()
+        except Exception as e:
+            self.send_message(f"❌ Invalid {self.schedule_file}, captions will fall back to the default: {e}", level=logging.ERROR)
+            return False
+        if self.config.error:
+            self.send_message(f"⚠️ {self.schedule_file} changed but is invalid, keeping the previous version: {self.config.error}", level=logging.WARNING)
+        return True
+
     def get_remaining_files_count(self, dbx):
         """Get the count of remaining files in Dropbox folder."""
         try:
@@ -635,101 +1054,218 @@ class DropboxToInstagramUploader:
             return 0
 
     def process_files_with_retries(self, dbx, caption, description, max_retries=1):
-        files = self.list_dropbox_files(dbx)
+        """Sync wrapper around process_files_with_retries_async."""
+        return self._run_sync(self.process_files_with_retries_async(dbx, caption, description, max_retries))
+
+    async def process_files_with_retries_async(self, dbx, caption, description, max_retries=1):
+        adbx = self._async_dropbox(dbx)
+        files = await asyncio.to_thread(self.list_dropbox_files, dbx)
+        groups = {}
+        if self.carousel_grouping != "off":
+            groups = await asyncio.to_thread(self.list_carousel_groups, dbx, files)
+            if self.carousel_grouping == "subfolder":
+                files = files + [f for group in groups.values() for f in group.files]
+        postable = []
+        for file in files:
+            ok, reason = self.validate_for_posting(file)
+            if ok:
+                postable.append(file)
+            else:
+                self.log_console_only(f"⚠️ Skipping {file.name} (media index): {reason}", level=logging.WARNING)
+        files = postable
         if not files:
             self.log_console_only("📭 No files found in Dropbox folder.", level=logging.INFO)
             return False
 
-        # Process only the first file - no retries
-        file = random.choice(files)
-        self.log_console_only(f"🎯 Processing single file: {file.name}", level=logging.INFO)
-        
-        try:
-            result = self.post_to_instagram(dbx, file, caption, description)
-            if isinstance(result, tuple):
-                if len(result) == 4:
-                    success, media_type, instagram_success, facebook_success = result
-                elif len(result) == 2:
-                    success, media_type = result
-                    instagram_success = success
-                    facebook_success = False
-                else:
-                    success = result
-                    media_type = None
-                    instagram_success = success
-                    facebook_success = False
+        # Never start uploads that media_publish is guaranteed to reject
+        quota_left = await self.publishing_quota_async()
+        if quota_left == 0:
+            await self.send_message_async("⏸️ Instagram publishing quota or app usage limit reached. Keeping all files for the next run.", level=logging.WARNING)
+            return False
+        batch_size = min(self.post_batch_size, quota_left)
+
+        if batch_size > 1:
+            batch = self.group_batch(
+                self.selector.pack_batch(files, batch_size, min(self.post_batch_deadline, self.budget.remaining()), self.PUBLISH_CONCURRENCY),
+                groups
+            )
+            self.log_console_only(f"🎯 Processing batch of {len(batch)} posts ({self.selector.strategy}): {', '.join(u.name for u in batch)}", level=logging.INFO)
+            # Create the batch's temporary links in one concurrent round; transcoding and publishing reuse them
+            await self.links.get_many(dbx, [f.path_lower for u in batch for f in (u.files if isinstance(u, CarouselGroup) else [u])])
+            await self.prepare_media_async(dbx, batch)
+            results = await self.publish_batch_async(dbx, batch, caption, description)
+        else:
+            # Process a single post (one file or one carousel set) - no retries
+            unit = self.group_batch([self.selector.select(files)], groups)[0]
+            batch = [unit]
+            self.log_console_only(f"🎯 Processing single post ({self.selector.strategy}): {unit.name}", level=logging.INFO)
+            try:
+                await self.prepare_media_async(dbx, batch)
+                results = [await self.publish_unit_async(dbx, unit, caption, description)]
+            except Exception as e:
+                await self.send_message_async(f"❌ Exception during post for {unit.name}: {e}", level=logging.ERROR)
+                results = [PostOutcome(unit.name, media_type_of(unit), ())]
+
+        # Always delete the file after an attempt, unless it failed while Meta or Dropbox was down
+        for unit, result in zip(batch, results):
+            if result is None:
+                self.log_console_only(f"♻️ Keeping {unit.name} for the next run: not attempted before the run deadline", level=logging.WARNING)
+                continue
+            if not result.success and self.blocked_services():
+                await self.send_message_async(f"♻️ Keeping {unit.name} for the next run: services degraded", level=logging.WARNING)
+                continue
+            if isinstance(unit, CarouselGroup):
+                paths = [unit.folder_path] if unit.folder_path else [f.path_lower for f in unit.files]
             else:
-                success = result
-                media_type = None
-                instagram_success = success
-                facebook_success = False
-        except Exception as e:
-            self.send_message(f"❌ Exception during post for {file.name}: {e}", level=logging.ERROR)
-            success = False
-            media_type = None
-            instagram_success = False
-            facebook_success = False
+                paths = [unit.path_lower]
+            # Normalised copies are only kept while their source may be retried
+            for file in (unit.files if isinstance(unit, CarouselGroup) else [unit]):
+                normalised = self.normalised_media.get(file.path_lower)
+                if normalised:
+                    paths.append(normalised.path_lower)
+                    self.transcode_cache.pop(file.content_hash, None)
+            for path in paths:
+                self.links.discard(path)
+                try:
+                    await adbx.files_delete_v2(path)
+                    self.log_console_only(f"🗑️ Deleted after attempt: {path}")
+                except Exception as e:
+                    self.log_console_only(f"⚠️ Failed to delete {path}: {e}", level=logging.WARNING)
 
-        # Always delete the file after an attempt
-        try:
-            dbx.files_delete_v2(file.path_lower)
-            self.log_console_only(f"🗑️ Deleted file after attempt: {file.name}")
-        except Exception as e:
-            self.log_console_only(f"⚠️ Failed to delete file {file.name}: {e}", level=logging.WARNING)
+        if self.normalised_media:
+            self._save_transcode_cache()
 
         # Get remaining files count
-        remaining_files = self.get_remaining_files_count(dbx)
-
-        # Report results for each platform separately
-        if instagram_success:
-            if media_type == "REELS":
-                self.send_message("✅ Successfully posted one reel to Instagram", level=logging.INFO)
-            elif media_type == "IMAGE":
-                self.send_message("✅ Successfully posted one image to Instagram", level=logging.INFO)
+        remaining_files = await asyncio.to_thread(self.get_remaining_files_count, dbx)
+
+        all_succeeded = True
+        for result in results:
+            if result is None:
+                continue
+            await self.report_post_result(result, remaining_files)
+            all_succeeded = all_succeeded and result.success
+
+        # Return overall success (the primary destination decides)
+        return all_succeeded
+
+    async def publishing_quota_async(self):
+        """Posts the account may still publish now, from the API limit, local history and app usage."""
+        try:
+            res = await self.graph.get(f"{self.INSTAGRAM_API_BASE}/{self.ig_id}/content_publishing_limit", "publishing_limit", self.meta_token)
+            if res.ok and res.get("data"):
+                self.quota.update_limit(res.get("data")[0])
             else:
-                self.send_message("✅ Successfully posted to Instagram", level=logging.INFO)
-        else:
-            self.send_message("❌ Instagram post failed", level=logging.ERROR)
-            
-        if media_type == "REELS":
-            if facebook_success:
-                self.send_message("✅ Successfully posted one reel to Facebook Page", level=logging.INFO)
+                self.log_console_only(f"⚠️ Could not read content_publishing_limit: {res.error_message}", level=logging.WARNING)
+        except Exception as e:
+            self.log_console_only(f"⚠️ Could not read content_publishing_limit: {e}", level=logging.WARNING)
+        remaining = self.quota.remaining()
+        self.log_console_only(
+            f"📊 Publishing quota: {remaining}/{self.quota.quota_total} left (API usage {self.quota.api_usage}, "
+            f"local 24h count {self.quota.local_count()}, app usage {self.quota.app_usage}%)",
+            level=logging.INFO
+        )
+        return remaining
+
+    async def report_post_result(self, outcome, remaining_files):
+        """Report each destination's result for one post, then a one-line summary."""
+        kinds = {"REELS": "reel", "IMAGE": "image", "CAROUSEL": "carousel"}
+        labels = {d.name: d.label for d in self.destinations}
+        if not outcome.results:
+            await self.send_message_async(f"❌ {outcome.name} was not published", level=logging.ERROR)
+        for result in outcome.results:
+            label = labels.get(result.destination, result.destination)
+            if result.success:
+                kind = "multi-photo post" if result.platform == "facebook" and outcome.media_type == "CAROUSEL" else kinds.get(outcome.media_type, "post")
+                await self.send_message_async(f"✅ Successfully posted one {kind} to {label}", level=logging.INFO)
             else:
-                self.send_message("❌ Facebook Page post failed", level=logging.ERROR)
-        
-        # Final summary with remaining files count
-        if media_type == "REELS":
-            self.log_console_only(f"📊 Final Status: Instagram {'✅' if instagram_success else '❌'} | Facebook {'✅' if facebook_success else '❌'} | 📦 Remaining files: {remaining_files}", level=logging.INFO)
-        elif media_type == "IMAGE":
-            self.log_console_only(f"📊 Final Status: Instagram {'✅' if instagram_success else '❌'} | Facebook {'✅' if facebook_success else '❌'} (image) | 📦 Remaining files: {remaining_files}", level=logging.INFO)
-        else:
-            self.log_console_only(f"📊 Final Status: Instagram {'✅' if instagram_success else '❌'} | Facebook N/A | 📦 Remaining files: {remaining_files}", level=logging.INFO)
-        
-        # Return overall success (Instagram success is primary)
-        return instagram_success
+                await self.send_message_async(f"❌ {label} post failed", level=logging.ERROR)
+
+        statuses = " | ".join(f"{labels.get(r.destination, r.destination)} {'✅' if r.success else '❌'}" for r in outcome.results)
+        self.log_console_only(f"📊 Final Status ({(outcome.media_type or 'unknown').lower()}): {statuses or 'not published'} | 📦 Remaining files: {remaining_files}", level=logging.INFO)
+
+    async def publish_batch_async(self, dbx, files, caption, description, concurrency=None):
+        """Publish several files (or carousel sets) concurrently; None marks a post skipped by the deadline."""
+        semaphore = asyncio.Semaphore(concurrency or self.PUBLISH_CONCURRENCY)
+
+        async def publish_one(file):
+            async with semaphore:
+                # Posts still queued when the run deadline passes are left for the next run
+                if self.budget.expired():
+                    return None
+                try:
+                    return await self.publish_unit_async(dbx, file, caption, description)
+                except Exception as e:
+                    await self.send_message_async(f"❌ Exception during post for {file.name}: {e}", level=logging.ERROR)
+                    return PostOutcome(file.name, media_type_of(file), ())
+
+        return await asyncio.gather(*(publish_one(file) for file in files))
 
     def run(self):
-        """Main execution method that orchestrates the posting process."""
+        """Main execution method that orchestrates the posting process (profiled when PROFILE_MODE is set)."""
+        if self.profiler is None:
+            return self._run()
+        token = _current_profiler.set(self.profiler)
+        self.profiler.start()
+        try:
+            return self._run()
+        finally:
+            self.profiler.stop()
+            _current_profiler.reset(token)
+            try:
+                paths = self.profiler.write(self.run_id)
+                self.log_console_only(f"📈 Profile written: {', '.join(paths)}", level=logging.INFO)
+            except Exception as e:
+                self.log_console_only(f"⚠️ Could not write profile: {e}", level=logging.WARNING)
+
+    def _run(self):
         self.log_console_only(f"📡 Run started at: {datetime.now(self.ist).strftime('%Y-%m-%d %H:%M:%S')}", level=logging.INFO)
         
         try:
+            with profile_phase("config"):
+                self.check_config()
+
+            # Fail fast while Meta or Dropbox is known to be degraded
+            blocked = self.blocked_services()
+            if blocked:
+                self.send_message(f"⛔ Circuit open for: {', '.join(blocked)}. Skipping publish and keeping all files.", level=logging.WARNING)
+                return
+
             # Check token expiry first
-            token_valid = self.check_token_expiry()
+            with profile_phase("tokens"):
+                try:
+                    if self.tokens.remove_legacy_cache():
+                        self.log_console_only(f"🧹 Removed the old token cache {TokenManager.LEGACY_CACHE}", level=logging.INFO)
+                except OSError as e:
+                    self.log_console_only(f"⚠️ Could not remove the old token cache: {e}", level=logging.WARNING)
+                token_valid = self.check_token_expiry()
+                if token_valid:
+                    self.refresh_meta_token()
             if not token_valid:
                 self.send_message("❌ Token validation failed. Stopping execution.", level=logging.ERROR)
                 return
+
+            if self.webhooks:
+                self.webhooks.start()
+                self.log_console_only(f"📨 Webhook receiver listening on {self.webhooks.host}:{self.webhooks.port}", level=logging.INFO)
             
             # List available pages for configuration help
-            self.list_available_pages()
+            with profile_phase("pages"):
+                self.list_available_pages()
             
             # Get caption from config
-            caption, description = self.get_caption_from_config()
+            with profile_phase("config"):
+                caption, description = self.get_caption_from_config()
+            if not self.apply_config_limits():
+                self.send_message("⏸️ Daily post limit from config reached. Skipping publish.", level=logging.INFO)
+                return
             
             # Authenticate with Dropbox
-            dbx = self.authenticate_dropbox()
+            with profile_phase("dropbox_auth"):
+                dbx = self.authenticate_dropbox()
             
             # Try posting one file only
-            success = self.process_files_with_retries(dbx, caption, description, max_retries=1)
+            with profile_phase("process_files"):
+                success = self.process_files_with_retries(dbx, caption, description, max_retries=1)
             
             if success:
                 self.send_message("🎉 Instagram post completed successfully!", level=logging.INFO)
@@ -742,261 +1278,92 @@ class DropboxToInstagramUploader:
             raise
         finally:
             # Send token expiry info before completion
-            self.send_token_expiry_info()
+            if not self.breakers.is_open("meta"):
+                with profile_phase("token_report"):
+                    self.send_token_expiry_info()
+            self.breakers.save()
+            if self.webhooks:
+                self.webhooks.stop()
+            if self.local_media:
+                self.local_media.stop()
+            if self.trace:
+                self.trace.save()
+                if self.trace.mode == "replay":
+                    self.log_console_only(f"🎬 Replayed {self.trace.replayed} responses, {self.trace.remaining()} unused", level=logging.INFO)
+                else:
+                    self.log_console_only(f"🎬 Recorded {len(self.trace.entries)} trace entries to {self.trace.path}", level=logging.INFO)
             duration = time.time() - self.start_time
             self.log_console_only(f"🏁 Run complete in {duration:.1f} seconds", level=logging.INFO)
 
+    def blocked_services(self):
+        """Services whose circuit breaker is open; publishing needs both Meta and Dropbox."""
+        blocked = []
+        for name in ("meta", "dropbox"):
+            if self.breakers.is_open(name):
+                stats = self.breakers.get(name).stats()
+                self.log_console_only(f"⛔ {name} circuit open: error rate {stats['error_rate']:.0%} over {stats['calls']} recent calls", level=logging.WARNING)
+                blocked.append(name)
+        return blocked
+
     def check_token_expiry(self):
         """Check Meta token expiry and send Telegram notification."""
         try:
             self.log_console_only("🔍 Checking token expiry...", level=logging.INFO)
-            url = "https://graph.facebook.com/debug_token"
-            params = {
-                "input_token": self.meta_token,
-                "access_token": self.meta_token
-            }
-            
-            res = self.session.get(url, params=params)
-            data = res.json()
-            
-            if "data" in data:
-                expires_at = data["data"].get("expires_at")
-                is_valid = data["data"].get("is_valid")
-                
-                if expires_at:
-                    dt = datetime.fromtimestamp(expires_at).astimezone(self.ist)
-                    self.log_console_only(f"🔐 Token Valid: {is_valid}\n⏳ Expires at: {dt.strftime('%Y-%m-%d %H:%M:%S')}", level=logging.INFO)
-                else:
-                    self.log_console_only("🔐 Token is long-lived or does not expire.", level=logging.INFO)
-                
-                return is_valid
-            else:
-                self.send_message(f"⚠️ Token debug info not returned properly: {res.text}", level=logging.WARNING)
+            try:
+                data = self.tokens.debug_meta_token()
+            except RuntimeError as e:
+                self.send_message(f"⚠️ {e}", level=logging.WARNING)
                 return False
-                
-        except Exception as e:
-            self.send_message(f"⚠️ Token expiry check failed: {str(e)}", level=logging.ERROR)
-            return False
 
-    def check_page_permissions(self, page_token):
-        """Check what permissions the page access token has."""
-        try:
-            self.log_console_only("🔍 Checking page permissions...", level=logging.INFO)
-            url = f"https://graph.facebook.com/v18.0/me/permissions"
-            params = {"access_token": page_token}
-            
-            self.log_console_only(f"📡 Permission check URL: {url}", level=logging.INFO)
-            
-            res = self.session.get(url, params=params)
-            self.log_console_only(f"📊 Permission check response status: {res.status_code}", level=logging.INFO)
-            
-            if res.status_code == 200:
-                permissions = res.json().get("data", [])
-                self.log_console_only(f"📋 Found {len(permissions)} permissions:", level=logging.INFO)
-                
-                for perm in permissions:
-                    permission_name = perm.get("permission", "Unknown")
-                    status = perm.get("status", "Unknown")
-                    self.log_console_only(f"🔑 {permission_name}: {status}", level=logging.INFO)
-                
-                # Check for specific permissions needed for video upload
-                has_publish_video = any(p.get("permission") == "publish_video" and p.get("status") == "granted" for p in permissions)
-                has_publish_actions = any(p.get("permission") == "publish_actions" and p.get("status") == "granted" for p in permissions)
-                has_manage_pages = any(p.get("permission") == "manage_pages" and p.get("status") == "granted" for p in permissions)
-                has_pages_show_list = any(p.get("permission") == "pages_show_list" and p.get("status") == "granted" for p in permissions)
-                
-                self.log_console_only("📊 Permission Analysis:", level=logging.INFO)
-                self.log_console_only(f"   🎥 publish_video: {'✅' if has_publish_video else '❌'}", level=logging.INFO)
-                self.log_console_only(f"   📝 publish_actions: {'✅' if has_publish_actions else '❌'}", level=logging.INFO)
-                self.log_console_only(f"   ⚙️ manage_pages: {'✅' if has_manage_pages else '❌'}", level=logging.INFO)
-                self.log_console_only(f"   📋 pages_show_list: {'✅' if has_pages_show_list else '❌'}", level=logging.INFO)
-                
-                if not has_publish_video:
-                    self.send_message("⚠️ Missing 'publish_video' permission! This is required for video uploads.", level=logging.WARNING)
-                if not has_publish_actions:
-                    self.send_message("⚠️ Missing 'publish_actions' permission! This is required for content publishing.", level=logging.WARNING)
-                if not has_manage_pages:
-                    self.send_message("⚠️ Missing 'manage_pages' permission! This is required for page management.", level=logging.WARNING)
-                
-                # For Facebook video uploads, we need publish_video
-                if has_publish_video and has_publish_actions:
-                    self.log_console_only("✅ Page has all required permissions for video publishing!", level=logging.INFO)
-                    return True
-                else:
-                    self.send_message("❌ Page missing required permissions for video publishing", level=logging.ERROR)
-                    return False
-            else:
-                error_response = res.text
-                self.send_message(f"❌ Failed to check permissions: {res.status_code}", level=logging.ERROR)
-                self.log_console_only(f"📄 Error response: {error_response}", level=logging.INFO)
-                
-                # If permission check fails, let's try a different approach
-                self.log_console_only("🔄 Trying alternative permission check...", level=logging.INFO)
-                return self.check_page_permissions_alternative(page_token)
-                
-        except Exception as e:
-            self.send_message(f"❌ Exception checking permissions: {e}", level=logging.ERROR)
-            return False
+            expires_at = data.get("expires_at")
+            is_valid = data.get("is_valid")
 
-    def check_page_permissions_alternative(self, page_token):
-        """Alternative method to check page permissions using page info."""
-        try:
-            self.log_console_only("🔍 Alternative permission check using page info...", level=logging.INFO)
-            
-            # Try to get page info and check if it has video publishing capabilities
-            url = f"https://graph.facebook.com/v18.0/{self.fb_page_id}"
-            params = {
-                "fields": "id,name,category,fan_count,verification_status,connected_instagram_account",
-                "access_token": page_token
-            }
-            
-            self.log_console_only(f"📡 Alternative check URL: {url}", level=logging.INFO)
-            
-            res = self.session.get(url, params=params)
-            if res.status_code == 200:
-                page_info = res.json()
-                page_name = page_info.get("name", "Unknown")
-                page_category = page_info.get("category", "Unknown")
-                
-                self.log_console_only(f"✅ Alternative check successful!", level=logging.INFO)
-                self.log_console_only(f"📄 Page Name: {page_name}", level=logging.INFO)
-                self.log_console_only(f"📄 Page Category: {page_category}", level=logging.INFO)
-                
-                # Since we can access the page info, the token has basic permissions
-                # Let's assume it can publish videos (we'll find out when we try)
-                self.log_console_only("✅ Assuming page has video publishing permissions (will test during upload)", level=logging.INFO)
-                return True
+            if expires_at:
+                dt = datetime.fromtimestamp(expires_at).astimezone(self.ist)
+                self.log_console_only(f"🔐 Token Valid: {is_valid}\n⏳ Expires at: {dt.strftime('%Y-%m-%d %H:%M:%S')}", level=logging.INFO)
             else:
-                self.send_message(f"❌ Alternative check also failed: {res.status_code}", level=logging.ERROR)
-                return False
-                
-        except Exception as e:
-            self.send_message(f"❌ Exception in alternative permission check: {e}", level=logging.ERROR)
-            return False
+                self.log_console_only("🔐 Token is long-lived or does not expire.", level=logging.INFO)
+
+            return is_valid
 
-    def refresh_page_access_token(self, page_token):
-        """Refresh the page access token if it's expired."""
-        try:
-            self.log_console_only("🔄 Refreshing page access token...", level=logging.INFO)
-            url = f"https://graph.facebook.com/v18.0/oauth/access_token"
-            params = {
-                "grant_type": "fb_exchange_token",
-                "client_id": self.dropbox_key,  # Using app ID
-                "client_secret": self.dropbox_secret,  # Using app secret
-                "fb_exchange_token": page_token
-            }
-            
-            res = self.session.get(url, params=params)
-            if res.status_code == 200:
-                new_token = res.json().get("access_token")
-                expires_in = res.json().get("expires_in", "Unknown")
-                self.send_message(f"✅ Page access token refreshed successfully! Expires in: {expires_in} seconds")
-                return new_token
-            else:
-                self.send_message(f"❌ Failed to refresh page token: {res.text}", level=logging.ERROR)
-                return None
         except Exception as e:
-            self.send_message(f"❌ Exception refreshing page token: {e}", level=logging.ERROR)
-            return None
+            self.send_message(f"⚠️ Token expiry check failed: {str(e)}", level=logging.ERROR)
+            return False
 
     def list_available_pages(self):
         """List all available pages for the user to help with configuration."""
         try:
-            self.log_console_only("🔍 Listing all available pages for configuration...", level=logging.INFO)
-            url = f"https://graph.facebook.com/v18.0/me/accounts"
-            params = {"access_token": self.meta_token}
-            
-            res = self.session.get(url, params=params)
-            if res.status_code != 200:
-                self.send_message(f"❌ Failed to fetch pages: {res.text}", level=logging.ERROR)
-                return
-
-            pages = res.json().get("data", [])
+            pages = self.pages.load(self.meta_token)
             self.log_console_only(f"📋 Found {len(pages)} pages:", level=logging.INFO)
-            
-            for i, page in enumerate(pages):
-                page_id = page.get("id", "Unknown")
-                page_name = page.get("name", "Unknown")
-                category = page.get("category", "Unknown")
-                tasks = page.get("tasks", [])
-                
-                self.log_console_only(f"📄 Page {i+1}:", level=logging.INFO)
-                self.log_console_only(f"   📝 Name: {page_name}", level=logging.INFO)
-                self.log_console_only(f"   🆔 ID: {page_id}", level=logging.INFO)
-                self.log_console_only(f"   📂 Category: {category}", level=logging.INFO)
-                self.log_console_only(f"   🔧 Tasks: {', '.join(tasks)}", level=logging.INFO)
-                
-                # Check if this matches current configuration
-                if page_id == self.fb_page_id:
-                    self.log_console_only(f"   ✅ CURRENTLY CONFIGURED", level=logging.INFO)
-                else:
-                    self.log_console_only(f"   ⚙️ To use this page, set FB_PAGE_ID={page_id}", level=logging.INFO)
-            
-            self.log_console_only("💡 Copy the ID of the page you want to use and set it as FB_PAGE_ID environment variable.", level=logging.INFO)
-            
+            for page in pages.values():
+                status = "✅ CURRENTLY CONFIGURED" if page.id == self.fb_page_id else f"⚙️ set FB_PAGE_ID={page.id}"
+                self.log_console_only(
+                    f"📄 {page.name} | 🆔 {page.id} | 📂 {page.category} | 🔧 {', '.join(page.tasks)} | 📸 IG {page.instagram_id or '-'} | {status}",
+                    level=logging.INFO
+                )
         except Exception as e:
             self.send_message(f"❌ Exception listing pages: {e}", level=logging.ERROR)
 
-    def exchange_user_token_for_page_token(self, page_id):
-        """Exchange user access token for page access token."""
-        try:
-            self.send_message(f"🔄 Exchanging token for page ID: {page_id}", level=logging.INFO)
-            
-            # Use the page token endpoint to get the actual page access token
-            # This is the correct way to get a page access token
-            url = f"https://graph.facebook.com/v18.0/{page_id}"
-            params = {
-                "fields": "access_token",
-                "access_token": self.meta_token
-            }
-            
-            self.send_message(f"📡 Exchange API URL: {url}", level=logging.INFO)
-            self.send_message(f"🔑 Using user token to get page token for page: {page_id}", level=logging.INFO)
-            
-            start_time = time.time()
-            res = self.session.get(url, params=params)
-            request_time = time.time() - start_time
-            
-            self.send_message(f"⏱️ Token exchange completed in {request_time:.2f} seconds", level=logging.INFO)
-            self.send_message(f"📊 Exchange response status: {res.status_code}", level=logging.INFO)
-            
-            if res.status_code == 200:
-                response_data = res.json()
-                page_token = response_data.get("access_token")
-                
-                if page_token:
-                    self.send_message("✅ Page access token obtained successfully!")
-                    self.send_message(f"🔐 Page token starts with: {page_token[:20]}...", level=logging.INFO)
-                    return page_token
-                else:
-                    self.send_message("❌ No access_token in response", level=logging.ERROR)
-                    self.send_message(f"📄 Response data: {response_data}", level=logging.ERROR)
-                    return None
-            else:
-                self.send_message(f"❌ Token exchange failed: {res.text}", level=logging.ERROR)
-                return None
-                
-        except Exception as e:
-            self.send_message(f"❌ Exception during token exchange: {e}", level=logging.ERROR)
-            return None
-
     def check_instagram_page_connection(self, page_token):
         """Check if Instagram account is properly connected to the Facebook page."""
         try:
             self.log_console_only("🔍 Checking Instagram-Facebook page connection...", level=logging.INFO)
             
-            # Check if the page has Instagram account connected
-            url = f"https://graph.facebook.com/v18.0/{self.fb_page_id}"
-            params = {
-                "fields": "instagram_business_account,connected_instagram_account",
-                "access_token": page_token
-            }
-            
-            self.log_console_only(f"📡 Checking page Instagram connection: {url}", level=logging.INFO)
-            
-            res = self.session.get(url, params=params)
-            if res.status_code == 200:
-                data = res.json()
+            # The page directory already knows the business account; only ask the Page otherwise
+            page = self.pages.cached(self.fb_page_id)
+            if page and page.instagram_id:
+                data = {"instagram_business_account": {"id": page.instagram_id}}
+            else:
+                url = f"https://graph.facebook.com/v18.0/{self.fb_page_id}"
+                params = {
+                    "fields": "instagram_business_account,connected_instagram_account",
+                    "access_token": page_token
+                }
+                self.log_console_only(f"📡 Checking page Instagram connection: {url}", level=logging.INFO)
+                res = self.session.get(url, params=params)
+                data = res.json() if res.status_code == 200 else None
+
+            if data is not None:
                 instagram_business_account = data.get("instagram_business_account", {})
                 connected_instagram = data.get("connected_instagram_account", {})
                 
@@ -1073,148 +1440,172 @@ class DropboxToInstagramUploader:
             self.send_message(f"❌ Exception testing page token: {e}", level=logging.ERROR)
             return False
 
-    def verify_token_type(self, page_token):
-        """Verify if the token is a page token."""
-        try:
-            self.send_message("🔍 Verifying token type...", level=logging.INFO)
-            
-            # Check if the token is valid by making a simple API call
-            url = f"https://graph.facebook.com/v18.0/me"
-            params = {
-                "fields": "id,name,category",
-                "access_token": page_token
-            }
-            
-            self.send_message(f"📡 Verification URL: {url}", level=logging.INFO)
-            
-            start_time = time.time()
-            res = self.session.get(url, params=params)
-            request_time = time.time() - start_time
-            
-            self.send_message(f"⏱️ Verification completed in {request_time:.2f} seconds", level=logging.INFO)
-            self.send_message(f"📊 Verification response status: {res.status_code}", level=logging.INFO)
-            
-            if res.status_code == 200:
-                page_info = res.json()
-                page_id = page_info.get("id", "Unknown")
-                page_name = page_info.get("name", "Unknown")
-                page_category = page_info.get("category", "Unknown")
-                
-                self.send_message(f"✅ Token verification successful!", level=logging.INFO)
-                self.send_message(f"📄 Page ID: {page_id}", level=logging.INFO)
-                self.send_message(f"📄 Page Name: {page_name}", level=logging.INFO)
-                self.send_message(f"📄 Page Category: {page_category}", level=logging.INFO)
-                
-                # Verify this matches our expected page
-                if page_id == self.fb_page_id:
-                    self.send_message("✅ Page ID matches expected page!", level=logging.INFO)
-                    return True
-                else:
-                    self.send_message(f"⚠️ Page ID mismatch! Expected: {self.fb_page_id}, Got: {page_id}", level=logging.WARNING)
-                    return False
-            else:
-                self.send_message(f"❌ Token verification failed: {res.text}", level=logging.ERROR)
-                return False
-                
-        except Exception as e:
-            self.send_message(f"❌ Exception verifying token type: {e}", level=logging.ERROR)
-            return False
+    def _record_verify(self, record, started, attempts, permalink=None):
+        if record is None:
+            return
+        record.store.add_phase(record.row_id, "verify", time.time() - started, attempts)
+        if permalink and permalink != "Not available":
+            record.update(permalink=permalink)
+
+    def verify_instagram_post_by_media_id(self, media_id, page_token, record=None):
+        """Sync wrapper around verify_instagram_post_by_media_id_async."""
+        return self._run_sync(self.verify_instagram_post_by_media_id_async(media_id, page_token, record=record))
 
-    def verify_instagram_post_by_media_id(self, media_id, page_token):
+    async def verify_instagram_post_by_media_id_async(self, media_id, page_token, record=None):
         """Verify Instagram post is live by polling the published media_id."""
         try:
-            self.send_message("🔍 Verifying Instagram post is live...", level=logging.INFO)
+            await self.send_message_async("🔍 Verifying Instagram post is live...", level=logging.INFO)
             
             # Poll the media_id to get post details
             url = f"{self.INSTAGRAM_API_BASE}/{media_id}"
-            params = {
-                "fields": "id,permalink_url,media_type,media_url,thumbnail_url,created_time",
-                "access_token": page_token
-            }
             
             self.log_console_only(f"📡 Verification URL: {url}", level=logging.INFO)
             
             # Try up to 10 times with 5-second intervals (increased from 5 attempts, 3 seconds)
+            verify_start = time.time()
             for attempt in range(10):
                 self.log_console_only(f"🔄 Verification attempt {attempt + 1}/10", level=logging.INFO)
                 
-                res = self.session.get(url, params=params)
-                if res.status_code == 200:
-                    post_data = res.json()
-                    post_id = post_data.get("id", "Unknown")
-                    permalink = post_data.get("permalink_url", "Not available")
-                    media_type = post_data.get("media_type", "Unknown")
-                    created_time = post_data.get("created_time", "Unknown")
-                    
-                    self.send_message(f"✅ Instagram post verified as live!", level=logging.INFO)
-                    self.log_console_only(f"📸 Post ID: {post_id}", level=logging.INFO)
+                res = await self.graph.get(url, "ig_media", page_token)
+                if res.ok:
+                    media = res.item
+                    permalink = media.permalink or "Not available"
+
+                    await self.send_message_async(f"✅ Instagram post verified as live!", level=logging.INFO)
+                    self.log_console_only(f"📸 Post ID: {media.id}", level=logging.INFO)
                     self.log_console_only(f"🔗 Permalink: {permalink}", level=logging.INFO)
-                    self.log_console_only(f"📂 Media Type: {media_type}", level=logging.INFO)
-                    self.log_console_only(f"⏰ Created: {created_time}", level=logging.INFO)
+                    self.log_console_only(f"📂 Media Type: {media.media_type}", level=logging.INFO)
+                    self.log_console_only(f"⏰ Created: {media.timestamp}", level=logging.INFO)
+                    self._record_verify(record, verify_start, attempt + 1, permalink)
                     return True
-                elif res.status_code == 400:
-                    self.send_message("⚠️ Permanent error on verification (400 Bad Request), stopping early.", level=logging.WARNING)
-                    self.log_console_only(f"❌ Unrecoverable error on attempt {attempt + 1}: {res.status_code}", level=logging.INFO)
+                elif res.status == 400:
+                    await self.send_message_async("⚠️ Permanent error on verification (400 Bad Request), stopping early.", level=logging.WARNING)
+                    self.log_console_only(f"❌ Unrecoverable error on attempt {attempt + 1}: {res.status} {res.error_message}", level=logging.INFO)
                     break
                 else:
-                    self.log_console_only(f"❌ Verification failed (attempt {attempt + 1}): {res.status_code}", level=logging.INFO)
-                    if attempt < 9:  # Don't sleep on last attempt
-                        time.sleep(5)  # Increased from 3 seconds
+                    self.log_console_only(f"❌ Verification failed (attempt {attempt + 1}): {res.status}", level=logging.INFO)
+                    if attempt < 9 and not await self.budget.wait(5, "verify"):  # Don't sleep on last attempt
+                        self.log_console_only("⌛ Verification budget used up", level=logging.WARNING)
+                        break
             
-            self.send_message("⚠️ Could not verify Instagram post is live after 10 attempts", level=logging.WARNING)
+            self._record_verify(record, verify_start, attempt + 1)
+            await self.send_message_async(f"⚠️ Could not verify Instagram post is live after {attempt + 1} attempts", level=logging.WARNING)
             return False
             
         except Exception as e:
-            self.send_message(f"❌ Exception verifying Instagram post: {e}", level=logging.ERROR)
+            await self.send_message_async(f"❌ Exception verifying Instagram post: {e}", level=logging.ERROR)
             return False
 
-    def verify_facebook_post_by_video_id(self, video_id, page_token):
-        """Verify Facebook video post is live by polling the video_id."""
+    def verify_facebook_post_by_video_id(self, video_id, page_token, record=None):
+        """Sync wrapper around verify_facebook_post_by_video_id_async."""
+        return self._run_sync(self.verify_facebook_post_by_video_id_async(video_id, page_token, record=record))
+
+    async def verify_facebook_post_by_video_id_async(self, video_id, page_token, record=None):
+        """Verify Facebook video post is live by polling the video_id, or sooner from a webhook event."""
         try:
-            self.send_message("🔍 Verifying Facebook video post is live...", level=logging.INFO)
+            await self.send_message_async("🔍 Verifying Facebook video post is live...", level=logging.INFO)
             
             # Poll the video_id to get post details
             url = f"https://graph.facebook.com/{video_id}"
-            params = {
-                "fields": "id,permalink_url,created_time,length,title,description",
-                "access_token": page_token
-            }
             
             self.log_console_only(f"📡 Verification URL: {url}", level=logging.INFO)
             
-            # Try up to 10 times with 5-second intervals (increased from 5 attempts, 3 seconds)
-            for attempt in range(10):
-                self.log_console_only(f"🔄 Verification attempt {attempt + 1}/10", level=logging.INFO)
-                
-                res = self.session.get(url, params=params)
-                if res.status_code == 200:
-                    post_data = res.json()
-                    fb_video_id = post_data.get("id", "Unknown")
-                    permalink = post_data.get("permalink_url", "Not available")
-                    created_time = post_data.get("created_time", "Unknown")
-                    length = post_data.get("length", "Unknown")
-                    
-                    self.send_message(f"✅ Facebook video post verified as live!", level=logging.INFO)
-                    self.log_console_only(f"📘 Video ID: {fb_video_id}", level=logging.INFO)
-                    self.log_console_only(f"🔗 Permalink: {permalink}", level=logging.INFO)
-                    self.log_console_only(f"⏰ Created: {created_time}", level=logging.INFO)
-                    self.log_console_only(f"⏱️ Length: {length} seconds", level=logging.INFO)
-                    return True
-                elif res.status_code == 400:
-                    self.send_message("⚠️ Permanent error on Facebook verification (400 Bad Request), stopping early.", level=logging.WARNING)
-                    self.log_console_only(f"❌ Unrecoverable error on attempt {attempt + 1}: {res.status_code}", level=logging.INFO)
-                    break
-                else:
-                    self.log_console_only(f"❌ Verification failed (attempt {attempt + 1}): {res.status_code}", level=logging.INFO)
-                    if attempt < 9:  # Don't sleep on last attempt
-                        time.sleep(5)  # Increased from 3 seconds
-            
-            self.send_message("⚠️ Could not verify Facebook video post is live after 10 attempts", level=logging.WARNING)
-            return False
-            
+            verify_start = time.time()
+            polling = asyncio.ensure_future(self._poll_facebook_video(url, page_token, record, verify_start))
+            if not self.webhooks:
+                return await polling
+            event_future = self.webhooks.future(f"video:{video_id}")
+            pushed = asyncio.ensure_future(self.budget.wait_for(event_future, self.WEBHOOK_WAIT_SECONDS, "verify"))
+            try:
+                await asyncio.wait({polling, pushed}, return_when=asyncio.FIRST_COMPLETED)
+                event = pushed.result() if pushed.done() else None
+                if not event:
+                    return await polling
+                polling.cancel()
+                self.log_console_only(f"📨 Webhook: video {video_id} {event['status']}", level=logging.INFO)
+                self._record_verify(record, verify_start, 0)
+                if event["status"] == "error":
+                    await self.send_message_async(f"❌ Facebook reported a processing error for video {video_id}", level=logging.ERROR)
+                    return False
+                await self.send_message_async("✅ Facebook video post verified as live!", level=logging.INFO)
+                return True
+            finally:
+                for task in (polling, pushed, event_future):
+                    task.cancel()
+
         except Exception as e:
-            self.send_message(f"❌ Exception verifying Facebook video post: {e}", level=logging.ERROR)
+            await self.send_message_async(f"❌ Exception verifying Facebook video post: {e}", level=logging.ERROR)
             return False
 
+    async def _poll_facebook_video(self, url, page_token, record, verify_start):
+        # Try up to 10 times with 5-second intervals (increased from 5 attempts, 3 seconds)
+        for attempt in range(10):
+            self.log_console_only(f"🔄 Verification attempt {attempt + 1}/10", level=logging.INFO)
+            
+            res = await self.graph.get(url, "fb_video", page_token)
+            if res.ok:
+                video = res.item
+                permalink = video.permalink_url or "Not available"
+
+                await self.send_message_async(f"✅ Facebook video post verified as live!", level=logging.INFO)
+                self.log_console_only(f"📘 Video ID: {video.id}", level=logging.INFO)
+                self.log_console_only(f"🔗 Permalink: {permalink}", level=logging.INFO)
+                self.log_console_only(f"⏰ Created: {video.created_time}", level=logging.INFO)
+                self.log_console_only(f"⏱️ Length: {video.length} seconds", level=logging.INFO)
+                self._record_verify(record, verify_start, attempt + 1, permalink)
+                return True
+            elif res.status == 400:
+                await self.send_message_async("⚠️ Permanent error on Facebook verification (400 Bad Request), stopping early.", level=logging.WARNING)
+                self.log_console_only(f"❌ Unrecoverable error on attempt {attempt + 1}: {res.status} {res.error_message}", level=logging.INFO)
+                break
+            else:
+                self.log_console_only(f"❌ Verification failed (attempt {attempt + 1}): {res.status}", level=logging.INFO)
+                if attempt < 9 and not await self.budget.wait(5, "verify"):  # Don't sleep on last attempt
+                    self.log_console_only("⌛ Verification budget used up", level=logging.WARNING)
+                    break
+        
+        self._record_verify(record, verify_start, attempt + 1)
+        await self.send_message_async(f"⚠️ Could not verify Facebook video post is live after {attempt + 1} attempts", level=logging.WARNING)
+        return False
+
+    def print_history_summary(self, since_days=7):
+        """Print publish outcomes and phase latencies from the history store."""
+        rows = self.history.summary(since_days=since_days)
+        if not rows:
+            print(f"No publishes recorded in the last {since_days} days.")
+            return
+        print(f"📊 Publishes in the last {since_days} days:")
+        for row in rows:
+            avg = f"{row['avg_seconds']:.1f}s" if row["avg_seconds"] is not None else "n/a"
+            print(f"  {row['day']} {row['account']} {row['platform']:<9} {row['media_type'] or '?':<6} {row['outcome']:<8} x{row['n']} avg {avg}")
+        print("⏱️ Phase latencies (successful publishes):")
+        for phase in ("page_token", "container", "processing", "publish", "upload", "verify"):
+            for media_type in ("REELS", "IMAGE"):
+                stats = self.history.phase_stats(phase, media_type=media_type, since_days=since_days)
+                if stats["count"]:
+                    print(f"  {phase:<11} {media_type:<6} n={stats['count']} mean={stats['mean']:.1f}s p95={stats['p95']:.1f}s")
+
+
 if __name__ == "__main__":
-    DropboxToInstagramUploader().run()
+    uploader = DropboxToInstagramUploader()
+    if len(sys.argv) > 1 and sys.argv[1] == "history":
+        uploader.print_history_summary(int(sys.argv[2]) if len(sys.argv) > 2 else 7)
+    elif len(sys.argv) > 1 and sys.argv[1] == "check-config":
+        try:
+            uploader.config.get()
+            print(f"✅ {uploader.schedule_file} is valid")
+        except ConfigError as e:
+            print("\n".join(f"❌ {problem}" for problem in e.problems))
+            sys.exit(1)
+        except OSError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+    elif len(sys.argv) > 1 and sys.argv[1] == "analyze":
+        uploader.analyze_folder()
+    elif len(sys.argv) > 3 and sys.argv[1] == "simulate-webhook":
+        # simulate-webhook <receiver url> <payload.json>: replay a Meta webhook against a local receiver
+        with open(sys.argv[3], "r") as f:
+            res = post_simulated_webhook(sys.argv[2], json.load(f), os.getenv("META_APP_SECRET") or "")
+        print(f"{res.status_code} {res.text}")
+    else:
+        uploader.run()
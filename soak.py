@@ -0,0 +1,479 @@
+"""Soak test for DropboxToInstagramUploader: hundreds of simulated publishes against local fakes.
+
+    python soak.py --runs 100 --accounts 2 --batch 3
+    python soak.py --runs 200 --transcode --save-report soak.json
+    python soak.py --runs 200 --baseline soak.json
+    python soak.py --runs 50 --lost-rate 0.2
+"""
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlparse
+
+import requests
+
+from autopost.clients import AsyncHttpClient, GraphClient
+from autopost.timing import ManualClock, RunBudget
+
+PHASES = ("page_token", "container", "processing", "upload_start", "upload", "publish", "verify")
+
+Sample = namedtuple("Sample", ("run", "rss_mb", "fds", "threads", "temp_files", "temp_bytes", "seconds"))
+Thresholds = namedtuple("Thresholds", ("rss_growth_mb", "fd_growth", "thread_growth", "temp_files", "phase_p99", "failures", "regression"))
+
+
+class FakeGraphAdapter(requests.adapters.BaseAdapter):
+    """Answers the Graph API and rupload endpoints the pipeline uses, with simulated latency and failures."""
+
+    def __init__(self, page_id, ig_id, latency=(0.005, 0.03), processing_polls=1, failure_rate=0.0, lost_rate=0.0, seed=0):
+        super().__init__()
+        self.page_id = page_id
+        self.ig_id = ig_id
+        self.latency = latency
+        self.processing_polls = processing_polls
+        self.failure_rate = failure_rate
+        self.lost_rate = lost_rate
+        self.rng = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.containers = {}
+        self.captions = {}
+        self.posts = {}
+        self.sources = {}
+        self.requests = 0
+        self.lost = 0
+
+    def new_id(self, prefix):
+        return f"{prefix}{next(self._ids)}"
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.requests += 1
+            delay = self.rng.uniform(*self.latency)
+            fail = self.rng.random() < self.failure_rate
+            lost = self.rng.random() < self.lost_rate
+        time.sleep(delay)
+        url = urlparse(request.url)
+        params = dict(parse_qsl(url.query))
+        body = request.body.decode("utf-8") if isinstance(request.body, bytes) else request.body or ""
+        data = dict(parse_qsl(body))
+        status, payload = self.route(request.method, url.netloc, url.path.rstrip("/"), params, data, fail, lost)
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(payload).encode("utf-8")
+        response.headers["Content-Type"] = "application/json"
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+    def status_of(self, container_id):
+        with self._lock:
+            polls = self.containers.get(container_id)
+            if polls is None:
+                return "FINISHED"
+            if polls > 0:
+                self.containers[container_id] = polls - 1
+                return "IN_PROGRESS"
+            return "FINISHED"
+
+    @property
+    def duplicates(self):
+        with self._lock:
+            return sum(count - 1 for count in self.sources.values())
+
+    def publish(self, edge, prefix, source, text_field, text, time_field, fail, lost):
+        """Create a post on edge; a lost publish goes through but answers 504."""
+        if fail:
+            return 400, {"error": {"message": "Simulated failure", "code": 100, "error_subcode": 0, "type": "OAuthException"}}
+        post_id = self.new_id(prefix)
+        with self._lock:
+            self.posts.setdefault(edge, []).insert(0, {"id": post_id, text_field: text, time_field: time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime())})
+            self.sources[(edge, source)] = self.sources.get((edge, source), 0) + 1
+            if lost:
+                self.lost += 1
+                return 504, {"error": {"message": "Simulated gateway timeout", "code": 2, "type": "OAuthException"}}
+        return 200, {"id": post_id}
+
+    def listing(self, edge, params):
+        with self._lock:
+            return 200, {"data": self.posts.get(edge, [])[:int(params.get("limit") or 25)]}
+
+    def route(self, method, host, path, params, data, fail, lost):
+        if host.startswith("rupload"):
+            return 200, {"success": True}
+        # Some calls pin a Graph version (/v18.0/...), others use the unversioned default
+        parts = [p for p in path.split("/") if p]
+        if parts and re.match(r"v\d+\.\d+$", parts[0]):
+            parts = parts[1:]
+        node = parts[0] if parts else None
+        edge = parts[1] if len(parts) > 1 else None
+
+        if method == "GET" and node is None and "ids" in params:
+            return 200, {cid: {"id": cid, "status_code": self.status_of(cid)} for cid in params["ids"].split(",")}
+        if node == "debug_token":
+            return 200, {"data": {"is_valid": True, "expires_at": int(time.time()) + 60 * 86400, "data_access_expires_at": 0}}
+        if node == "me" and edge == "accounts":
+            return 200, {"data": [{
+                "id": self.page_id, "name": "Soak Page", "category": "Test", "tasks": ["CREATE_CONTENT"],
+                "access_token": "soak-page-token", "instagram_business_account": {"id": self.ig_id}
+            }]}
+        if node == "me" and edge == "permissions":
+            return 200, {"data": [{"permission": "instagram_content_publish", "status": "granted"}]}
+        if node == "me":
+            return 200, {"id": self.page_id, "name": "Soak Page", "category": "Test"}
+
+        if node == self.ig_id and edge == "content_publishing_limit":
+            return 200, {"data": [{"quota_usage": 0, "config": {"quota_total": 1000000, "quota_duration": 86400}}]}
+        if method == "GET" and node in (self.ig_id, self.page_id) and edge in ("media", "video_reels", "videos", "photos", "feed"):
+            return self.listing(edge, params)
+        if node == self.ig_id and edge == "media":
+            container_id = self.new_id("C")
+            with self._lock:
+                self.containers[container_id] = self.processing_polls if data.get("media_type") == "REELS" else 0
+                self.captions[container_id] = data.get("caption")
+            return 200, {"id": container_id}
+        if node == self.ig_id and edge == "media_publish":
+            creation_id = data.get("creation_id")
+            return self.publish("media", "M", creation_id, "caption", self.captions.get(creation_id), "timestamp", fail, lost)
+
+        if node == self.page_id and edge == "video_reels":
+            if method == "GET":
+                return 200, {"data": []}
+            if data.get("upload_phase") == "start":
+                video_id = self.new_id("V")
+                return 200, {"video_id": video_id, "upload_url": f"https://rupload.facebook.com/video-upload/v23.0/{video_id}"}
+            return self.publish("video_reels", "V", data.get("video_id"), "description", data.get("description"), "created_time", fail, lost)
+        if node == self.page_id and edge == "videos":
+            return self.publish(edge, "V", data.get("file_url"), "description", data.get("description"), "created_time", fail, lost)
+        if node == self.page_id and edge == "photos":
+            if data.get("published") == "false":
+                return 200, {"id": self.new_id("PH")}
+            return self.publish(edge, "PH", data.get("url"), "name", data.get("caption"), "created_time", fail, lost)
+        if node == self.page_id and edge == "feed":
+            attached = tuple(sorted(v for k, v in data.items() if k.startswith("attached_media")))
+            return self.publish(edge, f"{self.page_id}_", attached, "message", data.get("message"), "created_time", fail, lost)
+        if node == self.page_id:
+            return 200, {"id": self.page_id, "name": "Soak Page", "instagram_business_account": {"id": self.ig_id}}
+
+        if node and node.startswith("C"):
+            return 200, {"id": node, "status_code": self.status_of(node)}
+        if node and node.startswith("M"):
+            return 200, {"id": node, "permalink": f"https://instagram.test/p/{node}", "media_type": "VIDEO", "timestamp": "2024-01-01T00:00:00+0000"}
+        if node and node.startswith("V"):
+            return 200, {"id": node, "permalink_url": f"/reel/{node}", "created_time": "2024-01-01T00:00:00+0000", "length": 4}
+        return 404, {"error": {"message": f"Unknown soak endpoint {method} {path}", "code": 803}}
+
+
+def rss_mb():
+    """Resident set size of this process in MB (VmRSS; ru_maxrss where /proc is missing)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def open_fds():
+    for path in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return -1
+
+
+def dir_usage(path):
+    files, size = 0, 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                pass
+    return files, size
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else None
+
+
+def make_samples(workdir):
+    """A 4 s 1080x1920 H.264 Reel (in spec) and a 1080x1350 JPEG to copy from."""
+    from moviepy.config import get_setting
+    from PIL import Image
+    video = os.path.join(workdir, "sample.mp4")
+    subprocess.run([
+        get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", "testsrc=size=1080x1920:rate=30:duration=4",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p", "-b:v", "2M", "-movflags", "+faststart", video
+    ], check=True)
+    image = os.path.join(workdir, "sample.jpg")
+    Image.new("RGB", (1080, 1350), (20, 40, 80)).save(image, quality=85)
+    return video, image
+
+
+def write_unique_copy(src, dst, serial):
+    """Copy src with a trailer players ignore, so every file gets its own content hash."""
+    shutil.copyfile(src, dst)
+    trailer = f"soak-{serial}-{random.getrandbits(64):016x}".encode("ascii")
+    with open(dst, "ab") as f:
+        if dst.endswith(".mp4"):
+            f.write(struct.pack(">I4s", 8 + len(trailer), b"free") + trailer)
+        else:
+            f.write(trailer)
+
+
+class SoakAccount:
+    """One uploader with its own media folder, state and fake Graph API."""
+
+    def __init__(self, pipeline, index, workdir, args):
+        self.pipeline = pipeline
+        self.root = os.path.join(workdir, f"account{index}")
+        self.folder = os.path.join(self.root, "eclipsed_by_you")
+        state = os.path.join(self.root, "state")
+        os.makedirs(self.folder)
+        os.makedirs(state)
+        env = {
+            "MEDIA_SOURCE": "local",
+            "LOCAL_MEDIA_DIR": self.root,
+            "META_TOKEN": "soak-user-token",
+            "IG_ID": f"1784{index:08d}",
+            "FB_PAGE_ID": f"1000{index:08d}",
+            "POST_BATCH_SIZE": str(args.batch),
+            "PUBLISH_DESTINATIONS": args.destinations,
+            "TRANSCODE_MODE": "auto" if args.transcode else "off",
+            "PUBLISH_HISTORY_DB": os.path.join(state, "publish_history.db"),
+            "MEDIA_INDEX_DB": os.path.join(state, "media_index.db"),
+            "CIRCUIT_BREAKER_STATE": os.path.join(state, "circuit_breakers.json"),
+            "TOKEN_CACHE": os.path.join(state, "tokens.json"),
+            "TRANSCODE_CACHE_DIR": os.path.join(state, "transcode_cache"),
+        }
+        for key in ("TELEGRAM_BOT_TOKEN", "PUBLISH_TRACE_MODE", "WEBHOOK_MODE"):
+            os.environ.pop(key, None)
+        os.environ.update(env)
+
+        uploader = pipeline.DropboxToInstagramUploader()
+        self.graph = FakeGraphAdapter(env["FB_PAGE_ID"], env["IG_ID"], latency=(args.min_latency, args.max_latency),
+                                      processing_polls=args.processing_polls, failure_rate=args.failure_rate,
+                                      lost_rate=args.lost_rate, seed=index)
+        uploader.session.mount("https://graph.facebook.com", self.graph)
+        uploader.session.mount("https://rupload.facebook.com", self.graph)
+        # The adapter lives on the requests session, so async calls must use it too
+        uploader.http = AsyncHttpClient(uploader.session, breakers=uploader.breakers, use_httpx=False)
+        uploader.http.response_hooks.append(uploader.quota.observe_response)
+        uploader.graph = GraphClient(uploader.http)
+        # Polls and verification waits complete instantly; request latency stays real
+        uploader.clock = ManualClock(time.time())
+        self.uploader = uploader
+        self.source = uploader.authenticate_dropbox()
+        self.serial = itertools.count()
+        self.runs = itertools.count(1)
+
+    def seed(self, count, video, image, video_share):
+        for _ in range(count):
+            serial = next(self.serial)
+            src = video if random.random() < video_share else image
+            write_unique_copy(src, os.path.join(self.folder, f"soak_{serial:06d}{os.path.splitext(src)[1]}"), serial)
+
+    def run_once(self, deadline):
+        uploader = self.uploader
+        uploader.run_id = f"soak{next(self.runs)}"
+        uploader.budget = RunBudget(uploader.clock, deadline)
+        return uploader.process_files_with_retries(self.source, "soak caption", "soak description")
+
+    def outcomes(self):
+        rows = self.uploader.history.query(limit=1000000)
+        return sum(1 for r in rows if r["outcome"] == "success"), sum(1 for r in rows if r["outcome"] != "success")
+
+    def phase_values(self):
+        conn = self.uploader.history.conn
+        return [(phase, seconds) for phase, seconds in conn.execute(
+            "SELECT ph.phase, ph.seconds FROM phases ph JOIN publishes p ON p.id = ph.publish_id WHERE p.outcome = 'success'"
+        )]
+
+    def close(self):
+        self.source.stop()
+
+
+def sample(run, temp_dir, seconds):
+    gc.collect()
+    files, size = dir_usage(temp_dir)
+    return Sample(run, rss_mb(), open_fds(), threading.active_count(), files, size, seconds)
+
+
+def evaluate(report, thresholds, baseline=None):
+    """Problems found in report; an empty list means the soak passed."""
+    problems = []
+    growth = report["growth"]
+    if growth["rss_mb"] > thresholds.rss_growth_mb:
+        problems.append(f"RSS grew {growth['rss_mb']:.1f} MB after warm-up (limit {thresholds.rss_growth_mb} MB)")
+    if growth["fds"] > thresholds.fd_growth:
+        problems.append(f"Open file descriptors grew by {growth['fds']} (limit {thresholds.fd_growth})")
+    if growth["threads"] > thresholds.thread_growth:
+        problems.append(f"Threads grew by {growth['threads']} (limit {thresholds.thread_growth})")
+    if report["final"]["temp_files"] > thresholds.temp_files:
+        problems.append(f"{report['final']['temp_files']} temp files ({report['final']['temp_bytes']} bytes) left behind (limit {thresholds.temp_files})")
+    if report["duplicates"]:
+        problems.append(f"{report['duplicates']} posts published more than once")
+    if report["failures"] > thresholds.failures:
+        problems.append(f"{report['failures']} failed publishes (limit {thresholds.failures})")
+    for phase, stats in report["phases"].items():
+        if stats["p99"] > thresholds.phase_p99:
+            problems.append(f"{phase} p99 {stats['p99']:.3f}s over {thresholds.phase_p99}s")
+    if baseline:
+        limit = 1 + thresholds.regression
+        for phase, stats in report["phases"].items():
+            before = baseline["phases"].get(phase)
+            if before and before["p95"] and stats["p95"] > before["p95"] * limit:
+                problems.append(f"{phase} p95 regressed {before['p95']:.3f}s -> {stats['p95']:.3f}s (more than {thresholds.regression:.0%})")
+        before_growth = baseline["growth"]["rss_mb"]
+        if growth["rss_mb"] > max(before_growth * limit, before_growth + 8):
+            problems.append(f"RSS growth regressed {before_growth:.1f} MB -> {growth['rss_mb']:.1f} MB")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak-test the publish pipeline against local fakes.")
+    parser.add_argument("--runs", type=int, default=100, help="runs per account")
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--batch", type=int, default=3, help="posts per run (POST_BATCH_SIZE)")
+    parser.add_argument("--destinations", default="instagram,facebook", help="PUBLISH_DESTINATIONS for every account")
+    parser.add_argument("--video-share", type=float, default=0.5, help="share of seeded files that are Reels")
+    parser.add_argument("--transcode", action="store_true", help="run the TRANSCODE_MODE=auto download/probe stage")
+    parser.add_argument("--warmup", type=int, default=5, help="runs before the baseline sample is taken")
+    parser.add_argument("--deadline", type=float, default=900, help="RUN_DEADLINE_SECONDS per run")
+    parser.add_argument("--min-latency", type=float, default=0.005)
+    parser.add_argument("--max-latency", type=float, default=0.03)
+    parser.add_argument("--processing-polls", type=int, default=1)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--lost-rate", type=float, default=0.0, help="share of publishes that go through but answer 504")
+    parser.add_argument("--max-rss-growth", type=float, default=64.0, help="MB")
+    parser.add_argument("--max-fd-growth", type=int, default=8)
+    parser.add_argument("--max-thread-growth", type=int, default=4)
+    parser.add_argument("--max-temp-files", type=int, default=0)
+    parser.add_argument("--max-phase-p99", type=float, default=5.0, help="seconds")
+    parser.add_argument("--max-failures", type=int, default=None, help="default: 0, or unlimited with --failure-rate")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="allowed p95 / RSS growth regression against --baseline")
+    parser.add_argument("--baseline", help="report JSON from an earlier soak to compare against")
+    parser.add_argument("--save-report", help="write the report JSON here")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    thresholds = Thresholds(
+        args.max_rss_growth, args.max_fd_growth, args.max_thread_growth, args.max_temp_files, args.max_phase_p99,
+        args.max_failures if args.max_failures is not None else (0 if args.failure_rate == 0 else float("inf")),
+        args.max_regression
+    )
+    workdir = tempfile.mkdtemp(prefix="soak-")
+    temp_dir = os.path.join(workdir, "tmp")
+    os.makedirs(temp_dir)
+    # Anything the pipeline leaks through tempfile ends up here
+    tempfile.tempdir = temp_dir
+    os.environ["TMPDIR"] = temp_dir
+
+    import eclipsed_by_you_post as pipeline
+    accounts = []
+    try:
+        video, image = make_samples(workdir)
+        accounts = [SoakAccount(pipeline, i, workdir, args) for i in range(args.accounts)]
+        logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+        samples, run_seconds, baseline_sample = [], [], None
+        for run in range(1, args.runs + 1):
+            started = time.time()
+            for account in accounts:
+                account.seed(args.batch, video, image, args.video_share)
+                account.run_once(args.deadline)
+            run_seconds.append(time.time() - started)
+            samples.append(sample(run, temp_dir, run_seconds[-1]))
+            if run == min(args.warmup, args.runs):
+                baseline_sample = samples[-1]
+            if run % 10 == 0 or run == args.runs:
+                s = samples[-1]
+                print(f"run {run}/{args.runs}: rss {s.rss_mb:.1f} MB, fds {s.fds}, threads {s.threads}, "
+                      f"temp {s.temp_files} files, {s.seconds:.2f}s", flush=True)
+
+        final = samples[-1]
+        phase_values = {}
+        for account in accounts:
+            for phase, seconds in account.phase_values():
+                phase_values.setdefault(phase, []).append(seconds)
+        succeeded = sum(a.outcomes()[0] for a in accounts)
+        failed = sum(a.outcomes()[1] for a in accounts)
+        report = {
+            "runs": args.runs,
+            "accounts": args.accounts,
+            "batch": args.batch,
+            "publishes": succeeded + failed,
+            "failures": failed,
+            "graph_requests": sum(a.graph.requests for a in accounts),
+            "lost_responses": sum(a.graph.lost for a in accounts),
+            "adopted": sum(a.uploader.guard.adopted for a in accounts),
+            "duplicates": sum(a.graph.duplicates for a in accounts),
+            "baseline": baseline_sample._asdict(),
+            "final": final._asdict(),
+            "growth": {
+                "rss_mb": final.rss_mb - baseline_sample.rss_mb,
+                "fds": final.fds - baseline_sample.fds,
+                "threads": final.threads - baseline_sample.threads,
+            },
+            "run_seconds": {"p50": percentile(run_seconds, 0.50), "p95": percentile(run_seconds, 0.95), "p99": percentile(run_seconds, 0.99)},
+            "phases": {
+                phase: {"count": len(values), "p50": percentile(values, 0.50), "p95": percentile(values, 0.95), "p99": percentile(values, 0.99)}
+                for phase, values in sorted(phase_values.items(), key=lambda item: PHASES.index(item[0]) if item[0] in PHASES else len(PHASES))
+            },
+            "samples": [s._asdict() for s in samples],
+        }
+    finally:
+        for account in accounts:
+            account.close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    problems = evaluate(report, thresholds, baseline)
+    report["problems"] = problems
+    if args.save_report:
+        with open(args.save_report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    print(f"\n📊 {report['publishes']} publishes ({report['failures']} failed), {report['graph_requests']} Graph requests")
+    print(f"🔁 {report['lost_responses']} lost publish responses, {report['adopted']} posts found by lookup, {report['duplicates']} duplicates")
+    print(f"🧠 RSS {baseline_sample.rss_mb:.1f} -> {final.rss_mb:.1f} MB | fds {baseline_sample.fds} -> {final.fds} | "
+          f"threads {baseline_sample.threads} -> {final.threads} | temp files left {final.temp_files}")
+    print(f"⏱️ Run p50 {report['run_seconds']['p50']:.2f}s p95 {report['run_seconds']['p95']:.2f}s p99 {report['run_seconds']['p99']:.2f}s")
+    for phase, stats in report["phases"].items():
+        print(f"  {phase:<12} n={stats['count']:<5} p50={stats['p50']:.3f}s p95={stats['p95']:.3f}s p99={stats['p99']:.3f}s")
+    if problems:
+        print("\n".join(f"❌ {problem}" for problem in problems))
+        return 1
+    print("✅ Soak passed")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())